@@ -0,0 +1,55 @@
+"""
+Compare the json and etf gateway encodings on recorded traffic.
+
+Usage: python benchmarks/gateway_encodings.py [traffic]
+
+traffic is a recording (main_loop(record_path=...)) or holds one raw gateway payload (JSON) per line.
+Without it a synthetic MESSAGE_CREATE is used.
+
+The etf decoder is pure Python: expect it to decode several times slower than json,
+etf is supported for compatibility, not speed. Frame sizes are those of the payloads re-encoded,
+only representative for the encoding the traffic was recorded in: JSON traffic (and the synthetic
+payload) carries snowflakes as strings, while Discord sends them as integers with etf.
+"""
+import sys
+import timeit
+
+from tppatchcord.api_types import process_event_payload
+from tppatchcord.codecs import ETF_CODEC, JSON_CODEC, ORJSON_CODEC
+from tppatchcord.fakegateway import load_events
+
+SYNTHETIC_USER = {"id": "80351110224678912", "username": "nelly", "discriminator": "0", "global_name": "Nelly", "avatar": "8342729096ea3675442027381ff50dfe"}
+SYNTHETIC_PAYLOAD = {
+    "op": 0, "s": 42, "t": "MESSAGE_CREATE",
+    "d": {
+        "id": "1278017234023940096", "channel_id": "1278017010211676200", "guild_id": "1278017009456570368",
+        "author": SYNTHETIC_USER, "member": {"roles": ["1278017009456570369"], "joined_at": "2024-08-27T15:00:00.000000+00:00", "deaf": False, "mute": False, "flags": 0},
+        "content": "Hello, world!", "timestamp": "2024-08-27T15:05:00.000000+00:00", "edited_timestamp": None,
+        "tts": False, "mention_everyone": False, "mentions": [SYNTHETIC_USER], "mention_roles": [], "attachments": [],
+        "embeds": [{"title": "embed", "description": "x" * 200, "fields": [{"name": "a", "value": "b", "inline": True}] * 5}],
+        "pinned": False, "type": 0, "flags": 0
+    }
+}
+
+
+def load_traffic(path: str | None) -> list[dict]:
+    if path is None:
+        return [SYNTHETIC_PAYLOAD] * 1000
+    return load_events(path)
+
+
+def main() -> None:
+    payloads = load_traffic(sys.argv[1] if len(sys.argv) > 1 else None)
+    codecs = [codec for codec in (JSON_CODEC, ORJSON_CODEC, ETF_CODEC) if codec]
+
+    for codec in codecs:
+        frames = [codec.dumps(payload) for payload in payloads]
+        size = sum(len(frame) for frame in frames)
+        decode = timeit.timeit(lambda: [codec.loads(frame) for frame in frames], number=5)
+        full = timeit.timeit(lambda: [process_event_payload(codec.loads(frame)) for frame in frames], number=5)
+        print(f"{codec.name:>8}: {size:>10} bytes, decode {decode / 5 * 1e6 / len(frames):8.2f} us/frame, "
+              f"decode+process {full / 5 * 1e6 / len(frames):8.2f} us/frame")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+End-to-end gateway throughput and latency against a local fake gateway:
+FakeGateway -> read_handler -> next_events() -> process_event_payloads().
+
+Usage: python benchmarks/gateway_throughput.py [--events N] [--rate R] [--codec json|orjson|etf] [--compress] [traffic]
+
+traffic is a recording (main_loop(record_path=...)) or holds one raw gateway payload (JSON) per line.
+Without it a synthetic MESSAGE_CREATE is used.
+Latency is measured from the first send of an event by the server to the end of its processing.
+"""
+import argparse
+import asyncio
+import itertools
+import time
+
+from gateway_encodings import SYNTHETIC_PAYLOAD
+
+from tppatchcord.api_types import process_event_payloads
+from tppatchcord.codecs import ETF_CODEC, JSON_CODEC, ORJSON_CODEC
+from tppatchcord.fakegateway import FakeGateway, load_events
+from tppatchcord.websockets import main_loop, next_events
+
+CODECS = {"json": JSON_CODEC, "orjson": ORJSON_CODEC, "etf": ETF_CODEC}
+
+
+async def run(args: argparse.Namespace) -> None:
+    events = load_events(args.traffic) if args.traffic else [SYNTHETIC_PAYLOAD]
+    events = [event for event in events if event.get("t") is not None] # dispatches only, the server does the rest
+    stream = itertools.islice(itertools.cycle(events), args.events)
+
+    async with FakeGateway(stream, rate=args.rate) as gateway:
+        client = asyncio.create_task(main_loop("token", gateway_base_url=gateway.url, codec=CODECS[args.codec],
+                                               compress=args.compress))
+        latencies = []
+        started = None
+        while len(latencies) < args.events:
+            batch = process_event_payloads(await next_events())
+            done = time.perf_counter()
+            for event in batch:
+                if event.name == "READY":
+                    started = done
+                    continue
+                latencies.append(done - gateway.sent_time(event.sequence))
+        elapsed = time.perf_counter() - started
+        client.cancel()
+
+    latencies.sort()
+    print(f"{args.codec:>6}{' +zlib' if args.compress else '':6}: {len(latencies) / elapsed:10.0f} events/s, "
+          f"latency p50 {latencies[len(latencies) // 2] * 1e3:7.2f} ms, p99 {latencies[len(latencies) * 99 // 100] * 1e3:7.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traffic", nargs="?")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=None, help="events per second, as fast as possible by default")
+    parser.add_argument("--codec", choices=[name for name, codec in CODECS.items() if codec], default="json")
+    parser.add_argument("--compress", action="store_true")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import asyncio
+import inspect
+
+import pytest
+
+ASYNC_TEST_TIMEOUT = 30 # seconds before a hanging coroutine test fails
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem: pytest.Function) -> bool | None:
+    # coroutine tests run in a fresh event loop each, without an asyncio plugin
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(asyncio.wait_for(pyfuncitem.obj(**arguments), ASYNC_TEST_TIMEOUT))
+    return True
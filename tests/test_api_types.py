@@ -0,0 +1,67 @@
+import logging
+import pickle
+
+from tppatchcord.api_types import (MessageCreate, User, dump_unknown_fields, process_event_payload, process_event_payloads,
+                                   unknown_field_counts)
+
+PAYLOAD = {"op": 0, "s": 1, "t": "MESSAGE_CREATE", "d": {
+    "id": "1", "content": "hello", "author": {"id": "2", "username": "author"}, "mentions": [{"id": "3"}]
+}}
+
+
+def test_lazy_and_eager_events_are_interchangeable():
+    eager = process_event_payload(PAYLOAD)
+    lazy = process_event_payload(PAYLOAD, lazy=True)
+    assert isinstance(lazy.data, MessageCreate)
+    assert type(lazy.data).__name__ == "LazyMessageCreate"
+    assert lazy == eager and eager == lazy
+    # nested fields are shown decoded
+    assert "author=LazyUser(id=2, username='author'" in repr(lazy.data)
+
+    restored = pickle.loads(pickle.dumps(lazy))
+    assert type(restored.data) is type(lazy.data)
+    assert restored == eager
+    assert isinstance(restored.data.mentions[0], User)
+
+    lazy.data.content = "edited"
+    assert lazy != eager
+
+
+def test_keep_unknown_objects_pickle_with_their_unknown_fields():
+    message = MessageCreate.from_dict({**PAYLOAD["d"], "undocumented": True}, keep_unknown=True)
+    assert message == MessageCreate.from_dict(PAYLOAD["d"])
+    restored = pickle.loads(pickle.dumps(message))
+    assert restored.unknown_fields == {"undocumented": True}
+    assert restored == message
+
+
+def test_keep_unknown_is_passed_through_and_logged_as_kept(caplog):
+    unknown_field_counts(reset=True)
+    payload = {**PAYLOAD, "d": {**PAYLOAD["d"], "kept_field": 1}}
+    with caplog.at_level(logging.WARNING, logger="tppatchcord.api_types"):
+        [event] = process_event_payloads([payload], keep_unknown=True)
+    assert event.data.unknown_fields == {"kept_field": 1}
+    assert "Undocumented field kept_field kept in unknown_fields of MessageCreate" in caplog.text
+
+    payload = {**PAYLOAD, "d": {**PAYLOAD["d"], "ignored_field": 1}}
+    with caplog.at_level(logging.WARNING, logger="tppatchcord.api_types"):
+        process_event_payload(payload)
+    assert "Undocumented field ignored_field ignored when serializing MessageCreate" in caplog.text
+    assert unknown_field_counts(reset=True) == {("MessageCreate", "kept_field"): 1, ("MessageCreate", "ignored_field"): 1}
+
+
+def test_unknown_fields_are_logged_once_across_summaries(caplog):
+    payload = {**PAYLOAD, "d": {**PAYLOAD["d"], "summarized_field": 1}}
+    with caplog.at_level(logging.WARNING, logger="tppatchcord.api_types"):
+        process_event_payload(payload)
+        dump_unknown_fields()
+        caplog.clear()
+        process_event_payload(payload)
+    assert "Undocumented field summarized_field" not in caplog.text
+    assert unknown_field_counts(reset=True) == {("MessageCreate", "summarized_field"): 1}
+
+
+def test_ready_is_decoded_with_every_option():
+    ready = {"op": 0, "s": 1, "t": "READY", "d": {"v": 10, "session_id": "session", "guilds": [{"id": "1", "unavailable": True}]}}
+    for options in ({}, {"lazy": True}, {"keep_unknown": True}, {"lazy": True, "keep_unknown": True}):
+        assert process_event_payload(ready, **options).data["session_id"] == "session"
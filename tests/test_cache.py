@@ -0,0 +1,91 @@
+from tppatchcord import cache as cache_module
+from tppatchcord.api_types import Event, MessageCreate, process_event_payload
+from tppatchcord.cache import EntityCache, MessageCache, SampledSizer, sizeof
+
+
+def dispatch(cache: EntityCache, name: str, data: dict) -> None:
+    cache.process_event(process_event_payload({"op": 0, "s": None, "t": name, "d": data}))
+
+
+def create_guild(cache: EntityCache) -> None:
+    dispatch(cache, "GUILD_CREATE", {
+        "id": "1", "name": "guild", "roles": [{"id": "2", "name": "role"}], "channels": [{"id": "3", "type": 0}],
+        "members": [{"user": {"id": "4", "username": "member"}}]
+    })
+
+
+def test_unavailable_guild_delete_keeps_the_guild():
+    cache = EntityCache()
+    create_guild(cache)
+    dispatch(cache, "GUILD_DELETE", {"id": "1", "unavailable": True})
+    assert cache.guild(1).unavailable
+    assert cache.channel(3).guild_id == 1
+    assert cache.role(2) is not None
+    assert cache.member(1, 4) is not None
+
+    create_guild(cache) # available again
+    assert not cache.guild(1).unavailable
+
+
+def test_guild_delete_evicts_the_guild():
+    for removed in ({"id": "1"}, {"id": "1", "unavailable": False}):
+        cache = EntityCache()
+        create_guild(cache)
+        dispatch(cache, "GUILD_DELETE", removed)
+        assert cache.guild(1) is None
+        assert cache.channel(3) is None
+        assert cache.role(2) is None
+        assert cache.member(1, 4) is None
+
+
+def test_every_message_is_measured_by_default():
+    # a few large messages among small ones, each charged its own size
+    messages = [MessageCreate.from_dict({"id": str(i), "channel_id": "1",
+                                         "content": "x" * (20000 if i % 10 == 5 else 10)}) for i in range(100)]
+    message_cache = MessageCache(max_messages=None, max_bytes=None)
+    for message in messages:
+        message_cache.add(message)
+    assert message_cache.size == sum(map(sizeof, messages))
+
+    max_bytes = message_cache.size // 2
+    message_cache = MessageCache(max_messages=None, max_bytes=max_bytes)
+    for message in messages:
+        message_cache.add(message)
+    assert sum(sizeof(message_cache.get(message.id)) for message in messages if message.id in message_cache) <= max_bytes
+
+
+def test_message_sizes_are_sampled_on_request(monkeypatch):
+    walked = []
+    monkeypatch.setattr(cache_module, "sizeof", lambda message: walked.append(message) or sizeof(message))
+    messages = [MessageCreate.from_dict({"id": str(i), "channel_id": "1", "content": "x" * 100}) for i in range(64)]
+    message_cache = MessageCache(max_bytes=None, sizer=SampledSizer(every=32))
+    for message in messages:
+        message_cache.add(message)
+    assert walked == [messages[0], messages[31], messages[63]]
+    assert message_cache.size == 64 * sizeof(messages[0])
+
+    # a size told by the caller (e.g. the raw frame length) is not estimated
+    message_cache.process_event(Event(0, 1, "MESSAGE_CREATE", MessageCreate.from_dict({"id": "64", "channel_id": "1"})), 500)
+    assert len(walked) == 3
+    assert message_cache.size == 64 * sizeof(messages[0]) + 500
+
+
+def test_guild_update_clears_fields_set_to_null():
+    cache = EntityCache()
+    dispatch(cache, "GUILD_CREATE", {"id": "1", "name": "guild", "icon": "abc", "description": "text"})
+    dispatch(cache, "GUILD_UPDATE", {"id": "1", "name": "renamed", "icon": None, "description": None})
+    guild = cache.guild(1)
+    assert (guild.name, guild.icon, guild.description) == ("renamed", None, None)
+
+
+def test_member_update_keeps_fields_not_sent():
+    cache = EntityCache()
+    dispatch(cache, "GUILD_CREATE", {"id": "1", "members": [
+        {"user": {"id": "4", "username": "member"}, "nick": "nick", "deaf": True, "mute": True, "roles": []}
+    ]})
+    dispatch(cache, "GUILD_MEMBER_UPDATE", {"guild_id": "1", "user": {"id": "4", "username": "member"}, "roles": ["2"],
+                                            "nick": None, "avatar": None, "joined_at": None})
+    member = cache.member(1, 4)
+    assert member.roles == [2]
+    assert member.nick is None # sent as null: cleared
+    assert member.deaf and member.mute # not sent: kept
@@ -0,0 +1,112 @@
+import asyncio
+
+from tppatchcord import websockets as gateway
+from tppatchcord.api_types import process_event_payload
+from tppatchcord.cache import EntityCache
+from tppatchcord.codecs import ETF_CODEC, JSON_CODEC
+from tppatchcord.fakegateway import FakeGateway
+from tppatchcord.queues import OverflowPolicy
+from tppatchcord.websockets import HEARTBEAT_SKEW, GatewayConnection
+
+EVENT_COUNT = 50
+
+
+def message_events(count: int = EVENT_COUNT) -> list[dict]:
+    return [{"t": "MESSAGE_CREATE", "d": {"content": str(i)}} for i in range(count)]
+
+
+async def receive_messages(connection: GatewayConnection, count: int = EVENT_COUNT) -> list[str]:
+    contents = []
+    while len(contents) < count:
+        payload = await asyncio.wait_for(connection.next_event(), 5)
+        if payload.get("t") == "MESSAGE_CREATE":
+            contents.append(payload["d"]["content"])
+    return contents
+
+
+async def run_client(gateway_server: FakeGateway, **settings) -> tuple[GatewayConnection, asyncio.Task]:
+    connection = GatewayConnection("token", gateway_base_url=gateway_server.url, **settings)
+    return connection, asyncio.create_task(connection.run())
+
+
+async def test_resume_after_disconnect_replays_missed_events(monkeypatch):
+    monkeypatch.setattr(gateway, "RECONNECT_BACKOFF_MIN", 0.01)
+    for codec, compress in ((JSON_CODEC, False), (JSON_CODEC, True), (ETF_CODEC, False)):
+        async with FakeGateway(message_events(), disconnect_every=7) as server:
+            connection, client = await run_client(server, codec=codec, compress=compress)
+            try:
+                # every event exactly once and in order, across the resumed connections
+                assert await receive_messages(connection) == [str(i) for i in range(EVENT_COUNT)]
+            finally:
+                client.cancel()
+        assert server.stats["identifies"] == 1
+        assert server.stats["resumes"] == EVENT_COUNT // 7
+        assert connection.session_id == server.session_id
+
+
+async def test_oversized_frame_reconnects_and_resumes(monkeypatch):
+    monkeypatch.setattr(gateway, "RECONNECT_BACKOFF_MIN", 0.01)
+    async with FakeGateway(message_events(), oversized_every=20) as server:
+        connection, client = await run_client(server, codec=JSON_CODEC)
+        try:
+            assert await receive_messages(connection) == [str(i) for i in range(EVENT_COUNT)]
+        finally:
+            client.cancel()
+    assert server.stats["oversized"] >= 1
+    assert server.stats["identifies"] == 1
+    assert server.stats["resumes"] >= 1
+    assert server.stats["connections"] == server.stats["resumes"] + 1
+
+
+async def test_zombie_connection_is_closed_and_resumed(monkeypatch):
+    monkeypatch.setattr(gateway, "RECONNECT_BACKOFF_MIN", 0.01)
+    # heartbeats every 50 ms, never acknowledged
+    async with FakeGateway(ack_heartbeats=False, heartbeat_interval=HEARTBEAT_SKEW + 50) as server:
+        connection, client = await run_client(server, codec=JSON_CODEC)
+        try:
+            while server.stats["resumes"] < 2:
+                await asyncio.sleep(0.05)
+        finally:
+            client.cancel()
+    assert server.stats["identifies"] == 1
+    assert server.stats["heartbeats"] >= 2
+    assert connection.latency() is None # no round-trip was ever completed
+
+
+async def test_cache_events_are_decoded_once():
+    guild = {"id": "1", "name": "guild", "roles": [{"id": "2", "name": "role"}]}
+    malformed = {"id": "3", "roles": 5}
+    cache = EntityCache()
+    async with FakeGateway([{"t": "GUILD_CREATE", "d": guild}, {"t": "GUILD_CREATE", "d": malformed},
+                            *message_events(1)]) as server:
+        connection, client = await run_client(server, codec=JSON_CODEC, entity_cache=cache,
+                                               events={"GUILD_CREATE", "MESSAGE_CREATE"})
+        try:
+            payloads = [await asyncio.wait_for(connection.next_event(), 5) for _ in range(3)]
+        finally:
+            client.cancel()
+    created, not_decoded, message = payloads
+    # the consumer gets the event the cache was fed with, unmodified
+    event = process_event_payload(created)
+    assert process_event_payload(created) is event
+    assert [role.id for role in event.data.roles] == [2]
+    assert cache.role(2) is event.data.roles[0]
+    assert cache.guild(1).roles is None
+    # a payload the cache failed to decode is still passed on, raw
+    assert type(not_decoded) is dict and not_decoded["d"] == malformed
+    assert cache.guild(3) is None
+    assert message["d"]["content"] == "0"
+
+
+async def test_spill_file_is_closed_when_the_connection_stops():
+    async with FakeGateway(message_events(5)) as server:
+        connection, client = await run_client(server, codec=JSON_CODEC, event_queue_size=1,
+                                              overflow_policy=OverflowPolicy.SPILL)
+        try:
+            while connection.queue_stats()["events"].spilled < 4:
+                await asyncio.sleep(0.01)
+            spill_file = connection.event_queue._spill_file
+        finally:
+            client.cancel()
+        await asyncio.gather(client, return_exceptions=True)
+    assert spill_file.closed
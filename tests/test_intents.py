@@ -0,0 +1,22 @@
+from tppatchcord.api_types import EVENT_DATAOBJECTS
+from tppatchcord.intents import (INTENT_EVENTS, PRIVILEGED_INTENTS, UNGATED_EVENTS, Intents, events_for_intents,
+                                  intents_for_events)
+
+
+def test_every_event_is_gated_or_ungated():
+    # UNGATED_EVENTS is spelled out so the gateway does not import the decode layer, keep it in sync
+    gated = frozenset().union(*INTENT_EVENTS.values())
+    assert UNGATED_EVENTS == frozenset(EVENT_DATAOBJECTS) - gated
+
+
+def test_privileged_intents_only_for_events_needing_them():
+    assert intents_for_events({"THREAD_MEMBERS_UPDATE"}) == Intents.GUILDS
+    assert intents_for_events({"THREAD_MEMBERS_UPDATE", "GUILD_MEMBER_ADD"}) == Intents.GUILDS | Intents.GUILD_MEMBERS
+    assert intents_for_events({"PRESENCE_UPDATE"}) == Intents.GUILD_PRESENCES
+    assert intents_for_events({"TYPING_START"}, direct_messages=True) == (Intents.GUILD_MESSAGE_TYPING
+                                                                          | Intents.DIRECT_MESSAGE_TYPING)
+    for event in frozenset().union(*INTENT_EVENTS.values()):
+        intents = intents_for_events({event}, message_content=False)
+        assert event in events_for_intents(intents)
+        if intents & PRIVILEGED_INTENTS:
+            assert all(event not in events for intent, events in INTENT_EVENTS.items() if intent not in PRIVILEGED_INTENTS)
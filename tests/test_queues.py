@@ -0,0 +1,21 @@
+from tppatchcord.queues import BoundedQueue, OverflowPolicy
+
+
+async def test_spill_file_is_closed_once_drained_or_on_close():
+    queue = BoundedQueue(2, OverflowPolicy.SPILL)
+    for i in range(5):
+        await queue.put(i)
+    spill_file = queue._spill_file
+    assert queue.stats().spilled == 3
+    assert [await queue.get() for _ in range(5)] == list(range(5))
+    assert spill_file.closed and queue._spill_file is None
+
+    # spilling again after the drain
+    for i in range(4):
+        await queue.put(i)
+    spill_file = queue._spill_file
+    queue.close()
+    assert spill_file.closed and queue._spill_file is None
+    assert queue.stats().dropped == 2
+    assert [queue.get_nowait() for _ in range(2)] == [0, 1]
+    assert queue.empty()
@@ -0,0 +1,74 @@
+import bisect
+import random
+
+from tppatchcord import ratelimit
+from tppatchcord.ratelimit import SlidingWindowLimiter
+from tppatchcord.websockets import (BULK_SEND_RESERVE, CONTROL_SEND_RESERVE, GATEWAY_SEND_LIMIT, GATEWAY_SEND_MARGIN,
+                                    GATEWAY_SEND_PERIOD)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def max_in_window(times: list[float], period: float) -> int:
+    return max(bisect.bisect_left(times, start + period) - i for i, start in enumerate(times))
+
+
+def test_sliding_window_never_exceeds_limit_in_any_window(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    limiter = SlidingWindowLimiter(GATEWAY_SEND_LIMIT, GATEWAY_SEND_PERIOD + GATEWAY_SEND_MARGIN)
+    rng = random.Random(0)
+    acquired = []
+    # bursts and lulls of mixed priority traffic, well above the limit on average
+    for _ in range(50000):
+        clock.now += rng.choice((0.0, 0.0, 0.01, rng.expovariate(1)))
+        if limiter.try_acquire(rng.choice((0, CONTROL_SEND_RESERVE, CONTROL_SEND_RESERVE + BULK_SEND_RESERVE))):
+            acquired.append(clock.now)
+    assert max_in_window(acquired, GATEWAY_SEND_PERIOD) <= GATEWAY_SEND_LIMIT
+    assert max_in_window(acquired, GATEWAY_SEND_PERIOD + GATEWAY_SEND_MARGIN) == GATEWAY_SEND_LIMIT
+
+
+def test_sliding_window_burst_is_not_refilled_within_the_period(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    limiter = SlidingWindowLimiter(120, 60)
+    assert all(limiter.try_acquire() for _ in range(120))
+    assert not limiter.try_acquire()
+    assert limiter.delay() == 60
+
+    clock.now += 59.9
+    assert not limiter.try_acquire()
+    clock.now += 0.1
+    assert all(limiter.try_acquire() for _ in range(120))
+    assert not limiter.try_acquire()
+
+
+def test_sliding_window_reserve(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    limiter = SlidingWindowLimiter(10, 1)
+    assert sum(limiter.try_acquire(reserve=3) for _ in range(10)) == 7
+    assert limiter.delay(reserve=3) == 1
+    assert limiter.try_acquire()
+
+
+def test_sliding_window_counts_held_acquisitions_until_released(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    limiter = SlidingWindowLimiter(2, 1)
+    assert limiter.try_acquire(hold=True) and limiter.try_acquire(hold=True)
+    clock.now += 5
+    assert not limiter.try_acquire() # still held
+    limiter.release()
+    clock.now += 0.5
+    limiter.release()
+    assert limiter.delay() == 0.5 # a period after the first release
+    clock.now += 0.5
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from tppatchcord import recording
+from tppatchcord.codecs import ETF_CODEC, default_codec
+from tppatchcord.queues import BoundedQueue
+from tppatchcord.recording import FrameRecorder, RecordingError, iter_frames, read_payloads, replay
+
+PAYLOADS = [
+    {"op": 10, "d": {"heartbeat_interval": 41250}, "s": None, "t": None},
+    {"op": 0, "d": {"id": "1", "content": "a"}, "s": 1, "t": "MESSAGE_CREATE"},
+    {"op": 0, "d": {"id": "1"}, "s": 2, "t": "MESSAGE_DELETE"},
+    {"op": 11, "d": None, "s": None, "t": None},
+    {"op": 0, "d": {"id": "2", "content": "b"}, "s": 3, "t": "MESSAGE_CREATE"},
+]
+
+
+async def test_recorded_frames_are_replayed(tmp_path, monkeypatch):
+    monkeypatch.setattr(recording, "RECORD_BLOCK_SIZE", 100) # several blocks
+    path = str(tmp_path / "gateway.rec")
+    recorder = FrameRecorder(path, default_codec().encoding)
+    for payload in PAYLOADS[:3]:
+        recorder.write(json.dumps(payload))
+    recorder.close()
+    # appending to an existing recording of the same encoding
+    recorder = FrameRecorder(path, default_codec().encoding)
+    for payload in PAYLOADS[3:]:
+        recorder.write(json.dumps(payload).encode(), shard_id=1)
+    recorder.close()
+
+    shard_ids = [None] * 3 + [1] * 2
+    assert [shard_id for _, shard_id, _ in iter_frames(path)] == shard_ids
+    assert list(read_payloads(path)) == [payload | {"shard_id": 1} if shard_id is not None else payload
+                                         for payload, shard_id in zip(PAYLOADS, shard_ids)]
+
+    queue = BoundedQueue()
+    assert await replay(path, queue, speed=None, events={"MESSAGE_CREATE"}) == 4 # non-dispatch payloads always pass
+    assert [queue.get_nowait()["op"] for _ in range(4)] == [10, 0, 11, 0]
+    assert queue.empty()
+
+    # a block truncated by a crash ends the recording
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 1)
+    assert len(list(iter_frames(path))) == 3
+
+
+def test_recording_of_another_encoding_is_refused(tmp_path):
+    path = str(tmp_path / "gateway.rec")
+    FrameRecorder(path, default_codec().encoding).close()
+    with pytest.raises(RecordingError):
+        FrameRecorder(path, ETF_CODEC.encoding)
+    assert list(iter_frames(path)) == [] # left untouched
+
+    not_a_recording = tmp_path / "frames.txt"
+    not_a_recording.write_text(json.dumps(PAYLOADS[0]))
+    with pytest.raises(RecordingError):
+        FrameRecorder(str(not_a_recording), default_codec().encoding)
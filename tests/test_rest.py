@@ -0,0 +1,229 @@
+import asyncio
+import bisect
+import contextlib
+from typing import AsyncIterator
+
+import aiohttp
+from aiohttp import web
+
+from tppatchcord import rest
+from tppatchcord import websockets as gateway
+from tppatchcord.ratelimit import REST_GLOBAL_LIMIT, REST_GLOBAL_PERIOD
+
+MESSAGES_ROUTE = "channels/{channel_id}/messages"
+MESSAGES_BUCKET = "messages-bucket-hash"
+GATEWAY_BOT = {"url": "wss://gateway.discord.gg", "shards": 2,
+               "session_start_limit": {"total": 1000, "remaining": 999, "reset_after": 0, "max_concurrency": 1}}
+
+
+class RateLimitedAPI:
+    """
+    Local stand-in of the Discord REST API. GET and POST of a channel's messages share one bucket hash,
+    split by channel like Discord's major parameters, and requests over its limit are answered with 429.
+    users/{user_id} has no per-route limit. Other failures (e.g. 429s of another scope) can be queued
+    with fail_next(), they are answered before any limit is applied.
+    """
+
+    def __init__(self, limit: int = 3, reset_after: float = 0.2) -> None:
+        self.limit = limit
+        self.reset_after = reset_after
+        self.windows = {} # channel_id -> [remaining, loop time of the reset]
+        self.requests = [] # (loop time, method, path)
+        self.unexpected_429s = 0 # requests sent over a bucket's limit
+        self._failures = [] # (status, headers, body) answered to the next requests
+
+    def fail_next(self, status: int = 429, headers: dict | None = None, body: dict | str | None = None) -> None:
+        self._failures.append((status, headers or {}, body))
+
+    def times(self, method: str | None = None) -> list[float]:
+        return [time for time, request_method, _ in self.requests if method is None or request_method == method]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        now = asyncio.get_running_loop().time()
+        self.requests.append((now, request.method, request.path))
+        await asyncio.sleep(0.01) # the next requests may be sent before this one is answered
+
+        if self._failures:
+            status, headers, body = self._failures.pop(0)
+            if isinstance(body, str):
+                return web.Response(status=status, text=body, headers=headers)
+            return web.json_response(body, status=status, headers=headers)
+
+        if request.path.endswith("/gateway/bot"):
+            return web.json_response(GATEWAY_BOT)
+        channel_id = request.match_info.get("channel_id")
+        if channel_id is None:
+            return web.json_response({"id": request.match_info["user_id"]})
+        window = self.windows.setdefault(channel_id, [self.limit, now + self.reset_after])
+        if window[1] <= now:
+            window[:] = [self.limit, now + self.reset_after]
+        reset_after = window[1] - now
+        if window[0] == 0:
+            self.unexpected_429s += 1
+            return web.json_response({"message": "You are being rate limited.", "retry_after": reset_after, "global": False},
+                                     status=429, headers={"X-RateLimit-Scope": "user"})
+        window[0] -= 1
+        return web.json_response({"id": channel_id}, headers={
+            "X-RateLimit-Bucket": MESSAGES_BUCKET, "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(window[0]), "X-RateLimit-Reset-After": f"{reset_after:.3f}"
+        })
+
+
+@contextlib.asynccontextmanager
+async def rest_stand_in(**settings) -> AsyncIterator[RateLimitedAPI]:
+    api = RateLimitedAPI(**settings)
+    app = web.Application()
+    app.router.add_route("*", "/api/v10/channels/{channel_id}/messages", api.handle)
+    app.router.add_route("*", "/api/v10/users/{user_id}", api.handle)
+    app.router.add_route("GET", "/api/v10/gateway/bot", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    rest.init_rest("token", base_url=f"http://127.0.0.1:{port}/api/v10/")
+    try:
+        yield api
+    finally:
+        await rest.close_rest_session()
+        await runner.cleanup()
+
+
+async def get_messages(channel_id: int, n: int) -> dict:
+    # distinct queries, identical GETs would be coalesced
+    return await rest.request("GET", MESSAGES_ROUTE, {"channel_id": channel_id}, query={"n": n})
+
+
+async def test_bucket_discovery_queues_requests_instead_of_429():
+    async with rest_stand_in(limit=3, reset_after=0.2) as api:
+        results = await asyncio.gather(*(get_messages(1, n) for n in range(10)))
+    assert results == [{"id": "1"}] * 10
+    assert api.unexpected_429s == 0
+    # a single probe until the first response told the limit
+    times = api.times()
+    assert times[1] - times[0] >= 0.01
+    # 10 requests at 3 per 0.2 s window
+    assert times[-1] - times[0] >= 0.6
+
+
+async def test_routes_sharing_a_bucket_hash_share_its_budget():
+    async with rest_stand_in(limit=3, reset_after=0.2) as api:
+        await get_messages(1, 0) # discovers the hash of the GET route
+        await rest.request("POST", MESSAGES_ROUTE, {"channel_id": 1}, {"content": "discovered"})
+        limiter = rest.rate_limiter()
+        assert limiter.route_buckets[("GET", MESSAGES_ROUTE)] == MESSAGES_BUCKET
+        assert limiter.route_buckets[("POST", MESSAGES_ROUTE)] == MESSAGES_BUCKET
+        assert limiter.bucket("GET", MESSAGES_ROUTE, {"channel_id": 1}) is limiter.bucket("POST", MESSAGES_ROUTE, {"channel_id": 1})
+        assert limiter.bucket("GET", MESSAGES_ROUTE, {"channel_id": 1}) is not limiter.bucket("GET", MESSAGES_ROUTE, {"channel_id": 2})
+
+        await asyncio.gather(*(get_messages(1, n) for n in range(1, 6)),
+                             *(rest.request("POST", MESSAGES_ROUTE, {"channel_id": 1}, {"content": n}) for n in range(5)),
+                             *(get_messages(2, n) for n in range(3)))
+    assert api.unexpected_429s == 0
+
+
+async def test_global_429_holds_back_every_route():
+    async with rest_stand_in() as api:
+        api.fail_next(429, {"X-RateLimit-Global": "true", "X-RateLimit-Scope": "global"},
+                      {"message": "You are being rate limited.", "retry_after": 0.3, "global": True})
+        first = asyncio.create_task(rest.request("GET", "users/{user_id}", {"user_id": 1}))
+        await asyncio.sleep(0.1) # the global 429 is answered meanwhile
+        assert await rest.request("GET", "users/{user_id}", {"user_id": 2}) == {"id": "2"}
+        assert await first == {"id": "1"}
+    rate_limited, *retries = api.times()
+    assert len(retries) == 2
+    assert all(time - rate_limited >= 0.3 for time in retries)
+
+
+async def test_retry_after_of_bucket_and_shared_429s():
+    async with rest_stand_in(limit=5, reset_after=5) as api:
+        await get_messages(1, 0)
+        # a bucket 429 (e.g. another process using the same token) blocks the bucket for retry_after
+        api.fail_next(429, {"X-RateLimit-Scope": "user", "X-RateLimit-Bucket": MESSAGES_BUCKET, "X-RateLimit-Limit": "5",
+                            "X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "0.3"},
+                      {"message": "You are being rate limited.", "retry_after": 0.3})
+        assert await get_messages(1, 1) == {"id": "1"}
+        # a shared resource 429 is retried after retry_after
+        api.fail_next(429, {"X-RateLimit-Scope": "shared"}, {"message": "You are being rate limited.", "retry_after": 0.2})
+        assert await get_messages(1, 2) == {"id": "1"}
+        # a 429 from a proxy only tells Retry-After
+        api.fail_next(429, {"Retry-After": "0.2"}, "Too Many Requests")
+        assert await get_messages(1, 3) == {"id": "1"}
+    times = api.times()
+    assert times[2] - times[1] >= 0.3
+    assert times[4] - times[3] >= 0.2
+    assert 0.2 <= times[6] - times[5] < 1 # the bucket kept its budget
+
+
+async def test_undiscovered_route_probes_again_after_a_429():
+    async with rest_stand_in(limit=3, reset_after=0.2) as api:
+        await asyncio.gather(*(rest.request("POST", MESSAGES_ROUTE, {"channel_id": 1}, {"n": n}) for n in range(3)))
+        # the first GET shares the exhausted bucket without knowing it yet and gets a 429 without limit headers
+        assert await asyncio.wait_for(get_messages(1, 0), 2) == {"id": "1"}
+    assert [method for _, method, _ in api.requests] == ["POST"] * 3 + ["GET"] * 2
+
+
+async def test_global_limit_holds_in_any_window():
+    async with rest_stand_in() as api:
+        await asyncio.gather(*(rest.request("GET", "users/{user_id}", {"user_id": n}) for n in range(REST_GLOBAL_LIMIT * 2 + 10)))
+    times = api.times()
+    assert max(bisect.bisect_left(times, start + REST_GLOBAL_PERIOD) - i for i, start in enumerate(times)) <= REST_GLOBAL_LIMIT
+
+
+async def test_gateway_bot_is_fetched_through_the_rest_session():
+    async with rest_stand_in() as api:
+        assert await gateway.fetch_gateway_bot("token") == GATEWAY_BOT
+    assert [path for _, _, path in api.requests] == ["/api/v10/gateway/bot"]
+
+
+async def current_session() -> aiohttp.ClientSession:
+    return rest.rest_session()
+
+
+def test_session_of_a_previous_loop_is_closed():
+    # by that loop if it is still open
+    loop = asyncio.new_event_loop()
+    try:
+        first = loop.run_until_complete(current_session())
+        second = asyncio.run(current_session())
+        assert second is not first
+        loop.run_until_complete(asyncio.sleep(0))
+        assert first.closed
+    finally:
+        loop.close()
+    # detached from it if it is closed
+    third = asyncio.run(current_session())
+    assert second.closed and not third.closed
+    asyncio.run(rest.close_rest_session())
+    assert third.closed
+
+
+async def test_identical_concurrent_gets_are_sent_once():
+    async with rest_stand_in() as api:
+        results = await asyncio.gather(*(rest.request("GET", "users/{user_id}", {"user_id": 1}) for _ in range(5)))
+        assert results == [{"id": "1"}] * 5
+        assert rest.rest_stats()["coalesced"] >= 4
+    assert len(api.requests) == 1
+
+
+async def test_get_results_are_cached_until_their_ttl():
+    async with rest_stand_in() as api:
+        rest.init_rest("token", base_url=rest._base_url, cache_ttl=0.2)
+        for _ in range(3):
+            assert await rest.request("GET", "users/{user_id}", {"user_id": 1}) == {"id": "1"}
+        assert len(api.requests) == 1
+        await asyncio.sleep(0.25)
+        assert await rest.request("GET", "users/{user_id}", {"user_id": 1}) == {"id": "1"}
+        assert len(api.requests) == 2
+
+
+async def test_other_methods_bypass_coalescing_and_the_cache():
+    async with rest_stand_in(limit=10) as api:
+        rest.init_rest("token", base_url=rest._base_url, cache_ttl=10)
+        await asyncio.gather(*(rest.request("POST", MESSAGES_ROUTE, {"channel_id": 1}, {"content": "same"}) for _ in range(3)))
+        assert len(api.requests) == 3
+        await get_messages(1, 0)
+        await get_messages(1, 0) # cached
+        await rest.request("DELETE", MESSAGES_ROUTE, {"channel_id": 1}) # invalidates the cached GET of the URL
+        await get_messages(1, 0)
+    assert [method for _, method, _ in api.requests] == ["POST"] * 3 + ["GET", "DELETE", "GET"]
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import subprocess
+import sys
+import zlib
+from http import HTTPStatus
+
+import pytest
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+from tppatchcord import websockets as gateway
+from tppatchcord.codecs import JSON_CODEC, peek_json
+from tppatchcord.websockets import (DISPATCH_OPCODE, HEARTBEAT_ACK_OPCODE, HELLO_OPCODE, IDENTIFY_OPCODE,
+                                    MEMBERS_CHUNK_EVENT, PRESENCE_UPDATE_OPCODE, REQUEST_GUILD_MEMBERS_OPCODE,
+                                    RESUME_CLOSE_CODE, RESUME_OPCODE, ZLIB_SUFFIX, GatewayConnection)
+
+
+async def next_payload(connection: GatewayConnection) -> dict:
+    return await asyncio.wait_for(connection.next_event(), 5)
+
+
+async def test_zlib_stream_reassembles_split_frames_and_resets_on_reconnect(monkeypatch):
+    monkeypatch.setattr(gateway, "RECONNECT_BACKOFF_MIN", 0.01)
+    handshakes = []
+
+    async def handler(websocket):
+        # a new zlib stream per connection, as the gateway does
+        deflator = zlib.compressobj()
+
+        async def send(payload: dict) -> None:
+            data = deflator.compress(json.dumps(payload).encode()) + deflator.flush(zlib.Z_SYNC_FLUSH)
+            assert data.endswith(ZLIB_SUFFIX)
+            step = max(1, len(data) // 3)
+            for i in range(0, len(data), step): # only the last message of a frame ends with the suffix
+                await websocket.send(data[i:i + step])
+
+        await send({"op": HELLO_OPCODE, "d": {"heartbeat_interval": 60000}})
+        handshakes.append(json.loads(await websocket.recv())["op"])
+        if len(handshakes) == 1:
+            await send({"op": DISPATCH_OPCODE, "s": 1, "t": "READY", "d": {"session_id": "session", "resume_gateway_url": url}})
+            await send({"op": DISPATCH_OPCODE, "s": 2, "t": "MESSAGE_CREATE", "d": {"content": "first " * 500}})
+            await websocket.close(RESUME_CLOSE_CODE)
+        else:
+            await send({"op": DISPATCH_OPCODE, "s": 3, "t": "MESSAGE_CREATE", "d": {"content": "second " * 500}})
+            await websocket.wait_closed()
+
+    async with serve(handler, "127.0.0.1", 0) as server:
+        url = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+        connection = GatewayConnection("token", codec=JSON_CODEC, compress=True, gateway_base_url=url)
+        client = asyncio.create_task(connection.run())
+        try:
+            assert (await next_payload(connection))["t"] == "READY"
+            assert (await next_payload(connection))["d"]["content"] == "first " * 500
+            # the resumed connection starts a new zlib stream, only decodable by a fresh inflator
+            assert (await next_payload(connection))["d"]["content"] == "second " * 500
+        finally:
+            client.cancel()
+    assert handshakes == [IDENTIFY_OPCODE, RESUME_OPCODE]
+
+
+class ClosedWebSocket:
+    async def send(self, message: str) -> None:
+        raise ConnectionClosed(None, None)
+
+
+class RecordingWebSocket:
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send(self, message: str) -> None:
+        self.sent.append(message)
+
+
+async def test_write_handler_keeps_messages_not_sent_for_the_next_connection():
+    connection = GatewayConnection("token", codec=JSON_CODEC)
+    presence = {"op": PRESENCE_UPDATE_OPCODE, "d": {"since": None, "activities": [], "status": "idle", "afk": False}}
+    message = {"op": 42, "d": {"regular": True}}
+    presence_receipt = await connection.send_event_message(presence)
+    message_receipt = await connection.send_event_message(message)
+
+    await asyncio.wait_for(connection.write_handler(ClosedWebSocket()), 1) # returns once the connection is closed
+    assert not message_receipt.done() and not presence_receipt.done()
+
+    websocket = RecordingWebSocket()
+    writer = asyncio.create_task(connection.write_handler(websocket))
+    try:
+        await asyncio.wait_for(asyncio.gather(message_receipt, presence_receipt), 1)
+    finally:
+        writer.cancel()
+    assert [json.loads(sent) for sent in websocket.sent] == [message, presence]
+
+
+async def test_write_handler_fails_receipts_of_unencodable_messages():
+    connection = GatewayConnection("token", codec=JSON_CODEC)
+    receipt = await connection.send_event_message({"op": 42, "d": object()})
+    receipt_after = await connection.send_event_message({"op": 42, "d": None})
+
+    websocket = RecordingWebSocket()
+    writer = asyncio.create_task(connection.write_handler(websocket))
+    try:
+        with pytest.raises(TypeError):
+            await asyncio.wait_for(receipt, 1)
+        await asyncio.wait_for(receipt_after, 1)
+    finally:
+        writer.cancel()
+    assert len(websocket.sent) == 1
+
+
+async def test_run_retries_refused_and_timed_out_handshakes(monkeypatch):
+    monkeypatch.setattr(gateway, "RECONNECT_BACKOFF_MIN", 0.01)
+    monkeypatch.setattr(gateway, "GATEWAY_OPEN_TIMEOUT", 0.2)
+    attempts = []
+
+    async def process_request(websocket, request):
+        attempts.append(request.path)
+        if len(attempts) == 1:
+            await asyncio.sleep(1) # the client gives up first
+        elif len(attempts) == 2:
+            return websocket.respond(HTTPStatus.SERVICE_UNAVAILABLE, "upstream unavailable\n")
+        return None
+
+    async def handler(websocket):
+        await websocket.send(json.dumps({"op": HELLO_OPCODE, "d": {"heartbeat_interval": 60000}}))
+        assert json.loads(await websocket.recv())["op"] == IDENTIFY_OPCODE
+        await websocket.send(json.dumps({"op": DISPATCH_OPCODE, "s": 1, "t": "READY",
+                                         "d": {"session_id": "session", "resume_gateway_url": url}}))
+        await websocket.wait_closed()
+
+    async with serve(handler, "127.0.0.1", 0, process_request=process_request) as server:
+        url = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+        connection = GatewayConnection("token", codec=JSON_CODEC, gateway_base_url=url)
+        client = asyncio.create_task(connection.run())
+        try:
+            assert (await next_payload(connection))["t"] == "READY"
+        finally:
+            client.cancel()
+    assert len(attempts) == 3
+
+
+async def test_member_chunks_are_reassembled_by_nonce_with_backpressure():
+    async def handler(websocket):
+        await websocket.send(json.dumps({"op": HELLO_OPCODE, "d": {"heartbeat_interval": 60000}}))
+        assert json.loads(await websocket.recv())["op"] == IDENTIFY_OPCODE
+        await websocket.send(json.dumps({"op": DISPATCH_OPCODE, "s": 1, "t": "READY",
+                                         "d": {"session_id": "session", "resume_gateway_url": url}}))
+        request = json.loads(await websocket.recv())
+        assert request["op"] == REQUEST_GUILD_MEMBERS_OPCODE
+        chunks = [{"guild_id": "1", "nonce": "another request", "chunk_index": 0, "chunk_count": 1, "members": []}]
+        chunks += [{"guild_id": "1", "nonce": request["d"]["nonce"], "chunk_index": index, "chunk_count": 3,
+                    "members": [{"user": {"id": str(index * 2 + i)}} for i in range(2)]} for index in range(3)]
+        for sequence, chunk in enumerate(chunks, 2):
+            await websocket.send(json.dumps({"op": DISPATCH_OPCODE, "s": sequence, "t": MEMBERS_CHUNK_EVENT, "d": chunk}))
+        await websocket.send(json.dumps({"op": DISPATCH_OPCODE, "s": 6, "t": "MESSAGE_CREATE", "d": {"content": "after"}}))
+        await websocket.wait_closed()
+
+    async with serve(handler, "127.0.0.1", 0) as server:
+        url = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+        connection = GatewayConnection("token", codec=JSON_CODEC, gateway_base_url=url)
+        client = asyncio.create_task(connection.run())
+        try:
+            assert (await next_payload(connection))["t"] == "READY"
+            user_ids = []
+            async for member in connection.request_guild_members(1):
+                user_ids.append(member.user.id)
+                if len(user_ids) == 1:
+                    await asyncio.sleep(0.2) # a slow consumer holds back the rest of the stream
+                    assert (await next_payload(connection))["d"]["nonce"] == "another request"
+                    assert connection.event_queue.empty()
+            assert user_ids == list(range(6))
+            assert (await next_payload(connection))["d"]["content"] == "after"
+            assert not connection.member_requests
+        finally:
+            client.cancel()
+
+
+def test_gateway_does_not_import_the_decode_layer():
+    # api_types and cache are only imported by users decoding events
+    modules = subprocess.run([sys.executable, "-c", "import sys, tppatchcord.websockets; print(*sys.modules)"],
+                             capture_output=True, text=True, check=True).stdout.split()
+    assert "tppatchcord.api_types" not in modules
+    assert "tppatchcord.cache" not in modules
+
+
+def test_peek_json_trusts_only_top_level_keys_before_the_data():
+    # the gateway sends "t" and "s" before "d"
+    message = {"t": "MESSAGE_CREATE", "s": 5, "op": DISPATCH_OPCODE, "d": {"content": '"t":"FAKE","s":9'}}
+    assert peek_json(json.dumps(message).encode()) == ("MESSAGE_CREATE", 5)
+    assert peek_json(json.dumps(message, separators=(",", ":")).encode()) == ("MESSAGE_CREATE", 5)
+    # after "d", a match may belong to the nested payload
+    reordered = {"op": DISPATCH_OPCODE, "d": {"t": "FAKE", "s": 9}, "s": 5, "t": "MESSAGE_CREATE"}
+    assert peek_json(json.dumps(reordered).encode()) is None
+    assert peek_json(json.dumps({"op": DISPATCH_OPCODE, "d": {}, "s": 5, "t": "MESSAGE_CREATE"}).encode()) is None
+
+    hello = {"t": None, "s": None, "op": HELLO_OPCODE, "d": {"heartbeat_interval": 41250}}
+    assert peek_json(json.dumps(hello).encode()) == (None, None)
+    assert peek_json(json.dumps({"op": HEARTBEAT_ACK_OPCODE}).encode()) is None
+
+
+async def test_next_events_drains_queued_events_in_batches():
+    connection = GatewayConnection("token", codec=JSON_CODEC)
+    assert await connection.next_events(timeout=0.05) == []
+
+    # waits for the first event only
+    batch = asyncio.create_task(connection.next_events(10))
+    await asyncio.sleep(0.05)
+    assert not batch.done()
+    await connection.event_queue.put({"op": DISPATCH_OPCODE, "s": 1})
+    assert await asyncio.wait_for(batch, 1) == [{"op": DISPATCH_OPCODE, "s": 1}]
+
+    for sequence in range(2, 7):
+        await connection.event_queue.put({"op": DISPATCH_OPCODE, "s": sequence})
+    assert [event["s"] for event in await connection.next_events(3)] == [2, 3, 4]
+    assert [event["s"] for event in await connection.next_events(3, timeout=1)] == [5, 6]
+    assert connection.event_queue.empty()
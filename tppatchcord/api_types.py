@@ -1,7 +1,7 @@
 import sys
 
 from enum import Enum
-from typing import Any, get_args, get_origin
+from typing import Any, Callable, get_args, get_origin
 from types import UnionType
 import logging
 
@@ -135,45 +135,297 @@ class InteractionContextType(int, Enum):
     BOT_DM = 1
     PRIVATE_CHANNEL = 2
 
+def _resolve_annotation(annot_type: Any) -> Any:
+    """
+    Resolve string annotations (self-references) into actual classes of this module
+
+    :param annot_type: annotation
+    :returns: resolved annotation
+    """
+    if isinstance(annot_type, str):
+        return getattr(sys.modules[__name__], annot_type)
+    return annot_type
+
+def _is_serializable(annot_type: Any) -> bool:
+    return isinstance(annot_type, type) and issubclass(annot_type, Serializable)
+
+def _is_enum(annot_type: Any) -> bool:
+    return isinstance(annot_type, type) and issubclass(annot_type, Enum)
+
+def _to_int(value: Any) -> Any:
+    """
+    Coerce snowflakes (sent by the API as strings) to ints. Anything not parsable is kept as is
+    """
+    if value.__class__ is str:
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+def _enum_converter(enum_type: type[Enum]) -> Callable[[Any], Any]:
+    def converter(value):
+        try:
+            return enum_type(value)
+        except ValueError: # value not documented (yet)
+            return value
+    return converter
+
+def _scalar_converter(annot_type: Any) -> Callable[[Any], Any] | None:
+    if annot_type is int:
+        return _to_int
+    if _is_enum(annot_type):
+        return _enum_converter(annot_type)
+    return None
+
+def _object_converter(field_type: type["Serializable"], lazy: bool, keep_unknown: bool) -> Callable[[dict], "Serializable"]:
+    if not (lazy or keep_unknown):
+        return field_type.from_dict
+    return lambda field: _variant_class(field_type, lazy, keep_unknown).from_dict(field)
+
+def _list_converter(item_type: type["Serializable"], lazy: bool, keep_unknown: bool) -> Callable[[list], list]:
+    if not (lazy or keep_unknown):
+        from_dict = item_type.from_dict
+        return lambda field: [from_dict(item) for item in field]
+    return lambda field: [_variant_class(item_type, lazy, keep_unknown).from_dict(item) for item in field]
+
+def _dict_converter(key_type: Any, value_type: type["Serializable"], lazy: bool, keep_unknown: bool) -> Callable[[dict], dict]:
+    key_converter = _scalar_converter(key_type) or (lambda k: k)
+    if not (lazy or keep_unknown):
+        from_dict = value_type.from_dict
+        return lambda field: {key_converter(k): from_dict(v) for k, v in field.items()}
+    return lambda field: {key_converter(k): _variant_class(value_type, lazy, keep_unknown).from_dict(v) for k, v in field.items()}
+
+# checks telling whether a lazy field still holds the raw JSON value
+_is_raw_object = lambda field: isinstance(field, dict)
+_is_raw_list = lambda field: bool(field) and isinstance(field[0], dict)
+_is_raw_dict = lambda field: bool(field) and isinstance(next(iter(field.values())), dict)
+
+def _field_converter(annot_type: Any, lazy: bool = False, keep_unknown: bool = False) -> tuple[Callable[[Any], Any], Callable[[Any], bool] | None] | None:
+    """
+    Build a converter for a single annotated field
+
+    :param annot_type: field annotation
+    :param lazy: whether nested objects should be decoded into lazy classes
+    :param keep_unknown: whether nested objects should keep their unknown fields
+    :returns: (converter, is_raw check) pair or None if the raw JSON value is stored as is.
+              is_raw is None for cheap scalar coercions which are never deferred
+    """
+    annot_type = _resolve_annotation(annot_type)
+    annot_type_args = [_resolve_annotation(arg) for arg in get_args(annot_type)]
+
+    if isinstance(annot_type, UnionType):
+        return None
+    if get_origin(annot_type) is list and annot_type_args:
+        # handle field: list[Serializable]
+        if _is_serializable(annot_type_args[0]):
+            return _list_converter(annot_type_args[0], lazy, keep_unknown), _is_raw_list
+        # handle field: list[int], list[Enum]
+        item_converter = _scalar_converter(annot_type_args[0])
+        if item_converter:
+            return (lambda field: [item_converter(item) for item in field]), None
+        return None
+    # handle field: dict[x, Serializable]
+    if get_origin(annot_type) is dict and len(annot_type_args) > 1 and _is_serializable(annot_type_args[1]):
+        return _dict_converter(annot_type_args[0], annot_type_args[1], lazy, keep_unknown), _is_raw_dict
+    if _is_serializable(annot_type):
+        return _object_converter(annot_type, lazy, keep_unknown), _is_raw_object
+
+    scalar_converter = _scalar_converter(annot_type)
+    return (scalar_converter, None) if scalar_converter else None
+
+def _compile_decoder(cls: type["Serializable"], lazy: bool = False, keep_unknown: bool = False) -> dict[str, Callable[[Any], Any] | None]:
+    """
+    Build a decoder plan for a Serializable class: a mapping of every field name to
+    a prebuilt converter (or None if the raw JSON value is stored as is).
+    Annotations are resolved only once here instead of on every from_dict call.
+    Lazily decoded fields are left out of the plan's conversions (see _variant_class).
+
+    :param cls: Serializable subclass
+    :param lazy: whether nested objects are decoded on first access
+    :param keep_unknown: whether nested objects keep their unknown fields
+    :returns: field name -> converter mapping
+    """
+    plan = {}
+    for field_name, annot_type in cls.__annotations__.items():
+        converter = _field_converter(annot_type, lazy, keep_unknown)
+        if converter is None or (lazy and converter[1] is not None):
+            plan[field_name] = None
+        else:
+            plan[field_name] = converter[0]
+    return plan
+
+def _lazy_field(descriptor: Any, converter: Callable[[Any], Any], is_raw: Callable[[Any], bool]) -> property:
+    def getter(self):
+        value = descriptor.__get__(self)
+        if value is not None and is_raw(value):
+            value = converter(value)
+            descriptor.__set__(self, value)
+        return value
+
+    def setter(self, value):
+        descriptor.__set__(self, value)
+
+    return property(getter, setter)
+
+def _variant_fields(obj: "Serializable", other: Any) -> tuple[tuple[str, ...], type["Serializable"]] | None:
+    # fields compared between a variant object and another object of the same Serializable class (or variant)
+    base = _variant_bases[type(obj)]
+    if _variant_bases.get(type(other), type(other)) is not base:
+        return None
+    return (type(obj).__fields__ if type(other) is type(obj) else base.__fields__), base
+
+def _variant_eq(self, other: Any) -> bool:
+    compared = _variant_fields(self, other)
+    if compared is None:
+        return NotImplemented
+    # read through the lazy properties, nested objects are compared decoded
+    return all(getattr(self, field) == getattr(other, field) for field in compared[0])
+
+def _variant_repr(self) -> str:
+    fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in type(self).__fields__)
+    return f"{type(self).__name__}({fields})"
+
+def _variant_reduce(self) -> tuple:
+    # pickled as its base class and options, the variant is rebuilt (or looked up) on load
+    cls = type(self)
+    return _restore_variant, (_variant_bases[cls], cls in _lazy_classes, cls in _keep_unknown_classes,
+                              {field: getattr(self, field) for field in cls.__fields__})
+
+def _restore_variant(cls: type["Serializable"], lazy: bool, keep_unknown: bool, fields: dict) -> "Serializable":
+    obj = _variant_class(cls, lazy, keep_unknown)()
+    for field, value in fields.items():
+        setattr(obj, field, value)
+    return obj
+
+def _variant_class(cls: type["Serializable"], lazy: bool, keep_unknown: bool) -> type["Serializable"]:
+    """
+    Get (or build) a decoding variant of a Serializable class.
+    The lazy variant (e.g. LazyMessage) is a subclass keeping nested Serializable, list[Serializable] and
+    dict[x, Serializable] fields as raw dicts until first access, then decoding and memoizing them.
+    The keep_unknown variant (e.g. MessageWithUnknownFields) is a subclass with an extra 'unknown_fields'
+    dict slot collecting the fields of the payload the class does not document.
+    Variants compare equal to the objects of their base class with the same (decoded) fields,
+    and are pickled through their base class.
+
+    :param cls: Serializable subclass
+    :param lazy: lazy variant
+    :param keep_unknown: keep_unknown variant
+    :returns: variant subclass of cls (cls itself if neither option is set)
+    """
+    if not (lazy or keep_unknown):
+        return cls
+
+    variant_cls = _variant_classes.get((cls, lazy, keep_unknown))
+    if variant_cls is not None:
+        return variant_cls
+
+    name = ("Lazy" if lazy else "") + cls.__name__ + ("WithUnknownFields" if keep_unknown else "")
+    namespace = {"__module__": cls.__module__, "__qualname__": name,
+                 "__eq__": _variant_eq, "__hash__": None, "__reduce__": _variant_reduce}
+    if lazy:
+        namespace["__repr__"] = _variant_repr # shows the nested fields decoded
+    if keep_unknown:
+        namespace["__annotations__"] = {UNKNOWN_FIELDS_SLOT: dict}
+    variant_cls = type(name, (cls,), namespace)
+    _variant_classes[(cls, lazy, keep_unknown)] = _variant_classes[(variant_cls, lazy, keep_unknown)] = variant_cls
+    _variant_bases[variant_cls] = cls
+
+    if lazy:
+        for field_name, annot_type in cls.__annotations__.items():
+            converter = _field_converter(annot_type, lazy, keep_unknown)
+            if converter and converter[1] is not None:
+                setattr(variant_cls, field_name, _lazy_field(getattr(variant_cls, field_name), *converter))
+
+    _decoders[variant_cls] = _compile_decoder(cls, lazy, keep_unknown)
+    if lazy:
+        _lazy_classes.add(variant_cls)
+    if keep_unknown:
+        _keep_unknown_classes.add(variant_cls)
+    return variant_cls
+
+def _record_unknown_field(cls: type["Serializable"], key: str, kept: bool) -> None:
+    class_name = _variant_bases.get(cls, cls).__name__
+    counter_key = (class_name, key)
+    if counter_key not in _logged_unknown_fields:
+        # logged once per (class, field) even across resets, see unknown_field_counts() for the totals
+        _logged_unknown_fields.add(counter_key)
+        if kept:
+            logger.warning("Undocumented field %s kept in %s of %s", key, UNKNOWN_FIELDS_SLOT, class_name)
+        else:
+            logger.warning("Undocumented field %s ignored when serializing %s", key, class_name)
+    _unknown_fields[counter_key] = _unknown_fields.get(counter_key, 0) + 1
+
+def unknown_field_counts(reset: bool = False) -> dict[tuple[str, str], int]:
+    """
+    Get the number of times each undocumented field was met while decoding
+
+    :param reset: clear the counts afterwards (fields already met are not logged again)
+    :returns: (class name, field name) -> count mapping
+    """
+    counts = dict(_unknown_fields)
+    if reset:
+        _unknown_fields.clear()
+    return counts
+
+def dump_unknown_fields(reset: bool = True) -> None:
+    """
+    Log a single summary of the undocumented fields met while decoding, e.g. periodically from a handler
+
+    :param reset: clear the registry afterwards
+    """
+    counts = unknown_field_counts(reset)
+    if counts:
+        logger.warning("Undocumented fields met while decoding: %s", ", ".join(
+            f"{class_name}.{field_name} x{count}" for (class_name, field_name), count in sorted(counts.items())
+        ))
+
+UNKNOWN_FIELDS_SLOT = "unknown_fields"
+
+_decoders: dict[type, dict[str, Callable[[Any], Any] | None]] = {}
+_variant_classes: dict[tuple[type, bool, bool], type] = {}
+_variant_bases: dict[type, type] = {} # variant -> base Serializable class
+_lazy_classes: set[type] = set()
+_keep_unknown_classes: set[type] = set()
+_unknown_fields: dict[tuple[str, str], int] = {}
+_logged_unknown_fields: set[tuple[str, str]] = set() # (class name, field name) already logged
+
 class Serializable(dataobject):
     @classmethod
-    def from_dict(cls, payload: dict) -> "Serializable":
+    def from_dict(cls, payload: dict, lazy: bool = False, keep_unknown: bool = False) -> "Serializable":
+        """
+        Decode a raw JSON dict into the dataobject.
+        Snowflakes of int fields are coerced to ints and enum fields are wrapped into their Enum types.
+        Undocumented fields are counted in a registry (see unknown_field_counts) and dropped,
+        unless keep_unknown is set.
+
+        :param payload: payload
+        :param lazy: keep nested Serializable fields raw until first access
+        :param keep_unknown: keep undocumented fields in the 'unknown_fields' dict slot of decoded objects
+        :returns: decoded dataobject, an instance of a variant subclass with lazy or keep_unknown
+                  (e.g. LazyMessage, see _variant_class): check its type with isinstance
+        """
+        if lazy or keep_unknown:
+            cls = _variant_class(cls, lazy, keep_unknown)
+
+        plan = _decoders.get(cls)
+        if plan is None:
+            plan = _decoders[cls] = _compile_decoder(cls)
+
         obj = cls()
         for key, value in payload.items():
-            if key in obj.__fields__:
+            if key in plan:
+                converter = plan[key]
+                if converter is not None and value is not None:
+                    value = converter(value)
                 setattr(obj, key, value) # REMOVES EXCESSIVE DATA GIVEN BY THE API. EITHER DOCUMENT IT, OR DON'T GIVE IT TO THE USER, DISCORD!!!! #rant
             else:
-                logger.warning("Field %s ignored when serializing %s", key, obj)
-        
-        for field_name, typeclass in cls.__annotations__.items():
-            annot_type = typeclass
-
-            # handle self-references through string annotations
-            if isinstance(annot_type, str):
-                annot_type = getattr(sys.modules[__name__], annot_type)
-
-            # handle generic["String"] self-references with annotations
-            annot_type_args = list(get_args(annot_type))
-            for i in range(len((annot_type_args))):
-                if isinstance(annot_type_args[i], str):
-                    annot_type_args[i] = getattr(sys.modules[__name__], annot_type_args[i])
-
-            field = getattr(obj, field_name)
-            if field:
-                if isinstance(annot_type, UnionType):
-                    continue
-                # handle field: list[Serializable]
-                elif get_origin(annot_type) is list and annot_type_args and issubclass(annot_type_args[0], Serializable):
-                    for i in range(len(field)):
-                        field[i] = get_args(annot_type)[0].from_dict(field[i])
-
-                # handle field: dict[x, Serializable]
-                elif get_origin(annot_type) is dict and annot_type_args and issubclass(annot_type_args[1], Serializable):
-                    for k in field:
-                        field[k] = get_args(annot_type)[1].from_dict(field[k])
-
-                elif issubclass(annot_type, Serializable):
-                    setattr(obj, field_name, annot_type.from_dict(field))
+                kept = cls in _keep_unknown_classes
+                _record_unknown_field(cls, key, kept)
+                if kept:
+                    if obj.unknown_fields is None:
+                        obj.unknown_fields = {}
+                    obj.unknown_fields[key] = value
 
         return obj
 
@@ -497,7 +749,7 @@ class GuildScheduledEvent(Serializable):
 
 class UnavailableGuild(Serializable):
     id: int
-    unavailable: bool = True
+    unavailable: bool # None when absent: GUILD_DELETE of a guild the user was removed from
 
 class Guild(Serializable):
     id: int
@@ -753,7 +1005,7 @@ class MessageCall(Serializable):
 class Component(Serializable):
     # TEMPORARY, NOT IMPLEMENTED, SEE TODOS
     @classmethod
-    def from_dict(cls, payload: dict) -> Serializable:
+    def from_dict(cls, payload: dict, lazy: bool = False, keep_unknown: bool = False) -> Serializable:
         return payload
 
 class Message(Serializable):
@@ -897,7 +1149,7 @@ class Ready(Serializable):
     application: Application
 
     @classmethod
-    def from_dict(cls, payload: dict) -> Serializable: # TODO(idmp152): Fix READY event serialization (check additional undocumented fields)
+    def from_dict(cls, payload: dict, lazy: bool = False, keep_unknown: bool = False) -> Serializable: # TODO(idmp152): Fix READY event serialization (check additional undocumented fields)
         return payload
 
 class ApplicationCommandPermissions(Serializable):
@@ -959,7 +1211,7 @@ class MessageDelete(Serializable):
     guild_id: int
 
 class MessageDeleteBulk(Serializable):
-    id: int
+    ids: list[int]
     channel_id: int
     guild_id: int
 
@@ -1147,7 +1399,7 @@ class GuildRoleUpdate(Serializable):
 
 class GuildRoleDelete(Serializable):
     guild_id: int
-    role: Role
+    role_id: int
 
 class GuildScheduledEventUserAdd(Serializable):
     guild_scheduled_event_id: int
@@ -1164,6 +1416,19 @@ class Event(dataobject):
     sequence: int
     name: str
     data: Serializable | bool | None
+    shard_id: int
+
+
+class DecodedPayload(dict):
+    """
+    Raw event payload carrying its already decoded Event (e.g. decoded for an entity cache),
+    which process_event_payload returns instead of decoding the payload again.
+    Copies and pickles (spilled, forwarded to another process) are plain dicts.
+    """
+    __slots__ = ("event",)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
 
 
 EVENT_DATAOBJECTS = {
@@ -1238,20 +1503,35 @@ EVENT_DATAOBJECTS = {
     "MESSAGE_POLL_VOTE_REMOVE": MessagePollVoteRemove
 }
 
-def process_event_payload(payload: dict) -> Event:
+def process_event_payload(payload: dict, lazy: bool = False, keep_unknown: bool = False) -> Event:
     """
     Preprocess raw JSON data into a dataclass-like object. (api_types.py)
     Uses recordclass.dataobject type for higher performance, inheritance and low memory footprint
 
-    :param payload: payload
+    :param payload: payload, the event of a DecodedPayload (decoded eagerly, unknown fields dropped) is returned as is
+    :param lazy: decode nested objects only on first attribute access (see Serializable.from_dict)
+    :param keep_unknown: keep undocumented fields in the 'unknown_fields' dict slot of decoded objects
     :returns: Dataclass-like Discord API stuct
     """
+    if type(payload) is DecodedPayload:
+        return payload.event
 
-    event = Event(opcode=payload["op"], sequence=payload["s"], name=payload["t"])
+    event = Event(opcode=payload["op"], sequence=payload["s"], name=payload["t"], shard_id=payload.get("shard_id"))
     event_dataobject = EVENT_DATAOBJECTS.get(event.name)
-    event.data = event_dataobject.from_dict(payload["d"]) if event_dataobject else payload["d"]
+    event.data = event_dataobject.from_dict(payload["d"], lazy, keep_unknown) if event_dataobject else payload["d"]
     return event
 
+def process_event_payloads(payloads: list[dict], lazy: bool = False, keep_unknown: bool = False) -> list[Event]:
+    """
+    Batched process_event_payload, e.g. for the result of next_events()
+
+    :param payloads: payloads
+    :param lazy: decode nested objects only on first attribute access (see Serializable.from_dict)
+    :param keep_unknown: keep undocumented fields in the 'unknown_fields' dict slot of decoded objects
+    :returns: list of Dataclass-like Discord API structs
+    """
+    return [process_event_payload(payload, lazy, keep_unknown) for payload in payloads]
+
 #TODO(idmp152): Document classes in format:
 """This is a test class for dataclasses.
 
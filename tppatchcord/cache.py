@@ -0,0 +1,511 @@
+import collections
+import copy
+import operator
+import sys
+import time
+from typing import Any, Callable
+
+from recordclass import dataobject
+
+from tppatchcord.api_types import (Channel, DecodedPayload, Event, Guild, GuildCreate, GuildMember, GuildMemberAdd,
+                                   GuildMemberRemove, GuildMembersChunk, GuildMemberUpdate, GuildRoleCreate,
+                                   GuildRoleDelete, Message, MessageUpdate, Role, ThreadListSync, ThreadMembersUpdate,
+                                   ThreadMemberUpdate, UnavailableGuild, process_event_payload)
+
+# dispatch events the cache is fed with (see GatewayConnection.configure(entity_cache=...))
+CACHE_EVENTS = frozenset({
+    "GUILD_CREATE", "GUILD_UPDATE", "GUILD_DELETE",
+    "CHANNEL_CREATE", "CHANNEL_UPDATE", "CHANNEL_DELETE",
+    "THREAD_CREATE", "THREAD_UPDATE", "THREAD_DELETE", "THREAD_LIST_SYNC", "THREAD_MEMBER_UPDATE", "THREAD_MEMBERS_UPDATE",
+    "GUILD_ROLE_CREATE", "GUILD_ROLE_UPDATE", "GUILD_ROLE_DELETE",
+    "GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE", "GUILD_MEMBER_REMOVE", "GUILD_MEMBERS_CHUNK"
+})
+
+# dispatch events handled by MessageCache.process_event
+MESSAGE_CACHE_EVENTS = frozenset({"MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE", "MESSAGE_DELETE_BULK"})
+MESSAGE_CACHE_SIZE = 10000 # default maximum number of cached messages
+MESSAGE_CACHE_BYTES = 32 << 20 # default maximum estimated size of the cached messages, in bytes
+MESSAGE_SIZE_SAMPLING = 32 # one message in this many is walked by sizeof with a SampledSizer
+
+# GUILD_CREATE fields indexed separately, cleared on the stored guild record
+_INDEXED_GUILD_FIELDS = ("roles", "members", "channels", "threads", "presences")
+# GUILD_MEMBER_UPDATE fields which may be left out but are never null: None means not sent, the cached value is kept
+_MEMBER_UPDATE_OPTIONAL_FIELDS = frozenset({"deaf", "mute", "pending", "flags"})
+
+
+class EntityCache:
+    """
+    Guild, channel (and thread), role and member records kept up to date from gateway events,
+    with O(1) lookups by snowflake. Records are the decoded api_types dataobjects, shared with
+    the cache and with the events passed on by attached connections: treat them as read-only.
+    Attach it to connections with the entity_cache setting, or feed it decoded events with process_event().
+    """
+    events = CACHE_EVENTS # dispatch events to feed the cache with
+
+    def __init__(self, cache_members: bool = True) -> None:
+        """
+        :param cache_members: keep guild members (GUILD_CREATE, GUILD_MEMBER_* and GUILD_MEMBERS_CHUNK)
+        """
+        self.cache_members = cache_members
+        self.guilds: dict[int, GuildCreate] = {}
+        self.channels: dict[int, Channel] = {} # channels and threads
+        self.roles: dict[int, Role] = {}
+        self.members: dict[int, dict[int, GuildMember]] = {} # guild_id -> user_id -> member
+        self._guild_channels: dict[int, set[int]] = {}
+        self._guild_roles: dict[int, set[int]] = {}
+        self._handlers: dict[str, Callable[[Any], None]] = {
+            "GUILD_CREATE": self._guild_create,
+            "GUILD_UPDATE": self._guild_update,
+            "GUILD_DELETE": self._guild_delete,
+            "CHANNEL_CREATE": self._channel_update,
+            "CHANNEL_UPDATE": self._channel_update,
+            "CHANNEL_DELETE": self._channel_delete,
+            "THREAD_CREATE": self._channel_update,
+            "THREAD_UPDATE": self._channel_update,
+            "THREAD_DELETE": self._channel_delete,
+            "THREAD_LIST_SYNC": self._thread_list_sync,
+            "THREAD_MEMBER_UPDATE": self._thread_member_update,
+            "THREAD_MEMBERS_UPDATE": self._thread_members_update,
+            "GUILD_ROLE_CREATE": self._role_update,
+            "GUILD_ROLE_UPDATE": self._role_update,
+            "GUILD_ROLE_DELETE": self._role_delete,
+            "GUILD_MEMBER_ADD": self._member_add,
+            "GUILD_MEMBER_UPDATE": self._member_update,
+            "GUILD_MEMBER_REMOVE": self._member_remove,
+            "GUILD_MEMBERS_CHUNK": self._members_chunk
+        }
+
+    def process_event(self, event: Event) -> None:
+        """
+        Update the cache from a decoded event (see process_event_payload), other events are ignored
+
+        :param event: event
+        """
+        handler = self._handlers.get(event.name)
+        if handler is not None and event.data is not None:
+            handler(event.data)
+
+    def process_payload(self, payload: dict) -> DecodedPayload:
+        """
+        Decode a raw event payload (one of CACHE_EVENTS) and update the cache from it
+
+        :param payload: raw payload
+        :returns: the payload carrying its decoded event, which process_event_payload returns without decoding again
+        """
+        decoded = DecodedPayload(payload)
+        decoded.event = process_event_payload(payload)
+        self.process_event(decoded.event)
+        return decoded
+
+    def guild(self, guild_id: int) -> GuildCreate | None:
+        """
+        :returns: guild record (roles, members, channels, threads and presences are indexed separately), None if unknown
+        """
+        return self.guilds.get(guild_id)
+
+    def channel(self, channel_id: int) -> Channel | None:
+        """
+        :returns: channel or thread record, None if unknown
+        """
+        return self.channels.get(channel_id)
+
+    def role(self, role_id: int) -> Role | None:
+        """
+        :returns: role record, None if unknown
+        """
+        return self.roles.get(role_id)
+
+    def member(self, guild_id: int, user_id: int) -> GuildMember | None:
+        """
+        :returns: member record, None if unknown (not cached, or not received: see request_guild_members)
+        """
+        members = self.members.get(guild_id)
+        return members.get(user_id) if members is not None else None
+
+    def guild_channels(self, guild_id: int) -> list[Channel]:
+        """
+        :returns: channels and threads of a guild
+        """
+        return [self.channels[channel_id] for channel_id in self._guild_channels.get(guild_id, ())]
+
+    def guild_roles(self, guild_id: int) -> list[Role]:
+        """
+        :returns: roles of a guild
+        """
+        return [self.roles[role_id] for role_id in self._guild_roles.get(guild_id, ())]
+
+    def _guild_create(self, guild: GuildCreate) -> None:
+        self._evict_guild(guild.id)
+        for role in guild.roles or ():
+            self._add_role(guild.id, role)
+        for channel in (guild.channels or []) + (guild.threads or []):
+            if channel.guild_id is None: # not sent within GUILD_CREATE
+                channel.guild_id = guild.id
+            self._add_channel(channel)
+        if self.cache_members:
+            self.members[guild.id] = {member.user.id: member for member in guild.members or () if member.user is not None}
+
+        # the event keeps its fields, they are only cleared on the stored record
+        guild = copy.copy(guild)
+        for field in _INDEXED_GUILD_FIELDS:
+            setattr(guild, field, None)
+        self.guilds[guild.id] = guild
+
+    def _guild_update(self, update: Guild) -> None:
+        guild = self.guilds.get(update.id)
+        if guild is None:
+            return
+        # the full guild is sent, None clears a field (icon, banner, afk_channel_id, ...)
+        for field in Guild.__fields__:
+            if field not in _INDEXED_GUILD_FIELDS:
+                setattr(guild, field, getattr(update, field))
+        if update.roles is not None:
+            for role_id in self._guild_roles.pop(update.id, ()):
+                self.roles.pop(role_id, None)
+            for role in update.roles:
+                self._add_role(update.id, role)
+
+    def _guild_delete(self, guild: UnavailableGuild) -> None:
+        if guild.unavailable: # outage, the guild is sent again with GUILD_CREATE once available
+            cached = self.guilds.get(guild.id)
+            if cached is not None:
+                cached.unavailable = True
+            return
+        self._evict_guild(guild.id) # the user left or was removed from the guild
+
+    def _evict_guild(self, guild_id: int) -> None:
+        self.guilds.pop(guild_id, None)
+        for channel_id in self._guild_channels.pop(guild_id, ()):
+            self.channels.pop(channel_id, None)
+        for role_id in self._guild_roles.pop(guild_id, ()):
+            self.roles.pop(role_id, None)
+        self.members.pop(guild_id, None)
+
+    def _add_channel(self, channel: Channel) -> None:
+        self.channels[channel.id] = channel
+        if channel.guild_id is not None:
+            self._guild_channels.setdefault(channel.guild_id, set()).add(channel.id)
+
+    def _channel_update(self, channel: Channel) -> None:
+        previous = self.channels.get(channel.id)
+        if previous is not None and channel.member is None:
+            channel.member = previous.member # thread member of the bot, not sent with updates
+        self._add_channel(channel)
+
+    def _channel_delete(self, channel: Channel) -> None:
+        self.channels.pop(channel.id, None)
+        if channel.guild_id in self._guild_channels:
+            self._guild_channels[channel.guild_id].discard(channel.id)
+
+    def _thread_list_sync(self, sync: ThreadListSync) -> None:
+        # the sync replaces the active threads of the given parent channels (all channels if None)
+        parents = set(sync.channel_ids) if sync.channel_ids is not None else None
+        for channel_id in list(self._guild_channels.get(sync.guild_id, ())):
+            thread = self.channels[channel_id]
+            if thread.thread_metadata is not None and (parents is None or thread.parent_id in parents):
+                self._channel_delete(thread)
+        members = {member.id: member for member in sync.members or ()}
+        for thread in sync.threads or ():
+            thread.guild_id = sync.guild_id
+            thread.member = members.get(thread.id)
+            self._add_channel(thread)
+
+    def _thread_member_update(self, member: ThreadMemberUpdate) -> None:
+        thread = self.channels.get(member.id)
+        if thread is not None:
+            thread.member = member
+
+    def _thread_members_update(self, update: ThreadMembersUpdate) -> None:
+        thread = self.channels.get(update.id)
+        if thread is not None:
+            thread.member_count = update.member_count
+
+    def _add_role(self, guild_id: int, role: Role) -> None:
+        self.roles[role.id] = role
+        self._guild_roles.setdefault(guild_id, set()).add(role.id)
+
+    def _role_update(self, update: GuildRoleCreate) -> None:
+        self._add_role(update.guild_id, update.role)
+
+    def _role_delete(self, delete: GuildRoleDelete) -> None:
+        self.roles.pop(delete.role_id, None)
+        if delete.guild_id in self._guild_roles:
+            self._guild_roles[delete.guild_id].discard(delete.role_id)
+
+    def _member_add(self, member: GuildMemberAdd) -> None:
+        guild = self.guilds.get(member.guild_id)
+        if guild is not None and guild.member_count is not None:
+            guild.member_count += 1
+        if self.cache_members and member.user is not None:
+            self.members.setdefault(member.guild_id, {})[member.user.id] = member
+
+    def _member_update(self, update: GuildMemberUpdate) -> None:
+        if not self.cache_members or update.user is None:
+            return
+        member = self.member(update.guild_id, update.user.id)
+        if member is None:
+            return # only update known members, see request_guild_members to load them
+        for field in type(update).__fields__:
+            value = getattr(update, field)
+            if field != "guild_id" and (value is not None or field not in _MEMBER_UPDATE_OPTIONAL_FIELDS):
+                setattr(member, field, value)
+
+    def _member_remove(self, remove: GuildMemberRemove) -> None:
+        guild = self.guilds.get(remove.guild_id)
+        if guild is not None and guild.member_count is not None:
+            guild.member_count -= 1
+        members = self.members.get(remove.guild_id)
+        if members is not None and remove.user is not None:
+            members.pop(remove.user.id, None)
+
+    def _members_chunk(self, chunk: GuildMembersChunk) -> None:
+        if self.cache_members and chunk.guild_id in self.guilds:
+            members = self.members.setdefault(chunk.guild_id, {})
+            for member in chunk.members or ():
+                if member.user is not None:
+                    members[member.user.id] = member
+
+
+class _CachedMessage(dataobject):
+    message: Message
+    size: int
+    cached_at: float
+
+
+# per class field getters of sizeof(), reading the raw slots of lazy variants so sizing does not decode them
+_field_getters: dict[type, Callable[[Any], tuple]] = {}
+
+def _field_getter(cls: type) -> Callable[[Any], tuple]:
+    fields = cls.__fields__
+    if not any(isinstance(getattr(cls, field, None), property) for field in fields):
+        return operator.attrgetter(*fields) if len(fields) > 1 else lambda obj: tuple(getattr(obj, field) for field in fields)
+    # lazy variant: its properties decode on access, read the slots they wrap instead
+    descriptors = [next(klass.__dict__[field] for klass in cls.__mro__
+                        if field in klass.__dict__ and not isinstance(klass.__dict__[field], property))
+                   for field in fields]
+    return lambda obj: tuple(descriptor.__get__(obj) for descriptor in descriptors)
+
+def sizeof(obj: Any) -> int:
+    """
+    Estimate the memory held by a decoded object: sys.getsizeof of the object and of everything
+    it references through dataobject fields, lists and dicts (None, bools and enums are shared and not counted).
+    Costs roughly as much as decoding the object.
+
+    :param obj: decoded object, e.g. a Message
+    :returns: estimated size in bytes
+    """
+    cls = type(obj)
+    if cls is list:
+        size = sys.getsizeof(obj)
+        values = obj
+    elif cls is dict:
+        size = sys.getsizeof(obj)
+        for key in obj:
+            size += sys.getsizeof(key)
+        values = obj.values()
+    elif isinstance(obj, dataobject):
+        size = sys.getsizeof(obj)
+        getter = _field_getters.get(cls)
+        if getter is None:
+            getter = _field_getters[cls] = _field_getter(cls)
+        values = getter(obj)
+    elif cls is str or cls is int or cls is float:
+        return sys.getsizeof(obj)
+    else:
+        return 0
+
+    for value in values:
+        value_type = type(value)
+        if value_type is str or value_type is int or value_type is float:
+            size += sys.getsizeof(value)
+        elif value is not None and value_type is not bool:
+            size += sizeof(value)
+    return size
+
+
+class SampledSizer:
+    """
+    Message size estimate walking only one message in every sampled with sizeof,
+    the others are charged the mean size of the sampled ones.
+    Opt-in (MessageCache(sizer=SampledSizer())) and NOT a memory bound: message sizes vary widely,
+    large messages falling between samples are undercounted and max_bytes is overshot.
+    """
+
+    def __init__(self, every: int = MESSAGE_SIZE_SAMPLING) -> None:
+        """
+        :param every: sampling period, 1 to walk every message
+        """
+        self.every = every
+        self.count = 0 # messages sized
+        self.sampled = 0 # messages walked
+        self.sampled_bytes = 0
+
+    def __call__(self, message: Any) -> int:
+        self.count += 1
+        if self.sampled and self.count % self.every:
+            return self.sampled_bytes // self.sampled
+        size = sizeof(message)
+        self.sampled += 1
+        self.sampled_bytes += size
+        return size
+
+
+class MessageCache:
+    """
+    Recently created messages by ID, to correlate MESSAGE_UPDATE, MESSAGE_DELETE and MESSAGE_DELETE_BULK
+    (which carry partial data or IDs only) with the original message.
+    Bounded by memory: messages are evicted least recently used first once the cache holds more than
+    max_messages messages or max_bytes estimated bytes (see sizeof, or pass the raw frame length
+    to process_event), or a channel more than max_per_channel messages, and expire max_age seconds after being cached.
+    Feed it decoded events with process_event() before handling them, messages are shared with the cache:
+    treat them as read-only.
+
+    previous = message_cache.process_event(event)
+    """
+
+    def __init__(self, max_messages: int | None = MESSAGE_CACHE_SIZE, max_bytes: int | None = MESSAGE_CACHE_BYTES,
+                 max_age: float | None = None, max_per_channel: int | None = None,
+                 sizer: Callable[[Message], int] = sizeof) -> None:
+        """
+        :param max_messages: maximum number of messages, None for no limit
+        :param max_bytes: maximum estimated size of the messages in bytes, None for no limit
+        :param max_age: seconds a message is kept after being cached (or updated), None for no limit
+        :param max_per_channel: maximum number of messages per channel, None for no limit
+        :param sizer: estimate of the memory held by a message, called for every message cached without a size
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_per_channel = max_per_channel
+        self.sizer = sizer
+        self.size = 0 # estimated bytes held
+        self.evictions = collections.Counter() # messages, bytes, age, channel
+        self._messages: collections.OrderedDict[int, _CachedMessage] = collections.OrderedDict() # least recently used first
+        self._channels: dict[int, collections.OrderedDict[int, None]] = {} # channel_id -> message IDs, least recently used first
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._messages
+
+    def process_event(self, event: Event, size: int | None = None) -> Message | list[Message] | None:
+        """
+        Update the cache from a decoded event (see process_event_payload), other events are ignored
+
+        :param event: event
+        :param size: estimated size in bytes of a MESSAGE_CREATE message, e.g. the length of its raw frame,
+                     estimated with sizer if None
+        :returns: the cached message before MESSAGE_UPDATE or MESSAGE_DELETE, the cached messages before
+                  MESSAGE_DELETE_BULK (list), None if not cached or for other events
+        """
+        data = event.data
+        if data is None:
+            return None
+        if event.name == "MESSAGE_CREATE":
+            self.add(data, size)
+        elif event.name == "MESSAGE_UPDATE":
+            return self.update(data)
+        elif event.name == "MESSAGE_DELETE":
+            return self.remove(data.id)
+        elif event.name == "MESSAGE_DELETE_BULK":
+            return [message for message in map(self.remove, data.ids or ()) if message is not None]
+        return None
+
+    def get(self, message_id: int) -> Message | None:
+        """
+        :returns: cached message, None if unknown or expired
+        """
+        entry = self._messages.get(message_id)
+        if entry is None:
+            return None
+        if self.max_age is not None and time.monotonic() - entry.cached_at > self.max_age:
+            self._pop(message_id)
+            self.evictions["age"] += 1
+            return None
+        self._messages.move_to_end(message_id)
+        self._channels[entry.message.channel_id].move_to_end(message_id)
+        return entry.message
+
+    def add(self, message: Message, size: int | None = None) -> None:
+        """
+        Cache a message, replacing the cached one with the same ID, and evict messages over the limits
+
+        :param message: message, e.g. MessageCreate
+        :param size: estimated size in bytes (e.g. the length of its raw frame), computed with sizer if None
+        """
+        if message.id in self._messages:
+            self._pop(message.id)
+        entry = _CachedMessage(message, self.sizer(message) if size is None else size, time.monotonic())
+        self._messages[message.id] = entry
+        channel = self._channels.setdefault(message.channel_id, collections.OrderedDict())
+        channel[message.id] = None
+        self.size += entry.size
+
+        if self.max_per_channel is not None:
+            while len(channel) > self.max_per_channel:
+                self._pop(next(iter(channel)))
+                self.evictions["channel"] += 1
+        self._evict()
+
+    def update(self, update: MessageUpdate) -> Message | None:
+        """
+        Apply a (partial) MESSAGE_UPDATE to a cached message: the cached record is replaced by a copy with
+        the fields sent set, unknown messages are not cached
+
+        :param update: update
+        :returns: the cached message before the update, None if not cached
+        """
+        previous = self.get(update.id)
+        if previous is None:
+            return None
+        message = copy.copy(previous)
+        for field in type(update).__fields__:
+            value = getattr(update, field)
+            if value is not None and field in message.__fields__:
+                setattr(message, field, value)
+        self.add(message)
+        return previous
+
+    def remove(self, message_id: int) -> Message | None:
+        """
+        :returns: removed message, None if not cached
+        """
+        entry = self._pop(message_id)
+        return entry.message if entry is not None else None
+
+    def clear(self) -> None:
+        """
+        Remove every message
+        """
+        self._messages.clear()
+        self._channels.clear()
+        self.size = 0
+
+    def _pop(self, message_id: int) -> _CachedMessage | None:
+        entry = self._messages.pop(message_id, None)
+        if entry is None:
+            return None
+        self.size -= entry.size
+        channel = self._channels[entry.message.channel_id]
+        del channel[message_id]
+        if not channel:
+            del self._channels[entry.message.channel_id]
+        return entry
+
+    def _evict(self) -> None:
+        messages = self._messages
+        if self.max_age is not None:
+            expired = time.monotonic() - self.max_age
+            # least recently used first: recently read messages past their age are dropped by get()
+            while messages and next(iter(messages.values())).cached_at < expired:
+                self._pop(next(iter(messages)))
+                self.evictions["age"] += 1
+        if self.max_messages is not None:
+            while len(messages) > self.max_messages:
+                self._pop(next(iter(messages)))
+                self.evictions["messages"] += 1
+        if self.max_bytes is not None:
+            while self.size > self.max_bytes and messages:
+                self._pop(next(iter(messages)))
+                self.evictions["bytes"] += 1
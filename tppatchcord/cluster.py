@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import Any, Awaitable, Callable, Iterable
+
+from tppatchcord.websockets import (AUTO_SHARD_COUNT, IDENTIFY_INTERVAL, IdentifyLimiter, fetch_gateway_bot,
+                                    main_loop, next_events, shard_connections)
+
+SESSION_REPORT_INTERVAL = 5 # seconds between two session reports of a worker to the supervisor
+SUPERVISOR_INTERVAL = 1
+RESTART_DELAY = 5
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+
+class SharedIdentifyLimiter(IdentifyLimiter):
+    """
+    IdentifyLimiter enforcing max_concurrency across the worker processes of a cluster,
+    through a process-shared lock and last identify timestamp per bucket
+    """
+
+    def __init__(self, max_concurrency: int, locks: list, last_identify: list) -> None:
+        super().__init__(max_concurrency)
+        self._shared_locks = locks
+        self._shared_last_identify = last_identify
+
+    async def wait(self, shard_id: int) -> None:
+        await asyncio.to_thread(self._wait_blocking, shard_id % self.max_concurrency)
+
+    def _wait_blocking(self, bucket: int) -> None:
+        with self._shared_locks[bucket]:
+            delay = self._shared_last_identify[bucket].value + IDENTIFY_INTERVAL - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._shared_last_identify[bucket].value = time.time()
+
+
+async def _report_sessions(worker_id: int, status_queue: multiprocessing.Queue) -> None:
+    while True:
+        await asyncio.sleep(SESSION_REPORT_INTERVAL)
+        sessions = {
+            shard_id: (connection.session_id, connection.resume_gateway_url, connection.sequence_number)
+            for shard_id, connection in shard_connections().items()
+            if connection.session_id is not None and connection.sequence_number is not None
+        }
+        status_queue.put((worker_id, sessions))
+
+async def _dispatch_events(handler: EventHandler | None, forward_queue: multiprocessing.Queue,
+                           forward_events: frozenset[str]) -> None:
+    while True:
+        for payload in await next_events():
+            if payload.get("t") in forward_events:
+                forward_queue.put(payload)
+            if handler is not None:
+                await handler(payload)
+
+async def _worker(worker_id: int, token: str, shard_count: int, shard_ids: list[int], handler: EventHandler | None,
+                  sessions: dict, identify_limiter: IdentifyLimiter, status_queue: multiprocessing.Queue,
+                  forward_queue: multiprocessing.Queue, forward_events: frozenset[str], settings: dict) -> None:
+    main_loop_task = asyncio.create_task(main_loop(token, shard_count, shard_ids, sessions=sessions,
+                                                   identify_limiter=identify_limiter, **settings))
+    tasks = [
+        asyncio.create_task(_dispatch_events(handler, forward_queue, forward_events)),
+        asyncio.create_task(_report_sessions(worker_id, status_queue))
+    ]
+    try:
+        # main_loop only returns when it fails (or is cancelled), the supervisor restarts the worker then
+        await main_loop_task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def _worker_main(*args: Any) -> None:
+    asyncio.run(_worker(*args))
+
+
+class ShardCluster:
+    """
+    Supervisor spreading the shards of a bot across worker processes. Every worker runs main_loop for its
+    shard range and decodes/handles its events locally with handler. Crashed workers are restarted and resume
+    the last sessions they reported. Events named in forward_events are also forwarded to the supervisor
+    process (see next_event).
+    """
+
+    def __init__(self, token: str, handler: EventHandler | None = None, shard_count: int = AUTO_SHARD_COUNT,
+                 workers: int | None = None, forward_events: Iterable[str] = (), **settings: Any) -> None:
+        """
+        :param token: User (bot) identification token
+        :param handler: Picklable (module level) coroutine function called by the workers for every event payload
+        :param shard_count: Total number of shards, AUTO_SHARD_COUNT for the recommended one
+        :param workers: Number of worker processes, one per core by default
+        :param forward_events: Event names to forward to the supervisor process
+        :param settings: connection settings, see GatewayConnection.configure
+        """
+        self.token = token
+        self.handler = handler
+        self.shard_count = shard_count
+        self.workers = workers or os.cpu_count() or 1
+        self.forward_events = frozenset(forward_events)
+        self.settings = settings
+
+        # spawn instead of fork: workers must not inherit the supervisor's running event loop
+        self._context = multiprocessing.get_context("spawn")
+        self._status_queue = self._context.Queue()
+        self._forward_queue = self._context.Queue()
+        self._processes = {}
+        self._shard_ranges = {}
+        self._sessions = {}
+        self._max_concurrency = 1
+
+    def _start_worker(self, worker_id: int) -> None:
+        shard_ids = self._shard_ranges[worker_id]
+        sessions = {shard_id: self._sessions[shard_id] for shard_id in shard_ids if shard_id in self._sessions}
+        process = self._context.Process(
+            target=_worker_main,
+            args=(worker_id, self.token, self.shard_count, shard_ids, self.handler, sessions, self._identify_limiter,
+                  self._status_queue, self._forward_queue, self.forward_events, self.settings),
+            name=f"tppatchcord-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self._processes[worker_id] = process
+        logger.info("Started worker %d (pid %d) for shards %s", worker_id, process.pid, shard_ids)
+
+    def _collect_sessions(self) -> None:
+        while True:
+            try:
+                _, sessions = self._status_queue.get_nowait()
+            except queue.Empty:
+                return
+            self._sessions.update(sessions)
+
+    async def run(self) -> None:
+        """
+        Start the workers and supervise them until cancelled
+        """
+        if self.shard_count == AUTO_SHARD_COUNT:
+            gateway_bot = await fetch_gateway_bot(self.token)
+            self.shard_count = gateway_bot["shards"]
+            self._max_concurrency = gateway_bot["session_start_limit"]["max_concurrency"]
+
+        self._identify_limiter = SharedIdentifyLimiter(
+            self._max_concurrency,
+            [self._context.Lock() for _ in range(self._max_concurrency)],
+            [self._context.Value("d", 0.0) for _ in range(self._max_concurrency)]
+        )
+
+        workers = min(self.workers, self.shard_count)
+        for worker_id in range(workers):
+            self._shard_ranges[worker_id] = list(range(worker_id, self.shard_count, workers))
+            self._start_worker(worker_id)
+
+        restart_at = {}
+        try:
+            while True:
+                await asyncio.sleep(SUPERVISOR_INTERVAL)
+                self._collect_sessions()
+                for worker_id, process in self._processes.items():
+                    if process.is_alive() or worker_id in restart_at:
+                        continue
+                    logger.warning("Worker %d exited with code %s, restarting in %ds", worker_id, process.exitcode, RESTART_DELAY)
+                    restart_at[worker_id] = time.monotonic() + RESTART_DELAY
+
+                for worker_id, when in list(restart_at.items()):
+                    if when <= time.monotonic():
+                        del restart_at[worker_id]
+                        self._start_worker(worker_id)
+        except asyncio.CancelledError:
+            return
+        finally:
+            for process in self._processes.values():
+                process.terminate()
+
+    async def next_event(self) -> dict:
+        """
+        Get the next event forwarded by the workers
+
+        :returns: raw dict processable with process_event_payload (tagged with "shard_id")
+        """
+        while True:
+            # poll with a timeout: a thread blocked on get() forever would keep the loop's executor from shutting down
+            try:
+                return await asyncio.to_thread(self._forward_queue.get, True, SUPERVISOR_INTERVAL)
+            except queue.Empty:
+                continue
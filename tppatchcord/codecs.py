@@ -0,0 +1,77 @@
+import json
+import re
+from typing import Any, Callable
+
+from recordclass import dataobject
+
+from tppatchcord import etf
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Codec(dataobject):
+    """
+    Gateway payload (de)serializer.
+    loads must accept raw frame bytes (no intermediate str copy), dumps returns the frame to send.
+    encoding is the gateway 'encoding' query parameter the codec speaks.
+    peek optionally extracts (event name, sequence number) from a raw frame without fully decoding it,
+    returning None when it cannot do so reliably.
+    """
+    name: str
+    encoding: str
+    loads: Callable[[bytes | str], Any]
+    dumps: Callable[[Any], str | bytes]
+    peek: Callable[[bytes], tuple[str | None, int | None] | None] | None = None
+
+
+_EVENT_NAME_RE = re.compile(rb'"t"\s*:\s*(?:"([A-Z0-9_]+)"|null)')
+_SEQUENCE_RE = re.compile(rb'"s"\s*:\s*(?:(\d+)|null)')
+_DATA_KEY = b'"d"'
+
+def peek_json(frame: bytes) -> tuple[str | None, int | None] | None:
+    """
+    Cheaply extract the top-level "t" and "s" fields of a JSON gateway frame.
+    Only matches found before the "d" key are trusted: anything after it may belong to the nested payload.
+
+    :param frame: raw JSON frame
+    :returns: (event name, sequence number) or None if they could not be located reliably
+    """
+    name_match = _EVENT_NAME_RE.search(frame)
+    sequence_match = _SEQUENCE_RE.search(frame)
+    if name_match is None or sequence_match is None:
+        return None
+
+    data_pos = frame.find(_DATA_KEY)
+    if data_pos != -1 and (data_pos < name_match.start() or data_pos < sequence_match.start()):
+        return None
+
+    name, sequence = name_match.group(1), sequence_match.group(1)
+    return name and name.decode(), sequence and int(sequence)
+
+
+JSON_CODEC = Codec(name="json", encoding="json", loads=json.loads, dumps=json.dumps, peek=peek_json)
+
+ORJSON_CODEC = Codec(
+    name="orjson",
+    encoding="json",
+    loads=orjson.loads,
+    dumps=lambda obj: orjson.dumps(obj).decode(), # the gateway expects text frames for the json encoding
+    peek=peek_json
+) if orjson else None
+
+# encoding=etf, e.g. to replay etf recordings. Not a performance option: the pure Python decoder is several times
+# slower than json, let alone orjson (see benchmarks/gateway_encodings.py). C decoders do not fit: earl rejects
+# SMALL_ATOM_UTF8_EXT, the atom encoding of current Erlang releases.
+ETF_CODEC = Codec(name="etf", encoding="etf", loads=etf.loads, dumps=etf.dumps)
+
+
+def default_codec() -> Codec:
+    """
+    Pick the fastest importable codec: orjson if installed, stdlib json otherwise (never ETF_CODEC, which is slower)
+
+    :returns: codec
+    """
+    return ORJSON_CODEC or JSON_CODEC
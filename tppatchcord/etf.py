@@ -0,0 +1,208 @@
+import struct
+import zlib
+from typing import Any
+
+# https://www.erlang.org/doc/apps/erts/erl_ext_dist
+FORMAT_VERSION = 131
+
+NEW_FLOAT_EXT = 70
+COMPRESSED = 80
+SMALL_INTEGER_EXT = 97
+INTEGER_EXT = 98
+FLOAT_EXT = 99
+ATOM_EXT = 100
+SMALL_TUPLE_EXT = 104
+LARGE_TUPLE_EXT = 105
+NIL_EXT = 106
+STRING_EXT = 107
+LIST_EXT = 108
+BINARY_EXT = 109
+SMALL_BIG_EXT = 110
+LARGE_BIG_EXT = 111
+SMALL_ATOM_EXT = 115
+MAP_EXT = 116
+ATOM_UTF8_EXT = 118
+SMALL_ATOM_UTF8_EXT = 119
+
+_ATOMS = {"nil": None, "true": True, "false": False}
+
+_unpack_int32 = struct.Struct(">i").unpack_from
+_unpack_uint32 = struct.Struct(">I").unpack_from
+_unpack_uint16 = struct.Struct(">H").unpack_from
+_unpack_double = struct.Struct(">d").unpack_from
+
+
+class ETFDecodeError(ValueError):
+    pass
+
+
+def _decode_atom(data: bytes, pos: int, size: int) -> tuple[Any, int]:
+    name = data[pos:pos + size].decode()
+    # nil/true/false map to their JSON counterparts, every other atom (keys, event names) is a str
+    return _ATOMS.get(name, name), pos + size
+
+def _decode_term(data: bytes, pos: int) -> tuple[Any, int]:
+    """
+    Decode a single term starting at pos
+
+    :param data: ETF data
+    :param pos: offset of the term tag
+    :returns: (decoded term, offset past the term)
+    """
+    tag = data[pos]
+    pos += 1
+
+    if tag == BINARY_EXT:
+        size = _unpack_uint32(data, pos)[0]
+        pos += 4
+        return data[pos:pos + size].decode(), pos + size
+
+    if tag == MAP_EXT:
+        arity = _unpack_uint32(data, pos)[0]
+        pos += 4
+        result = {}
+        for _ in range(arity):
+            key, pos = _decode_term(data, pos)
+            result[key], pos = _decode_term(data, pos)
+        return result, pos
+
+    if tag == SMALL_INTEGER_EXT:
+        return data[pos], pos + 1
+
+    if tag == INTEGER_EXT:
+        return _unpack_int32(data, pos)[0], pos + 4
+
+    if tag == SMALL_ATOM_UTF8_EXT or tag == SMALL_ATOM_EXT:
+        return _decode_atom(data, pos + 1, data[pos])
+
+    if tag == ATOM_UTF8_EXT or tag == ATOM_EXT:
+        return _decode_atom(data, pos + 2, _unpack_uint16(data, pos)[0])
+
+    if tag == SMALL_BIG_EXT or tag == LARGE_BIG_EXT:
+        if tag == SMALL_BIG_EXT:
+            size = data[pos]
+            pos += 1
+        else:
+            size = _unpack_uint32(data, pos)[0]
+            pos += 4
+        sign = data[pos]
+        value = int.from_bytes(data[pos + 1:pos + 1 + size], "little")
+        return -value if sign else value, pos + 1 + size
+
+    if tag == LIST_EXT:
+        length = _unpack_uint32(data, pos)[0]
+        pos += 4
+        result = []
+        for _ in range(length):
+            item, pos = _decode_term(data, pos)
+            result.append(item)
+        tail, pos = _decode_term(data, pos)
+        if tail != []:
+            raise ETFDecodeError("Improper lists are not supported")
+        return result, pos
+
+    if tag == NIL_EXT:
+        return [], pos
+
+    if tag == STRING_EXT:
+        # Erlang packs lists of small integers as strings, keep them as lists like JSON would
+        size = _unpack_uint16(data, pos)[0]
+        pos += 2
+        return list(data[pos:pos + size]), pos + size
+
+    if tag == NEW_FLOAT_EXT:
+        return _unpack_double(data, pos)[0], pos + 8
+
+    if tag == FLOAT_EXT:
+        return float(data[pos:pos + 31].rstrip(b"\x00")), pos + 31
+
+    if tag == SMALL_TUPLE_EXT or tag == LARGE_TUPLE_EXT:
+        if tag == SMALL_TUPLE_EXT:
+            arity = data[pos]
+            pos += 1
+        else:
+            arity = _unpack_uint32(data, pos)[0]
+            pos += 4
+        result = []
+        for _ in range(arity):
+            item, pos = _decode_term(data, pos)
+            result.append(item)
+        return result, pos
+
+    raise ETFDecodeError(f"Unsupported ETF tag {tag}")
+
+def loads(data: bytes) -> Any:
+    """
+    Decode an ETF payload into JSON-compatible python objects
+    (dicts, lists, strs, ints, floats, bools and None), suitable for process_event_payload
+
+    :param data: ETF data
+    :returns: decoded payload
+    """
+    if data[0] != FORMAT_VERSION:
+        raise ETFDecodeError(f"Unknown ETF format version {data[0]}")
+
+    pos = 1
+    if data[pos] == COMPRESSED:
+        data = bytes([FORMAT_VERSION]) + zlib.decompress(data[pos + 5:])
+
+    return _decode_term(data, pos)[0]
+
+
+def _encode_term(obj: Any, out: bytearray) -> None:
+    if obj is None:
+        out += b"\x77\x03nil"
+    elif obj is True:
+        out += b"\x77\x04true"
+    elif obj is False:
+        out += b"\x77\x05false"
+    elif isinstance(obj, str):
+        encoded = obj.encode()
+        out.append(BINARY_EXT)
+        out += struct.pack(">I", len(encoded))
+        out += encoded
+    elif isinstance(obj, int):
+        if 0 <= obj <= 255:
+            out.append(SMALL_INTEGER_EXT)
+            out.append(obj)
+        elif -2**31 <= obj < 2**31:
+            out.append(INTEGER_EXT)
+            out += struct.pack(">i", obj)
+        else:
+            magnitude = abs(obj)
+            encoded = magnitude.to_bytes((magnitude.bit_length() + 7) // 8, "little")
+            out.append(SMALL_BIG_EXT)
+            out.append(len(encoded))
+            out.append(obj < 0)
+            out += encoded
+    elif isinstance(obj, float):
+        out.append(NEW_FLOAT_EXT)
+        out += struct.pack(">d", obj)
+    elif isinstance(obj, dict):
+        out.append(MAP_EXT)
+        out += struct.pack(">I", len(obj))
+        for key, value in obj.items():
+            _encode_term(key, out)
+            _encode_term(value, out)
+    elif isinstance(obj, (list, tuple)):
+        if not obj:
+            out.append(NIL_EXT)
+            return
+        out.append(LIST_EXT)
+        out += struct.pack(">I", len(obj))
+        for item in obj:
+            _encode_term(item, out)
+        out.append(NIL_EXT)
+    else:
+        raise TypeError(f"Object of type {type(obj).__name__} is not ETF serializable")
+
+def dumps(obj: Any) -> bytes:
+    """
+    Encode JSON-compatible python objects into an ETF payload
+
+    :param obj: payload
+    :returns: ETF data
+    """
+    out = bytearray([FORMAT_VERSION])
+    _encode_term(obj, out)
+    return bytes(out)
@@ -0,0 +1,246 @@
+import array
+import asyncio
+import collections
+import json
+import logging
+import time
+import uuid
+import zlib
+from typing import Any, Awaitable, Callable, Iterable
+from urllib.parse import parse_qs, urlsplit
+
+from websockets.asyncio.server import Server, ServerConnection, serve
+from websockets.exceptions import ConnectionClosed
+
+from tppatchcord.codecs import ETF_CODEC, JSON_CODEC, Codec
+from tppatchcord.recording import MAGIC, read_payloads
+from tppatchcord.websockets import (DISPATCH_OPCODE, HEARTBEAT_ACK_OPCODE, HEARTBEAT_OPCODE, HELLO_OPCODE,
+                                    IDENTIFY_OPCODE, INVALID_SESSION_OPCODE, RESUME_CLOSE_CODE, RESUME_OPCODE,
+                                    WS_MAX_SIZE)
+
+FAKE_HEARTBEAT_INTERVAL = 41250 # milliseconds, as sent by the real gateway
+RESUME_BUFFER_SIZE = 10000 # dispatched events kept for RESUME
+RECEIVED_BUFFER_SIZE = 1000 # client messages kept in FakeGateway.received
+OVERSIZED_EVENT = "FAKE_OVERSIZED"
+
+_CODECS = {codec.encoding: codec for codec in (JSON_CODEC, ETF_CODEC)}
+
+logger = logging.getLogger(__name__)
+
+
+def load_events(path: str) -> list[dict]:
+    """
+    Load an event stream to replay: a recording (see recording.FrameRecorder) or one raw gateway payload (JSON) per line
+
+    :param path: recording or JSON lines file
+    :returns: payloads
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            return list(read_payloads(path))
+        f.seek(0)
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class FakeGateway:
+    """
+    Local stand-in for the Discord gateway, for tests and benchmarks without a token or network access.
+    Speaks the HELLO/IDENTIFY/heartbeat/RESUME handshake with the json and etf encodings and zlib-stream compression,
+    and replays an event stream at a configurable rate. Sequence numbers are assigned by the server and the stream
+    continues across connections, a RESUME replays what the client missed.
+    Faults can be injected periodically (disconnect_every, oversized_every) or on demand (disconnect, send_oversized).
+
+    async with FakeGateway(events, rate=1000) as gateway:
+        await main_loop(token, gateway_base_url=gateway.url)
+    """
+
+    def __init__(self, events: Iterable[dict] = (), rate: float | None = None, host: str = "127.0.0.1", port: int = 0,
+                 heartbeat_interval: int = FAKE_HEARTBEAT_INTERVAL, ack_heartbeats: bool = True,
+                 disconnect_every: int | None = None, oversized_every: int | None = None,
+                 oversized_size: int = WS_MAX_SIZE + 1) -> None:
+        """
+        :param events: payloads to dispatch ("t" and "d", "op" and "s" are set by the server), e.g. from load_events()
+        :param rate: events per second, None for as fast as possible
+        :param host: interface to listen on
+        :param port: port to listen on, 0 for a free one (see url)
+        :param heartbeat_interval: heartbeat interval sent with HELLO, in milliseconds
+        :param ack_heartbeats: answer heartbeats, False to simulate a zombie connection
+        :param disconnect_every: close the connection (resumable) after every n dispatched events
+        :param oversized_every: send a frame of oversized_size bytes after every n dispatched events
+        :param oversized_size: size of the oversized frames
+        """
+        self.events = iter(events)
+        self.rate = rate
+        self.host = host
+        self.port = port
+        self.heartbeat_interval = heartbeat_interval
+        self.ack_heartbeats = ack_heartbeats
+        self.disconnect_every = disconnect_every
+        self.oversized_every = oversized_every
+        self.oversized_size = oversized_size
+
+        self.session_id = None
+        self.sequence = 0
+        self.resume_buffer = collections.deque(maxlen=RESUME_BUFFER_SIZE) # (seq, payload)
+        self.sent_times = array.array("d") # perf_counter() of the first send of every sequence number, index seq - 1
+        self.received = collections.deque(maxlen=RECEIVED_BUFFER_SIZE) # non-heartbeat client payloads
+        self.exhausted = asyncio.Event() # set once every event was dispatched
+        self.stats = collections.Counter() # connections, identifies, resumes, invalid_sessions, disconnects, oversized, heartbeats
+
+        self._server: Server | None = None
+        self._connection: ServerConnection | None = None
+        self._send: Callable[[dict], Awaitable[None]] | None = None
+
+    @property
+    def url(self) -> str:
+        """
+        Base URL to connect to, usable as the gateway_base_url connection setting
+        """
+        return f"ws://{self.host}:{self.port}/"
+
+    async def start(self) -> None:
+        self._server = await serve(self._handle_connection, self.host, self.port, max_size=None)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self) -> "FakeGateway":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    def sent_time(self, sequence: int) -> float | None:
+        """
+        Get when an event was first dispatched, e.g. to measure end-to-end latency
+
+        :param sequence: sequence number ("s") of the event
+        :returns: time.perf_counter() timestamp, None if not dispatched yet
+        """
+        return self.sent_times[sequence - 1] if 0 < sequence <= len(self.sent_times) else None
+
+    async def disconnect(self, code: int = RESUME_CLOSE_CODE) -> None:
+        """
+        Close the current client connection
+
+        :param code: close code, the default one keeps the session resumable
+        """
+        if self._connection is not None:
+            self.stats["disconnects"] += 1
+            await self._connection.close(code)
+
+    async def send_oversized(self) -> None:
+        """
+        Send a dispatch frame of oversized_size bytes on the current client connection
+        """
+        if self._send is not None:
+            self.stats["oversized"] += 1
+            await self._send({"op": DISPATCH_OPCODE, "s": None, "t": OVERSIZED_EVENT, "d": {"padding": "x" * self.oversized_size}})
+
+    async def _handle_connection(self, websocket: ServerConnection) -> None:
+        query = parse_qs(urlsplit(websocket.request.path).query)
+        codec = _CODECS[query.get("encoding", ["json"])[0]]
+        deflator = zlib.compressobj() if query.get("compress") == ["zlib-stream"] else None
+
+        async def send(payload: dict) -> None:
+            frame = codec.dumps(payload)
+            if deflator is not None:
+                frame = frame.encode() if isinstance(frame, str) else frame
+                frame = deflator.compress(frame) + deflator.flush(zlib.Z_SYNC_FLUSH)
+            await websocket.send(frame)
+
+        self.stats["connections"] += 1
+        self._connection, self._send = websocket, send
+        try:
+            await send({"op": HELLO_OPCODE, "d": {"heartbeat_interval": self.heartbeat_interval}})
+            if await self._handshake(websocket, codec, send):
+                await asyncio.gather(self._receive(websocket, codec, send), self._dispatch(websocket, send))
+        except ConnectionClosed:
+            pass
+        finally:
+            if self._connection is websocket:
+                self._connection, self._send = None, None
+
+    async def _handshake(self, websocket: ServerConnection, codec: Codec, send: Callable[[dict], Awaitable[None]]) -> bool:
+        while True:
+            payload = codec.loads(await websocket.recv())
+            if payload["op"] == HEARTBEAT_OPCODE:
+                self.stats["heartbeats"] += 1
+                await send({"op": HEARTBEAT_ACK_OPCODE, "d": None})
+                continue
+            break
+
+        if payload["op"] == IDENTIFY_OPCODE:
+            self.stats["identifies"] += 1
+            self.session_id = uuid.uuid4().hex
+            self.sequence = 0
+            self.resume_buffer.clear()
+            await send(self._next_dispatch("READY", {
+                "v": 10, "session_id": self.session_id, "resume_gateway_url": self.url,
+                "user": {"id": "0", "username": "fake", "discriminator": "0"}, "guilds": [],
+                "shard": payload["d"].get("shard"), "application": {"id": "0", "flags": 0}
+            }))
+            return True
+
+        if payload["op"] == RESUME_OPCODE:
+            missed = [(seq, event) for seq, event in self.resume_buffer if seq > payload["d"]["seq"]]
+            if payload["d"]["session_id"] != self.session_id or (
+                    self.resume_buffer and self.resume_buffer[0][0] > payload["d"]["seq"] + 1):
+                self.stats["invalid_sessions"] += 1
+                await send({"op": INVALID_SESSION_OPCODE, "d": False})
+                await websocket.wait_closed()
+                return False
+            self.stats["resumes"] += 1
+            for seq, event in missed:
+                await send({"op": DISPATCH_OPCODE, "s": seq, "t": event["t"], "d": event["d"]})
+            await send(self._next_dispatch("RESUMED", {}))
+            return True
+
+        raise ValueError(f"Unexpected opcode {payload['op']} during the handshake")
+
+    def _next_dispatch(self, name: str, data: Any) -> dict:
+        self.sequence += 1
+        self.resume_buffer.append((self.sequence, {"t": name, "d": data}))
+        if self.sequence > len(self.sent_times):
+            self.sent_times.append(time.perf_counter())
+        return {"op": DISPATCH_OPCODE, "s": self.sequence, "t": name, "d": data}
+
+    async def _receive(self, websocket: ServerConnection, codec: Codec, send: Callable[[dict], Awaitable[None]]) -> None:
+        async for message in websocket:
+            payload = codec.loads(message)
+            if payload["op"] == HEARTBEAT_OPCODE:
+                self.stats["heartbeats"] += 1
+                if self.ack_heartbeats:
+                    await send({"op": HEARTBEAT_ACK_OPCODE, "d": None})
+            else:
+                self.received.append(payload)
+
+    async def _dispatch(self, websocket: ServerConnection, send: Callable[[dict], Awaitable[None]]) -> None:
+        started = time.perf_counter()
+        dispatched = 0
+        while (event := next(self.events, None)) is not None:
+            if self.rate is not None:
+                delay = started + dispatched / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                await send(self._next_dispatch(event["t"], event["d"]))
+            except ConnectionClosed:
+                # not sent, but buffered for RESUME: the client gets it on the next connection
+                return
+            dispatched += 1
+
+            if self.oversized_every and dispatched % self.oversized_every == 0:
+                await self.send_oversized()
+            if self.disconnect_every and dispatched % self.disconnect_every == 0:
+                await self.disconnect()
+                return
+            if self.rate is None and dispatched % 100 == 0:
+                await asyncio.sleep(0) # let heartbeats through
+        self.exhausted.set()
+        await websocket.wait_closed()
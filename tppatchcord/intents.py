@@ -0,0 +1,116 @@
+from enum import IntFlag
+from typing import Iterable
+
+
+# https://discord.com/developers/docs/events/gateway#gateway-intents
+class Intents(IntFlag):
+    GUILDS = 1 << 0
+    GUILD_MEMBERS = 1 << 1 # privileged
+    GUILD_MODERATION = 1 << 2
+    GUILD_EXPRESSIONS = 1 << 3
+    GUILD_INTEGRATIONS = 1 << 4
+    GUILD_WEBHOOKS = 1 << 5
+    GUILD_INVITES = 1 << 6
+    GUILD_VOICE_STATES = 1 << 7
+    GUILD_PRESENCES = 1 << 8 # privileged
+    GUILD_MESSAGES = 1 << 9
+    GUILD_MESSAGE_REACTIONS = 1 << 10
+    GUILD_MESSAGE_TYPING = 1 << 11
+    DIRECT_MESSAGES = 1 << 12
+    DIRECT_MESSAGE_REACTIONS = 1 << 13
+    DIRECT_MESSAGE_TYPING = 1 << 14
+    MESSAGE_CONTENT = 1 << 15 # privileged, no events of its own: fills content/embeds/attachments/components of messages
+    GUILD_SCHEDULED_EVENTS = 1 << 16
+    AUTO_MODERATION_CONFIGURATION = 1 << 20
+    AUTO_MODERATION_EXECUTION = 1 << 21
+    GUILD_MESSAGE_POLLS = 1 << 24
+    DIRECT_MESSAGE_POLLS = 1 << 25
+
+PRIVILEGED_INTENTS = Intents.GUILD_MEMBERS | Intents.GUILD_PRESENCES | Intents.MESSAGE_CONTENT
+DIRECT_MESSAGE_INTENTS = (Intents.DIRECT_MESSAGES | Intents.DIRECT_MESSAGE_REACTIONS | Intents.DIRECT_MESSAGE_TYPING
+                          | Intents.DIRECT_MESSAGE_POLLS)
+
+_MESSAGE_EVENTS = frozenset({"MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE", "MESSAGE_DELETE_BULK"})
+_REACTION_EVENTS = frozenset({"MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE", "MESSAGE_REACTION_REMOVE_ALL",
+                              "MESSAGE_REACTION_REMOVE_EMOJI"})
+_POLL_EVENTS = frozenset({"MESSAGE_POLL_VOTE_ADD", "MESSAGE_POLL_VOTE_REMOVE"})
+
+# dispatch events (EVENT_DATAOBJECTS names) each intent enables
+INTENT_EVENTS = {
+    Intents.GUILDS: frozenset({
+        "GUILD_CREATE", "GUILD_UPDATE", "GUILD_DELETE", "GUILD_ROLE_CREATE", "GUILD_ROLE_UPDATE", "GUILD_ROLE_DELETE",
+        "CHANNEL_CREATE", "CHANNEL_UPDATE", "CHANNEL_DELETE", "CHANNEL_PINS_UPDATE", "THREAD_CREATE", "THREAD_UPDATE",
+        "THREAD_DELETE", "THREAD_LIST_SYNC", "THREAD_MEMBER_UPDATE", "THREAD_MEMBERS_UPDATE", "STAGE_INSTANCE_CREATE",
+        "STAGE_INSTANCE_UPDATE", "STAGE_INSTANCE_DELETE"
+    }),
+    Intents.GUILD_MEMBERS: frozenset({"GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE", "GUILD_MEMBER_REMOVE", "THREAD_MEMBERS_UPDATE"}),
+    Intents.GUILD_MODERATION: frozenset({"GUILD_AUDIT_LOG_ENTRY_CREATE", "GUILD_BAN_ADD", "GUILD_BAN_REMOVE"}),
+    Intents.GUILD_EXPRESSIONS: frozenset({"GUILD_EMOJIS_UPDATE", "GUILD_STICKERS_UPDATE"}),
+    Intents.GUILD_INTEGRATIONS: frozenset({"GUILD_INTEGRATIONS_UPDATE", "INTEGRATION_CREATE", "INTEGRATION_UPDATE",
+                                           "INTEGRATION_DELETE"}),
+    Intents.GUILD_WEBHOOKS: frozenset({"WEBHOOKS_UPDATE"}),
+    Intents.GUILD_INVITES: frozenset({"INVITE_CREATE", "INVITE_DELETE"}),
+    Intents.GUILD_VOICE_STATES: frozenset({"VOICE_CHANNEL_EFFECT_SEND", "VOICE_STATE_UPDATE"}),
+    Intents.GUILD_PRESENCES: frozenset({"PRESENCE_UPDATE"}),
+    Intents.GUILD_MESSAGES: _MESSAGE_EVENTS,
+    Intents.GUILD_MESSAGE_REACTIONS: _REACTION_EVENTS,
+    Intents.GUILD_MESSAGE_TYPING: frozenset({"TYPING_START"}),
+    Intents.DIRECT_MESSAGES: _MESSAGE_EVENTS - {"MESSAGE_DELETE_BULK"} | {"CHANNEL_PINS_UPDATE"},
+    Intents.DIRECT_MESSAGE_REACTIONS: _REACTION_EVENTS,
+    Intents.DIRECT_MESSAGE_TYPING: frozenset({"TYPING_START"}),
+    Intents.GUILD_SCHEDULED_EVENTS: frozenset({
+        "GUILD_SCHEDULED_EVENT_CREATE", "GUILD_SCHEDULED_EVENT_UPDATE", "GUILD_SCHEDULED_EVENT_DELETE",
+        "GUILD_SCHEDULED_EVENT_USER_ADD", "GUILD_SCHEDULED_EVENT_USER_REMOVE"
+    }),
+    Intents.AUTO_MODERATION_CONFIGURATION: frozenset({"AUTO_MODERATION_RULE_CREATE", "AUTO_MODERATION_RULE_UPDATE",
+                                                      "AUTO_MODERATION_RULE_DELETE"}),
+    Intents.AUTO_MODERATION_EXECUTION: frozenset({"AUTO_MODERATION_ACTION_EXECUTION"}),
+    Intents.GUILD_MESSAGE_POLLS: _POLL_EVENTS,
+    Intents.DIRECT_MESSAGE_POLLS: _POLL_EVENTS
+}
+
+# dispatch events sent regardless of intents (READY, INTERACTION_CREATE, GUILD_MEMBERS_CHUNK, ...)
+UNGATED_EVENTS = frozenset({
+    "APPLICATION_COMMAND_PERMISSIONS_UPDATE", "ENTITLEMENT_CREATE", "ENTITLEMENT_DELETE", "ENTITLEMENT_UPDATE",
+    "GUILD_MEMBERS_CHUNK", "HELLO", "INTERACTION_CREATE", "READY", "SUBSCRIPTION_CREATE", "SUBSCRIPTION_DELETE",
+    "SUBSCRIPTION_UPDATE", "VOICE_SERVER_UPDATE"
+})
+
+# events whose payloads lack content without Intents.MESSAGE_CONTENT
+MESSAGE_CONTENT_EVENTS = frozenset({"MESSAGE_CREATE", "MESSAGE_UPDATE"})
+
+
+def intents_for_events(events: Iterable[str], direct_messages: bool = False, message_content: bool = True) -> Intents:
+    """
+    Get the minimal intents enabling given dispatch events, so the gateway only sends what is subscribed to.
+    A privileged intent (which the gateway refuses with close code 4014 unless enabled for the bot) is only
+    added for events no other intent enables, e.g. GUILD_MEMBERS for GUILD_MEMBER_ADD but not for THREAD_MEMBERS_UPDATE.
+    e.g. intents_for_events({"MESSAGE_CREATE"}) == Intents.GUILD_MESSAGES | Intents.MESSAGE_CONTENT
+
+    :param events: dispatch event names (EVENT_DATAOBJECTS keys)
+    :param direct_messages: also enable the direct message counterparts of guild message/reaction/typing/poll events
+    :param message_content: add Intents.MESSAGE_CONTENT if message events are requested
+    :returns: intents
+    """
+    events = frozenset(events)
+    intents = Intents(0)
+    # least privileged first: privileged intents only cover the events left
+    for privileged in (False, True):
+        for intent, intent_events in INTENT_EVENTS.items():
+            if (intent in PRIVILEGED_INTENTS) != privileged or (intent in DIRECT_MESSAGE_INTENTS and not direct_messages):
+                continue
+            if events & intent_events:
+                intents |= intent
+        events -= events_for_intents(intents)
+    if message_content and events & MESSAGE_CONTENT_EVENTS:
+        intents |= Intents.MESSAGE_CONTENT
+    return intents
+
+def events_for_intents(intents: Intents) -> frozenset[str]:
+    """
+    Get the dispatch events the gateway may send with given intents
+
+    :param intents: intents
+    :returns: event names, including UNGATED_EVENTS
+    """
+    return UNGATED_EVENTS.union(*(events for intent, events in INTENT_EVENTS.items() if intent in intents))
@@ -0,0 +1,137 @@
+import asyncio
+import pickle
+import tempfile
+from enum import Enum
+from typing import Any, Iterable
+
+from recordclass import dataobject
+
+
+class OverflowPolicy(int, Enum):
+    BLOCK = 0 # wait for room, applying backpressure to the producer (read_handler stops reading the socket)
+    DROP_OLDEST = 1 # discard the oldest queued item
+    DROP_BY_TYPE = 2 # discard the oldest queued item of a droppable event type (or the new one if it is droppable), block otherwise
+    SPILL = 3 # write overflowing items to a temporary file on disk, read back in order as room frees up
+
+class QueueStats(dataobject):
+    size: int
+    maxsize: int
+    high_water_mark: int
+    dropped: int
+    spilled: int
+
+
+class BoundedQueue(asyncio.Queue):
+    """
+    asyncio.Queue with an explicit overflow policy and high-water-mark statistics.
+    Bounds can be reconfigured in place, so consumers already waiting on the queue keep working.
+    """
+
+    def __init__(self, maxsize: int = 0, policy: OverflowPolicy = OverflowPolicy.BLOCK,
+                 droppable_events: Iterable[str] = (), spill_dir: str | None = None) -> None:
+        super().__init__()
+        self._spill_file = None
+        self._spill_count = 0
+        self._spill_read_pos = 0
+        self.high_water_mark = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.configure(maxsize, policy, droppable_events, spill_dir)
+
+    def configure(self, maxsize: int = 0, policy: OverflowPolicy = OverflowPolicy.BLOCK,
+                  droppable_events: Iterable[str] = (), spill_dir: str | None = None) -> None:
+        """
+        Set bounds and overflow policy
+
+        :param maxsize: maximum number of queued items, 0 for unbounded
+        :param policy: what to do when the queue is full
+        :param droppable_events: event names (payload "t") which may be dropped with OverflowPolicy.DROP_BY_TYPE
+        :param spill_dir: directory for the spill file of OverflowPolicy.SPILL, None for the system default
+        """
+        self._maxsize = maxsize
+        self.policy = policy
+        self.droppable_events = frozenset(droppable_events)
+        self.spill_dir = spill_dir
+
+    def stats(self) -> QueueStats:
+        return QueueStats(
+            size=self.qsize() + self._spill_count,
+            maxsize=self._maxsize,
+            high_water_mark=self.high_water_mark,
+            dropped=self.dropped,
+            spilled=self.spilled
+        )
+
+    async def put(self, item: Any) -> None:
+        if self._spill_count or (self.full() and self.policy == OverflowPolicy.SPILL):
+            # keep ordering: once spilling started everything goes through the spill file until it is drained
+            self._spill(item)
+            return
+
+        if self.full():
+            if self.policy == OverflowPolicy.DROP_OLDEST:
+                super().get_nowait()
+                self.task_done()
+                self.dropped += 1
+            elif self.policy == OverflowPolicy.DROP_BY_TYPE:
+                if self._is_droppable(item):
+                    self.dropped += 1
+                    return
+                self._drop_oldest_droppable()
+
+        await super().put(item)
+        if self.qsize() > self.high_water_mark:
+            self.high_water_mark = self.qsize()
+
+    def get_nowait(self) -> Any:
+        # asyncio.Queue.get() ends with get_nowait(), so spilled items are refilled on both paths
+        item = super().get_nowait()
+        if self._spill_count:
+            self._refill()
+        return item
+
+    def close(self) -> None:
+        """
+        Close the spill file, the items still spilled to it are dropped (and counted as such).
+        Queued items are kept, spilling opens a new file if the queue is used again.
+        """
+        self.dropped += self._spill_count
+        self._spill_count = 0
+        self._close_spill_file()
+
+    def _is_droppable(self, item: Any) -> bool:
+        return isinstance(item, dict) and item.get("t") in self.droppable_events
+
+    def _drop_oldest_droppable(self) -> None:
+        for queued in self._queue:
+            if self._is_droppable(queued):
+                self._queue.remove(queued)
+                self.task_done()
+                self.dropped += 1
+                return
+
+    def _spill(self, item: Any) -> None:
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        self._spill_file.seek(0, 2)
+        pickle.dump(item, self._spill_file, pickle.HIGHEST_PROTOCOL)
+        self._spill_count += 1
+        self.spilled += 1
+        self.high_water_mark = max(self.high_water_mark, self.qsize() + self._spill_count)
+
+    def _refill(self) -> None:
+        self._spill_file.seek(self._spill_read_pos)
+        while self._spill_count and not self.full():
+            self.put_nowait(pickle.load(self._spill_file))
+            self._spill_count -= 1
+        self._spill_read_pos = self._spill_file.tell()
+
+        if not self._spill_count:
+            self._close_spill_file()
+
+    def _close_spill_file(self) -> None:
+        # reopened on the next overflow, bursts are rare
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        self._spill_read_pos = 0
@@ -0,0 +1,315 @@
+import asyncio
+import collections
+import math
+import time
+from typing import Any
+
+
+class SlidingWindowLimiter:
+    """
+    Allows `limit` acquisitions within any `period` seconds: the times of the acquisitions of the last period
+    are kept, and a new one is only allowed while fewer than `limit` of them are left in the window.
+    Unlike a token bucket, a burst is never followed by a refill within the same period.
+    Callers may keep a reserve for higher priority traffic: acquire(reserve=n) only succeeds while more than n
+    acquisitions are left.
+    An acquisition may be held (e.g. a request whose arrival time at the server is unknown until its response):
+    it counts as happening now until release(), which timestamps it.
+    """
+
+    def __init__(self, limit: int, period: float) -> None:
+        self.limit = limit
+        self.period = period
+        self.acquired = collections.deque() # time.monotonic() of the acquisitions of the last period, oldest first
+        self.held = 0 # acquisitions not released yet
+
+    def delay(self, reserve: int = 0) -> float:
+        """
+        Get the time until an acquisition above reserve is allowed
+
+        :param reserve: acquisitions to leave for higher priority traffic
+        :returns: seconds to wait, 0 if allowed now
+        """
+        now = time.monotonic()
+        acquired = self.acquired
+        while acquired and acquired[0] <= now - self.period:
+            acquired.popleft()
+        allowed = self.limit - reserve
+        used = len(acquired) + self.held
+        if used < allowed:
+            return 0.0
+        if self.held >= allowed: # held acquisitions leave the window a period after their release at the earliest
+            return self.period
+        # until enough acquisitions left the window
+        return acquired[used - allowed] + self.period - now
+
+    def try_acquire(self, reserve: int = 0, hold: bool = False) -> bool:
+        """
+        Acquire if allowed now
+
+        :param reserve: acquisitions to leave for higher priority traffic
+        :param hold: count the acquisition as happening now until release()
+        :returns: whether it was acquired
+        """
+        if self.delay(reserve) > 0:
+            return False
+        if hold:
+            self.held += 1
+        else:
+            self.acquired.append(time.monotonic())
+        return True
+
+    async def acquire(self, reserve: int = 0, hold: bool = False) -> float:
+        """
+        Wait until allowed and acquire
+
+        :param reserve: acquisitions to leave for higher priority traffic
+        :param hold: count the acquisition as happening now until release()
+        :returns: seconds waited
+        """
+        waited = 0.0
+        while not self.try_acquire(reserve, hold):
+            delay = self.delay(reserve)
+            await asyncio.sleep(delay)
+            waited += delay
+        return waited
+
+    def release(self) -> None:
+        """
+        Timestamp a held acquisition with the current time
+        """
+        self.held -= 1
+        self.acquired.append(time.monotonic())
+
+
+# https://discord.com/developers/docs/topics/rate-limits
+REST_GLOBAL_LIMIT = 50 # requests per REST_GLOBAL_PERIOD across all routes
+REST_GLOBAL_PERIOD = 1
+MAJOR_PARAMETERS = ("channel_id", "guild_id", "webhook_id", "webhook_token") # route params splitting a bucket
+ROUTE_BUCKET_CACHE_SIZE = 10000 # buckets kept before idle ones are evicted
+
+
+class RouteBucket:
+    """
+    Server-driven rate limit bucket of a REST route (and its major parameters).
+    Until the first response tells the limit, a single probing request is let through.
+    Waiters are granted in FIFO order as soon as budget is left, and exactly at the reset time otherwise.
+    """
+
+    def __init__(self, key: tuple) -> None:
+        self.key = key
+        self.limit = None # None until discovered
+        self.remaining = 1 # requests left in the current window, None for routes without limit
+        self.reset_at = 0.0 # loop time the window resets, inf until the first response of a new window tells it
+        self.inflight = 0
+        self.waiters = collections.deque()
+        self._reset_handle = None
+
+    def idle(self, now: float) -> bool:
+        return not self.waiters and not self.inflight and self.reset_at <= now
+
+    async def acquire(self) -> "RouteBucket":
+        """
+        Wait for and take a request slot, release it with release() or update()
+
+        :returns: bucket granting the slot, another one if this one was merged into it meanwhile
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self._wake()
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled(): # granted, but the caller went away
+                waiter.result().release()
+            raise
+
+    def merge_into(self, bucket: "RouteBucket") -> None:
+        """
+        Hand the waiters and the in-flight probe of a provisional bucket to the discovered bucket it belongs to
+
+        :param bucket: discovered bucket
+        """
+        bucket.waiters.extend(self.waiters)
+        self.waiters.clear()
+        bucket.inflight += self.inflight
+        self.inflight = 0
+
+    def release(self) -> None:
+        """
+        Give back a slot whose request got no rate limit headers (e.g. connection errors)
+        """
+        self.inflight -= 1
+        if self.limit is None and self.remaining is not None:
+            self.remaining = 1 # the probe failed, probe again
+        if self.reset_at == math.inf and not self.inflight:
+            self.reset_at = 0.0 # nothing will tell the reset time of this window anymore
+        self._wake()
+
+    def update(self, limit: int | None, remaining: int | None, reset_after: float | None) -> None:
+        """
+        Release a slot and apply the X-RateLimit-* headers of its response
+
+        :param limit: X-RateLimit-Limit, None if the route is not limited
+        :param remaining: X-RateLimit-Remaining
+        :param reset_after: X-RateLimit-Reset-After, seconds
+        """
+        self.inflight -= 1
+        self.limit = limit
+        if limit is None:
+            self.remaining = None
+        else:
+            # requests still in flight may not be counted by the server yet
+            self.remaining = max(0, remaining - self.inflight)
+            self.reset_at = asyncio.get_running_loop().time() + reset_after
+        self._wake()
+
+    def exhaust(self, retry_after: float) -> None:
+        """
+        Block the bucket after a 429 on it
+
+        :param retry_after: seconds until requests may be retried
+        """
+        if self.remaining is not None:
+            self.remaining = 0
+        self.reset_at = max(self.reset_at, asyncio.get_running_loop().time() + retry_after)
+        self._wake()
+
+    def _on_reset(self) -> None:
+        self._reset_handle = None
+        self._wake()
+
+    def _wake(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.waiters:
+            if self.waiters[0].done(): # cancelled while waiting
+                self.waiters.popleft()
+                continue
+            if self.remaining is not None:
+                if self.remaining <= 0:
+                    if self.reset_at > loop.time():
+                        # an unknown reset time (inf) is learned from a response, which wakes the waiters again
+                        if self.reset_at != math.inf and (self._reset_handle is None or self._reset_handle.when() != self.reset_at):
+                            if self._reset_handle is not None:
+                                self._reset_handle.cancel()
+                            self._reset_handle = loop.call_at(self.reset_at, self._on_reset)
+                        return
+                    if self.limit is None:
+                        if self.inflight: # wait for the probe's response
+                            return
+                        self.remaining = 1 # the probe got a 429 without limit headers, probe again
+                    else:
+                        self.remaining = self.limit
+                        self.reset_at = math.inf
+                self.remaining -= 1
+            self.inflight += 1
+            self.waiters.popleft().set_result(self)
+
+
+class RouteRateLimiter:
+    """
+    Per-route REST rate limiter. Buckets are discovered from X-RateLimit-Bucket and split by the major parameters
+    of the route (MAJOR_PARAMETERS); routes sharing a bucket hash share its budget. Requests queue per bucket
+    instead of being sent into a 429, and all of them respect the global limit.
+    """
+
+    def __init__(self, global_limit: int = REST_GLOBAL_LIMIT) -> None:
+        self.global_limiter = SlidingWindowLimiter(global_limit, REST_GLOBAL_PERIOD)
+        self.global_reset_at = 0.0
+        self.route_buckets = {} # (method, route template) -> X-RateLimit-Bucket
+        self.buckets = {} # (bucket hash or route, major parameters) -> RouteBucket
+
+    def bucket(self, method: str, route: str, route_params: dict | None = None) -> RouteBucket:
+        """
+        Get the bucket of a request
+
+        :param method: HTTP method
+        :param route: route template, e.g. "channels/{channel_id}/messages"
+        :param route_params: values of the route placeholders
+        :returns: bucket
+        """
+        major = tuple(str(route_params.get(name)) for name in MAJOR_PARAMETERS) if route_params else ()
+        key = (self.route_buckets.get((method, route), f"{method} {route}"), major)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= ROUTE_BUCKET_CACHE_SIZE:
+                self._evict()
+            bucket = self.buckets[key] = RouteBucket(key)
+        return bucket
+
+    async def acquire(self, method: str, route: str, route_params: dict | None = None) -> RouteBucket:
+        """
+        Wait until a request may be sent
+
+        :returns: bucket to pass to update() once the response arrived, or to release() on errors
+        """
+        bucket = await self.bucket(method, route, route_params).acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            while self.global_reset_at > loop.time():
+                await asyncio.sleep(self.global_reset_at - loop.time())
+            # held until the response: the request reaches the server at some point before it
+            await self.global_limiter.acquire(hold=True)
+        except BaseException:
+            bucket.release()
+            raise
+        return bucket
+
+    def release(self, bucket: RouteBucket) -> None:
+        """
+        Give back the slot of a request which got no response (e.g. connection errors)
+
+        :param bucket: bucket returned by acquire()
+        """
+        self.global_limiter.release()
+        bucket.release()
+
+    def update(self, bucket: RouteBucket, method: str, route: str, status: int, headers: Any,
+               retry_after: float | None = None) -> RouteBucket:
+        """
+        Apply the rate limit headers of a response to its bucket
+
+        :param bucket: bucket returned by acquire()
+        :param method: HTTP method
+        :param route: route template
+        :param status: HTTP status of the response
+        :param headers: response headers (case insensitive mapping)
+        :param retry_after: retry_after of a 429 response body
+        :returns: bucket the headers were applied to (the discovered one for a provisional bucket)
+        """
+        self.global_limiter.release()
+        bucket_hash = headers.get("X-RateLimit-Bucket")
+        if bucket_hash is not None and bucket.key[0] != bucket_hash:
+            # a provisional (per-route) bucket learned its hash, it may be shared with other routes: merge into it
+            self.route_buckets[(method, route)] = bucket_hash
+            if self.buckets.get(bucket.key) is bucket:
+                del self.buckets[bucket.key]
+            key = (bucket_hash, bucket.key[1])
+            discovered = self.buckets.setdefault(key, bucket)
+            if discovered is bucket:
+                bucket.key = key
+            else:
+                bucket.merge_into(discovered)
+                bucket = discovered
+
+        if "X-RateLimit-Limit" in headers:
+            bucket.update(int(headers["X-RateLimit-Limit"]), int(headers["X-RateLimit-Remaining"]),
+                          float(headers["X-RateLimit-Reset-After"]))
+        elif retry_after is None and status < 500: # server errors may come without headers from a proxy
+            bucket.update(None, None, None)
+        else:
+            bucket.release()
+
+        if retry_after is not None:
+            scope = headers.get("X-RateLimit-Scope")
+            if headers.get("X-RateLimit-Global") == "true" or scope == "global":
+                self.global_reset_at = asyncio.get_running_loop().time() + retry_after
+            elif scope is not None and scope != "shared":
+                # shared resource limits and 429s from proxies (without scope) do not count against the bucket
+                bucket.exhaust(retry_after)
+        return bucket
+
+    def _evict(self) -> None:
+        now = asyncio.get_running_loop().time()
+        for key, bucket in list(self.buckets.items()):
+            if bucket.idle(now):
+                del self.buckets[key]
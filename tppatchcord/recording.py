@@ -0,0 +1,184 @@
+import asyncio
+import mmap
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+from tppatchcord.codecs import ETF_CODEC, Codec, default_codec
+from tppatchcord.queues import BoundedQueue
+
+# Recording file layout (append-only, little endian):
+#   header: MAGIC, encoding name length (1 byte), encoding name (gateway 'encoding' of the recorded frames)
+#   blocks: compressed size (4 bytes), raw size (4 bytes), zlib compressed records
+#   record: timestamp (time.time(), 8 bytes double), shard id (2 bytes, NO_SHARD if not sharded), frame size (4 bytes), frame
+# Blocks are compressed independently, so a crash only loses the block being filled and appending never rewrites data.
+MAGIC = b"TPPREC\x01"
+NO_SHARD = 0xFFFF
+RECORD_BLOCK_SIZE = 1 << 16 # raw bytes buffered before a block is compressed and written
+RECORD_COMPRESSION_LEVEL = 1
+REPLAY_YIELD_INTERVAL = 100 # frames replayed as fast as possible between two yields to the event loop
+
+_BLOCK_HEADER = struct.Struct("<II")
+_RECORD_HEADER = struct.Struct("<dHI")
+
+
+class RecordingError(ValueError):
+    pass
+
+
+class FrameRecorder:
+    """
+    Appends raw gateway frames with their receive timestamp to a recording file.
+    write() only buffers: blocks are compressed and written by a background thread (zlib releases the GIL),
+    keeping the cost on the read path to a struct.pack and a buffer append.
+    """
+
+    def __init__(self, path: str, encoding: str) -> None:
+        """
+        :param path: recording file, appended to if it exists
+        :param encoding: gateway encoding of the recorded frames (Codec.encoding), must match an existing file's
+        """
+        if os.path.exists(path) and os.path.getsize(path) and _read_header(path)[0] != encoding:
+            raise RecordingError(f"{path} holds frames of another encoding than {encoding}")
+        self.path = path
+        self.encoding = encoding
+        self.frames = 0
+        self._buffer = bytearray()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tppatchcord-recorder") # keeps blocks in order
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC + bytes([len(encoding)]) + encoding.encode())
+
+    def write(self, frame: bytes | str, shard_id: int | None = None) -> None:
+        """
+        Record a raw (decompressed) frame received now
+
+        :param frame: raw frame
+        :param shard_id: ID of the shard the frame was received on
+        """
+        if isinstance(frame, str):
+            frame = frame.encode()
+        self._buffer += _RECORD_HEADER.pack(time.time(), NO_SHARD if shard_id is None else shard_id, len(frame))
+        self._buffer += frame
+        self.frames += 1
+        if len(self._buffer) >= RECORD_BLOCK_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Hand the buffered frames to the writer thread
+        """
+        if self._buffer:
+            self._executor.submit(self._write_block, bytes(self._buffer))
+            self._buffer.clear()
+
+    def close(self) -> None:
+        """
+        Write the buffered frames and close the file
+        """
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self._file.close()
+
+    def _write_block(self, raw: bytes) -> None:
+        compressed = zlib.compress(raw, RECORD_COMPRESSION_LEVEL)
+        self._file.write(_BLOCK_HEADER.pack(len(compressed), len(raw)) + compressed)
+        self._file.flush()
+
+
+def _read_header(path: str) -> tuple[str, int]:
+    with open(path, "rb") as f:
+        header = f.read(len(MAGIC) + 1)
+        if len(header) < len(MAGIC) + 1 or not header.startswith(MAGIC):
+            raise RecordingError(f"{path} is not a recording")
+        encoding = f.read(header[-1]).decode()
+    return encoding, len(header) + len(encoding)
+
+def recording_codec(path: str) -> Codec:
+    """
+    Get the codec decoding the frames of a recording
+
+    :param path: recording file
+    :returns: codec for the recorded encoding
+    """
+    return ETF_CODEC if _read_header(path)[0] == ETF_CODEC.encoding else default_codec()
+
+def iter_frames(path: str) -> Iterator[tuple[float, int | None, bytes]]:
+    """
+    Read the frames of a recording through a memory map, one block decompressed at a time.
+    A truncated last block (e.g. after a crash) ends the iteration.
+
+    :param path: recording file
+    :returns: iterator of (timestamp, shard ID, raw frame)
+    """
+    _, pos = _read_header(path)
+    if os.path.getsize(path) == pos:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while pos + _BLOCK_HEADER.size <= len(data):
+            compressed_size, raw_size = _BLOCK_HEADER.unpack_from(data, pos)
+            pos += _BLOCK_HEADER.size
+            if pos + compressed_size > len(data):
+                return
+            block = zlib.decompress(data[pos:pos + compressed_size], bufsize=raw_size)
+            pos += compressed_size
+
+            offset = 0
+            while offset < len(block):
+                timestamp, shard_id, size = _RECORD_HEADER.unpack_from(block, offset)
+                offset += _RECORD_HEADER.size
+                yield timestamp, None if shard_id == NO_SHARD else shard_id, block[offset:offset + size]
+                offset += size
+
+def read_payloads(path: str) -> Iterator[dict]:
+    """
+    Decode the frames of a recording, e.g. to benchmark process_event_payload against real traffic
+
+    :param path: recording file
+    :returns: iterator of raw payloads (tagged with "shard_id" if sharded)
+    """
+    codec = recording_codec(path)
+    for _, shard_id, frame in iter_frames(path):
+        payload = codec.loads(frame)
+        if shard_id is not None:
+            payload["shard_id"] = shard_id
+        yield payload
+
+async def replay(path: str, event_queue: BoundedQueue, speed: float | None = 1.0,
+                 events: Iterable[str] | None = None) -> int:
+    """
+    Feed a recording into an event queue like read_handler would, e.g. default_connection().event_queue
+    to process it with next_event()/next_events()
+
+    :param path: recording file
+    :param event_queue: queue to feed
+    :param speed: replay speed relative to the recorded timing (1.0 for real time), None for as fast as possible
+    :param events: Dispatch event names to pass, None for all
+    :returns: number of payloads fed
+    """
+    events = frozenset(events) if events is not None else None
+    codec = recording_codec(path)
+    loop = asyncio.get_running_loop()
+    started = first_timestamp = None
+    fed = 0
+    for timestamp, shard_id, frame in iter_frames(path):
+        if speed is not None:
+            if started is None:
+                started, first_timestamp = loop.time(), timestamp
+            delay = started + (timestamp - first_timestamp) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif fed % REPLAY_YIELD_INTERVAL == 0:
+            await asyncio.sleep(0)
+
+        payload = codec.loads(frame)
+        if events is not None and payload.get("t") is not None and payload["t"] not in events:
+            continue
+        if shard_id is not None:
+            payload["shard_id"] = shard_id
+        await event_queue.put(payload)
+        fed += 1
+    return fed
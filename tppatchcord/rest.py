@@ -0,0 +1,340 @@
+import asyncio
+import collections
+import logging
+import time
+from typing import Any
+from urllib.parse import quote
+
+import aiohttp
+
+from tppatchcord.api_types import Channel, Guild, GuildMember, Message, Serializable, User
+from tppatchcord.codecs import default_codec
+from tppatchcord.ratelimit import RouteRateLimiter
+from tppatchcord.websockets import DISCORD_API_BASE_URL, DISCORD_USER_AGENT
+
+REST_CONNECTION_LIMIT = 100 # simultaneous connections of the pool
+REST_DNS_CACHE_TTL = 300 # seconds a resolved API host address is reused
+REST_KEEPALIVE_TIMEOUT = 60 # seconds an idle connection (and its TLS session) is kept for reuse
+REST_TIMEOUT = 30
+REST_MAX_RETRIES = 3 # retries of a request answered with 429 (shared resources, global limit, proxies) or 502
+REST_CACHE_SIZE = 1000 # URLs kept in the GET response cache
+REST_DEFAULT_RETRY_AFTER = 1 # seconds to wait after a 429 telling neither retry_after nor Retry-After
+
+logger = logging.getLogger(__name__)
+
+_token: str | None = None
+_base_url: str = DISCORD_API_BASE_URL
+_session: aiohttp.ClientSession | None = None
+_session_loop: asyncio.AbstractEventLoop | None = None
+_rate_limiter: RouteRateLimiter | None = None
+_cache_ttl: float = 0
+_inflight: dict[tuple, asyncio.Task] = {} # GET request key -> task of the request shared by identical GETs
+_cache: collections.OrderedDict = collections.OrderedDict() # url -> {request key: (expires at, result)}, LRU order
+_stats = collections.Counter() # requests, coalesced, cache_hits
+
+
+class DiscordHTTPError(Exception):
+    """
+    Non-2xx REST response. code and message come from the Discord JSON error body, if any.
+    https://discord.com/developers/docs/reference#error-messages
+    """
+
+    def __init__(self, status: int, method: str, route: str, payload: Any) -> None:
+        self.status = status
+        self.payload = payload
+        self.code = payload.get("code") if isinstance(payload, dict) else None
+        self.message = payload.get("message") if isinstance(payload, dict) else payload
+        super().__init__(f"{method} {route} failed with {status}: {self.message} (code {self.code})")
+
+
+def init_rest(token: str, base_url: str = DISCORD_API_BASE_URL, cache_ttl: float = 0) -> None:
+    """
+    Set the token (and API base URL) used by the REST functions of this module
+
+    :param token: Bot token, with or without the "Bot " prefix
+    :param base_url: API base URL, e.g. a local stand-in
+    :param cache_ttl: seconds GET results are reused for, 0 to disable the response cache.
+                      Other requests to a URL invalidate its cached GET results.
+    """
+    global _token, _base_url, _cache_ttl
+    _token = token if token.startswith("Bot ") else f"Bot {token}"
+    _base_url = base_url
+    _cache_ttl = cache_ttl
+    _cache.clear()
+
+def rest_initialized() -> bool:
+    """
+    :returns: whether init_rest was called
+    """
+    return _token is not None
+
+def _discard_session(session: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop) -> None:
+    # the session of another event loop can only be closed by that loop
+    if loop.is_closed():
+        session.detach() # its connections were dropped with the loop
+    else:
+        asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+def rest_session() -> aiohttp.ClientSession:
+    """
+    Get the process wide pooled REST session, created on first use in the running event loop.
+    Its keep-alive connections, DNS cache and TLS sessions are reused by every request.
+    The session of a previous event loop is closed by that loop (or detached from it if closed).
+
+    :returns: session
+    """
+    global _session, _session_loop, _rate_limiter
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        if _session is not None and not _session.closed:
+            _discard_session(_session, _session_loop)
+        # rate limiter state and in-flight requests are bound to the loop as well
+        _rate_limiter = RouteRateLimiter()
+        _inflight.clear()
+        connector = aiohttp.TCPConnector(limit=REST_CONNECTION_LIMIT, ttl_dns_cache=REST_DNS_CACHE_TTL,
+                                         keepalive_timeout=REST_KEEPALIVE_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": DISCORD_USER_AGENT},
+                                         timeout=aiohttp.ClientTimeout(total=REST_TIMEOUT))
+        _session_loop = loop
+    return _session
+
+async def close_rest_session() -> None:
+    """
+    Close the pooled REST session and its connections
+    """
+    global _session, _session_loop, _rate_limiter
+    if _session is not None and _session_loop is asyncio.get_running_loop():
+        await _session.close()
+    elif _session is not None and not _session.closed:
+        _discard_session(_session, _session_loop)
+    _session = _session_loop = _rate_limiter = None
+
+def rate_limiter() -> RouteRateLimiter:
+    """
+    Get the rate limiter of the pooled REST session (see ratelimit.RouteRateLimiter)
+
+    :returns: rate limiter
+    """
+    rest_session()
+    return _rate_limiter
+
+def rest_stats() -> dict[str, int]:
+    """
+    Get the number of requests sent, and of GETs served by an identical in-flight request or the response cache
+
+    :returns: {"requests": ..., "coalesced": ..., "cache_hits": ...}
+    """
+    return {"requests": _stats["requests"], "coalesced": _stats["coalesced"], "cache_hits": _stats["cache_hits"]}
+
+def _format_route(route: str, route_params: dict[str, Any] | None) -> str:
+    if not route_params:
+        return route
+    return route.format_map({name: quote(str(value), safe="") for name, value in route_params.items()})
+
+def _decode(data: Any, decode: type[Serializable] | None, lazy: bool) -> Any:
+    if decode is None or data is None:
+        return data
+    if isinstance(data, list):
+        return [decode.from_dict(item, lazy) for item in data]
+    return decode.from_dict(data, lazy)
+
+async def request(method: str, route: str, route_params: dict[str, Any] | None = None, payload: Any = None,
+                  query: dict[str, Any] | None = None, decode: type[Serializable] | None = None, lazy: bool = False,
+                  reason: str | None = None) -> Any:
+    """
+    Make a REST API request through the pooled session, within the per-route and global rate limits.
+    Requests wait in their bucket for budget instead of running into a 429; 429s caused by shared resources
+    or the global limit and 502s are retried up to REST_MAX_RETRIES times.
+    Identical GETs (same URL, query and decoding) in flight at the same time are sent once, all callers
+    get the same decoded result (or error): treat it as read-only. See init_rest for the response cache.
+    e.g. await request("GET", "channels/{channel_id}", {"channel_id": channel_id}, decode=Channel)
+
+    :param method: HTTP method
+    :param route: route template relative to the API base URL, with {name} placeholders for route_params
+    :param route_params: values of the route placeholders (snowflakes etc.)
+    :param payload: JSON body
+    :param query: query string parameters
+    :param decode: Serializable class to decode the response (or each item of a list response) into, None for the raw JSON
+    :param lazy: decode nested objects only on first attribute access (see Serializable.from_dict)
+    :param reason: audit log reason (X-Audit-Log-Reason)
+    :returns: decoded response, None for empty responses (204)
+    """
+    url = _base_url + _format_route(route, route_params)
+    if method != "GET":
+        _cache.pop(url, None)
+        return await _send_request(method, url, route, route_params, payload, query, decode, lazy, reason)
+
+    key = (tuple(sorted(query.items())) if query else (), decode, lazy)
+    cached = _cache.get(url, {}).get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        _cache.move_to_end(url)
+        _stats["cache_hits"] += 1
+        return cached[1]
+
+    task = _inflight.get((url, key))
+    if task is not None:
+        _stats["coalesced"] += 1
+        # shielded: a caller giving up does not cancel the request of the others
+        return await asyncio.shield(task)
+
+    task = asyncio.ensure_future(_send_request(method, url, route, route_params, payload, query, decode, lazy, reason))
+    _inflight[(url, key)] = task
+    task.add_done_callback(lambda _: _inflight.pop((url, key), None))
+    result = await asyncio.shield(task)
+
+    if _cache_ttl:
+        _cache.setdefault(url, {})[key] = (time.monotonic() + _cache_ttl, result)
+        _cache.move_to_end(url)
+        if len(_cache) > REST_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+async def _send_request(method: str, url: str, route: str, route_params: dict[str, Any] | None, payload: Any,
+                        query: dict[str, Any] | None, decode: type[Serializable] | None, lazy: bool,
+                        reason: str | None) -> Any:
+    codec = default_codec()
+    headers = {}
+    if _token is not None:
+        headers["Authorization"] = _token
+    if reason is not None:
+        headers["X-Audit-Log-Reason"] = quote(reason, safe=" ")
+    data = None
+    if payload is not None:
+        headers["Content-Type"] = "application/json"
+        data = codec.dumps(payload)
+
+    session = rest_session()
+    for attempt in range(REST_MAX_RETRIES + 1):
+        _stats["requests"] += 1
+        bucket = await _rate_limiter.acquire(method, route, route_params)
+        try:
+            async with session.request(method, url, params=query, data=data, headers=headers) as response:
+                body = await response.read()
+        except BaseException:
+            _rate_limiter.release(bucket)
+            raise
+        result = codec.loads(body) if body and response.content_type == "application/json" else (body.decode() or None)
+        retry_after = None
+        if response.status == 429:
+            # the JSON body is more precise, but 429s from a proxy may only come with the header
+            retry_after = result.get("retry_after") if isinstance(result, dict) else None
+            if retry_after is None:
+                retry_after = float(response.headers.get("Retry-After", REST_DEFAULT_RETRY_AFTER))
+        _rate_limiter.update(bucket, method, route, response.status, response.headers, retry_after)
+
+        if attempt < REST_MAX_RETRIES and (response.status == 429 or response.status == 502):
+            logger.warning("%s %s got %d, retrying (scope %s)", method, route, response.status,
+                           response.headers.get("X-RateLimit-Scope"))
+            if response.status == 429 and response.headers.get("X-RateLimit-Scope") in ("shared", None):
+                await asyncio.sleep(retry_after or 0)
+            elif response.status == 502:
+                await asyncio.sleep(attempt + 1)
+            continue
+        if response.status >= 400:
+            raise DiscordHTTPError(response.status, method, route, result)
+        return _decode(result, decode, lazy)
+
+
+# https://discord.com/developers/docs/resources/channel
+async def get_channel(channel_id: int) -> Channel:
+    return await request("GET", "channels/{channel_id}", {"channel_id": channel_id}, decode=Channel)
+
+async def trigger_typing(channel_id: int) -> None:
+    await request("POST", "channels/{channel_id}/typing", {"channel_id": channel_id})
+
+# https://discord.com/developers/docs/resources/message
+async def get_message(channel_id: int, message_id: int) -> Message:
+    return await request("GET", "channels/{channel_id}/messages/{message_id}",
+                         {"channel_id": channel_id, "message_id": message_id}, decode=Message)
+
+async def get_messages(channel_id: int, limit: int = 50, before: int | None = None,
+                       after: int | None = None) -> list[Message]:
+    """
+    Get the messages of a channel, newest first
+
+    :param channel_id: channel snowflake
+    :param limit: 1-100
+    :param before: get messages before this message snowflake
+    :param after: get messages after this message snowflake
+    :returns: list of messages
+    """
+    query = {"limit": limit}
+    if before is not None:
+        query["before"] = before
+    if after is not None:
+        query["after"] = after
+    return await request("GET", "channels/{channel_id}/messages", {"channel_id": channel_id}, query=query, decode=Message)
+
+async def create_message(channel_id: int, content: str | None = None, reply_to: int | None = None,
+                         **fields: Any) -> Message:
+    """
+    Send a message to a channel
+
+    :param channel_id: channel snowflake
+    :param content: message text
+    :param reply_to: snowflake of the message to reply to
+    :param fields: other JSON params (embeds, allowed_mentions, components, ...)
+    :returns: created message
+    """
+    if content is not None:
+        fields["content"] = content
+    if reply_to is not None:
+        fields["message_reference"] = {"message_id": str(reply_to)}
+    return await request("POST", "channels/{channel_id}/messages", {"channel_id": channel_id}, fields, decode=Message)
+
+async def edit_message(channel_id: int, message_id: int, **fields: Any) -> Message:
+    return await request("PATCH", "channels/{channel_id}/messages/{message_id}",
+                         {"channel_id": channel_id, "message_id": message_id}, fields, decode=Message)
+
+async def delete_message(channel_id: int, message_id: int, reason: str | None = None) -> None:
+    await request("DELETE", "channels/{channel_id}/messages/{message_id}",
+                  {"channel_id": channel_id, "message_id": message_id}, reason=reason)
+
+async def create_reaction(channel_id: int, message_id: int, emoji: str) -> None:
+    """
+    React to a message as the bot
+
+    :param channel_id: channel snowflake
+    :param message_id: message snowflake
+    :param emoji: unicode emoji or name:id of a custom one
+    """
+    await request("PUT", "channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me",
+                  {"channel_id": channel_id, "message_id": message_id, "emoji": emoji})
+
+# https://discord.com/developers/docs/resources/guild
+async def get_guild(guild_id: int, with_counts: bool = False) -> Guild:
+    return await request("GET", "guilds/{guild_id}", {"guild_id": guild_id},
+                         query={"with_counts": "true" if with_counts else "false"}, decode=Guild)
+
+async def get_guild_member(guild_id: int, user_id: int) -> GuildMember:
+    return await request("GET", "guilds/{guild_id}/members/{user_id}", {"guild_id": guild_id, "user_id": user_id},
+                         decode=GuildMember)
+
+async def get_guild_members(guild_id: int, limit: int = 1000, after: int = 0) -> list[GuildMember]:
+    """
+    Get a page of guild members (requires the GUILD_MEMBERS intent), see websockets.request_guild_members
+    to stream all of them through the gateway instead
+
+    :param guild_id: guild snowflake
+    :param limit: 1-1000
+    :param after: highest user snowflake of the previous page
+    :returns: list of members
+    """
+    return await request("GET", "guilds/{guild_id}/members", {"guild_id": guild_id},
+                         query={"limit": limit, "after": after}, decode=GuildMember)
+
+# https://discord.com/developers/docs/events/gateway#get-gateway-bot
+async def get_gateway_bot() -> dict:
+    """
+    Get the recommended shard count and session start limits
+
+    :returns: {"url": ..., "shards": ..., "session_start_limit": {..., "max_concurrency": ...}}
+    """
+    return await request("GET", "gateway/bot")
+
+# https://discord.com/developers/docs/resources/user
+async def get_user(user_id: int) -> User:
+    return await request("GET", "users/{user_id}", {"user_id": user_id}, decode=User)
+
+async def get_current_user() -> User:
+    return await request("GET", "users/@me", decode=User)
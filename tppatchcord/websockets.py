@@ -1,26 +1,57 @@
 import asyncio
-import json
-from typing import Any
+import collections
+import copy
+import itertools
+import logging
+import random
+import time
+import zlib
+from typing import TYPE_CHECKING, Any, AsyncIterator, Iterable
 
 from websockets.asyncio.client import ClientConnection
 from websockets.asyncio.client import connect as ws_connect
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
 
-HELLO_OPCODE = 10
-IDENTIFY_OPCODE = 2
+from tppatchcord.codecs import Codec, default_codec
+from tppatchcord.intents import Intents, events_for_intents, intents_for_events
+from tppatchcord.queues import BoundedQueue, OverflowPolicy, QueueStats
+from tppatchcord.ratelimit import SlidingWindowLimiter
+from tppatchcord.recording import FrameRecorder
+
+if TYPE_CHECKING:
+    from tppatchcord.api_types import GuildMember
+    from tppatchcord.cache import EntityCache
+
+DISPATCH_OPCODE = 0
 HEARTBEAT_OPCODE = 1
+IDENTIFY_OPCODE = 2
+PRESENCE_UPDATE_OPCODE = 3
+VOICE_STATE_UPDATE_OPCODE = 4
+RESUME_OPCODE = 6
+RECONNECT_OPCODE = 7
+REQUEST_GUILD_MEMBERS_OPCODE = 8
+INVALID_SESSION_OPCODE = 9
+HELLO_OPCODE = 10
+HEARTBEAT_ACK_OPCODE = 11
 
 DISCORD_API_VERSION = 10
 DISCORD_API_BASE_URL = f"https://discord.com/api/v{DISCORD_API_VERSION}/"
 
 DISCORD_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:129.0) Gecko/20100101 Firefox/129.0"
 
-GATEWAY_URL = f"wss://gateway.discord.gg/?v={DISCORD_API_VERSION}&encoding=json"
+GATEWAY_BASE_URL = "wss://gateway.discord.gg/"
+GATEWAY_URL = f"{GATEWAY_BASE_URL}?v={DISCORD_API_VERSION}&encoding=json"
+GATEWAY_COMPRESS_PARAM = "&compress=zlib-stream"
 
-INTENTS = 33280
+ZLIB_SUFFIX = b"\x00\x00\xff\xff"
 
+# used when neither intents nor events are configured
+INTENTS = Intents.GUILD_MESSAGES | Intents.MESSAGE_CONTENT
+
+# template of the IDENTIFY payload, see GatewayConnection.configure for its options
 IDENTIFY_PAYLOAD = {
     "token": None,
-    "intents": INTENTS,
+    "intents": int(INTENTS),
     "properties": {
         "$os": "windows",
         "$browser": "disco",
@@ -29,100 +60,863 @@ IDENTIFY_PAYLOAD = {
 }
 
 HEARTBEAT_SKEW = 2000
+LATENCY_SAMPLES = 20 # heartbeat round-trips kept for the rolling latency statistic
+
+# https://discord.com/developers/docs/events/gateway#rate-limiting
+GATEWAY_SEND_LIMIT = 120
+GATEWAY_SEND_PERIOD = 60
+GATEWAY_SEND_MARGIN = 1 # seconds added to the send window, absorbing network jitter between our clock and the gateway's
+CONTROL_SEND_RESERVE = 5 # sends per period only heartbeats, identify and resume may use
+BULK_SEND_RESERVE = 20 # further sends per period bulk traffic leaves to regular messages
+# deferred behind regular messages and coalesced while waiting
+BULK_OPCODES = {PRESENCE_UPDATE_OPCODE, VOICE_STATE_UPDATE_OPCODE, REQUEST_GUILD_MEMBERS_OPCODE}
+IDENTIFY_INTERVAL = 5 # seconds between two identifies of the same max_concurrency bucket
+AUTO_SHARD_COUNT = 0 # main_loop(shard_count=AUTO_SHARD_COUNT) uses the shard count recommended by Discord
 WS_MAX_SIZE = 2**22
+GATEWAY_OPEN_TIMEOUT = 10 # seconds for the opening handshake of a connection
 
-_global_context = {
-    "heartbeat_interval": None,
-    "sequence_number": None
-}
+# https://discord.com/developers/docs/topics/opcodes-and-status-codes#gateway-gateway-close-event-codes
+RESUME_CLOSE_CODE = 4000
+INVALID_SESSION_CLOSE_CODES = {4007, 4009}
+FATAL_CLOSE_CODES = {4004, 4010, 4011, 4012, 4013, 4014}
+RECONNECT_BACKOFF_MIN = 1
+RECONNECT_BACKOFF_MAX = 60
+
+# dispatch events always decoded for the session bookkeeping, even if not subscribed to
+SESSION_EVENTS = {"READY"}
+MEMBERS_CHUNK_EVENT = "GUILD_MEMBERS_CHUNK"
+MEMBERS_CHUNK_TIMEOUT = 30 # seconds to wait for the next chunk of a guild member request
 
-_message_queue = asyncio.Queue()
-_event_queue = asyncio.Queue()
+logger = logging.getLogger(__name__)
 
-def form_message(opcode: int, payload: Any):
+
+def form_message(opcode: int, payload: Any, codec: Codec | None = None):
     """
     Form a 'send event' message using given opcode and payload.
     https://discord.com/developers/docs/topics/gateway-events#send-events
 
     :param opcode: opcode
     :param payload: payload
-    :returns: JSON event message
+    :param codec: Gateway payload codec, defaults to codecs.default_codec()
+    :returns: encoded event message
+    """
+    return (codec or default_codec()).dumps({"op": opcode, "d": payload})
+
+async def fetch_gateway_bot(token: str) -> dict:
+    """
+    Get the recommended shard count and session start limits (GET /gateway/bot)
+    https://discord.com/developers/docs/events/gateway#get-gateway-bot
+
+    Sent through the pooled REST session, within its rate limits (see rest.request).
+
+    :param token: Bot token, REST requests are initialized with it unless init_rest was called
+    :returns: {"url": ..., "shards": ..., "session_start_limit": {..., "max_concurrency": ...}}
+    """
+    from tppatchcord import rest # rest depends on this module's constants
+
+    if not rest.rest_initialized():
+        rest.init_rest(token)
+    return await rest.get_gateway_bot()
+
+def shard_for_guild(guild_id: int, shard_count: int) -> int:
+    """
+    Get the ID of the shard receiving the events of a guild
+
+    :param guild_id: guild snowflake
+    :param shard_count: total number of shards
+    :returns: shard ID
+    """
+    return (int(guild_id) >> 22) % shard_count
+
+def gateway_url(codec: Codec, compress: bool = False, base_url: str = GATEWAY_BASE_URL) -> str:
+    """
+    Form the gateway URL for given codec encoding and transport compression
+
+    :param codec: Gateway payload codec
+    :param compress: Enable zlib-stream transport compression
+    :param base_url: Gateway base URL, e.g. the resume_gateway_url of a session
+    :returns: gateway URL
+    """
+    url = f"{base_url}?v={DISCORD_API_VERSION}&encoding={codec.encoding}"
+    return url + GATEWAY_COMPRESS_PARAM if compress else url
+
+
+class IdentifyLimiter:
+    """
+    Spaces out identifies of shards sharing a max_concurrency bucket (shard_id % max_concurrency)
+    by IDENTIFY_INTERVAL, while shards of different buckets identify concurrently.
+    https://discord.com/developers/docs/events/gateway#sharding-max-concurrency
+    """
+
+    def __init__(self, max_concurrency: int = 1) -> None:
+        self.max_concurrency = max_concurrency
+        self._locks = {}
+        self._last_identify = {}
+
+    async def wait(self, shard_id: int) -> None:
+        """
+        Wait until shard_id may identify
+
+        :param shard_id: shard ID
+        """
+        bucket = shard_id % self.max_concurrency
+        lock = self._locks.setdefault(bucket, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_running_loop()
+            last_identify = self._last_identify.get(bucket)
+            if last_identify is not None and last_identify + IDENTIFY_INTERVAL > loop.time():
+                await asyncio.sleep(last_identify + IDENTIFY_INTERVAL - loop.time())
+            self._last_identify[bucket] = loop.time()
+
+
+class GatewayConnection:
+    """
+    A single gateway connection owning its queues, heartbeat and session state and settings.
+    Many connections can run in one process (and event loop); main_loop()/next_event()/... are thin
+    wrappers over a default instance.
+    """
+
+    def __init__(self, token: str | None = None, event_queue: BoundedQueue | None = None, **settings: Any) -> None:
+        """
+        :param token: User (bot) identification token
+        :param event_queue: Event queue to share with other connections (e.g. shards), a new one by default
+        :param settings: see configure()
+        """
+        self.event_queue = event_queue if event_queue is not None else BoundedQueue()
+        self.message_queue = BoundedQueue()
+
+        self.heartbeat_interval = None
+        self.sequence_number = None
+        self.session_id = None
+        self.resume_gateway_url = None
+        self.inflator = None
+        self.heartbeat_acked = True
+        self.last_heartbeat_sent = None
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.send_limiter = SlidingWindowLimiter(GATEWAY_SEND_LIMIT, GATEWAY_SEND_PERIOD + GATEWAY_SEND_MARGIN)
+        # messages taken from message_queue waiting for send budget: [payload, receipts, queued_at]
+        self.send_lane = collections.deque()
+        self.bulk_send_lane = collections.deque()
+        self.coalesced_messages = 0
+        # nonce -> queue of the GUILD_MEMBERS_CHUNK payloads answering a request_guild_members() call
+        self.member_requests = {}
+        self._member_request_nonces = itertools.count()
+
+        self.configure(token, **settings)
+
+    def configure(self, token: str | None = None, codec: Codec | None = None, compress: bool = False,
+                  events: Iterable[str] | None = None, event_queue_size: int = 0,
+                  overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK, droppable_events: Iterable[str] = (),
+                  spill_dir: str | None = None, message_queue_size: int = 0, shard: tuple[int, int] | None = None,
+                  identify_limiter: IdentifyLimiter | None = None, intents: Intents | None = None,
+                  large_threshold: int | None = None, presence: dict | None = None,
+                  gateway_base_url: str = GATEWAY_BASE_URL, recorder: FrameRecorder | None = None,
+                  entity_cache: "EntityCache | None" = None) -> None:
+        """
+        Set the connection settings. Queues are reconfigured in place, so consumers already waiting on them keep working
+
+        :param token: User (bot) identification token
+        :param codec: Gateway payload codec (codecs.ETF_CODEC selects encoding=etf, slower than json),
+                      defaults to the fastest available JSON one (see codecs.default_codec)
+        :param compress: Enable zlib-stream transport compression
+        :param events: Dispatch event names (e.g. "MESSAGE_CREATE") to pass to next_event(), None for all
+        :param event_queue_size: Maximum number of events waiting for next_event(), 0 for unbounded
+        :param overflow_policy: What read_handler does when the event queue is full (see queues.OverflowPolicy)
+        :param droppable_events: Event names which may be dropped with OverflowPolicy.DROP_BY_TYPE
+        :param spill_dir: Directory for the spill file of OverflowPolicy.SPILL
+        :param message_queue_size: Maximum number of messages waiting to be sent, send_event_message() blocks when full
+        :param shard: (shard_id, shard_count) sent with IDENTIFY, events of a sharded connection are tagged with "shard_id"
+        :param identify_limiter: Limiter shared by the shards of a bot, respecting max_concurrency
+        :param intents: Gateway intents, by default the minimal ones for events (see intents.intents_for_events),
+                        INTENTS if events is None
+        :param large_threshold: Member count (50-250) above which GUILD_CREATE omits offline members
+        :param presence: Initial presence, an op 3 payload: {"since": ..., "activities": [...], "status": ..., "afk": ...}
+        :param gateway_base_url: Gateway to connect to when there is no session to resume, e.g. a fakegateway.FakeGateway url
+        :param recorder: Recorder of the raw frames received (see recording.FrameRecorder), shareable between shards
+        :param entity_cache: Cache fed with the CACHE_EVENTS received, whether subscribed to or not (see cache.EntityCache),
+                             shareable between shards. Derived intents include Intents.GUILDS then.
+        """
+        self.token = token
+        self.shard = shard
+        self.identify_limiter = identify_limiter
+        self.codec = codec or default_codec()
+        self.compress = compress
+        self.gateway_base_url = gateway_base_url
+        self.recorder = recorder
+        self.entity_cache = entity_cache
+        self.events = frozenset(events) if events is not None else None
+        if intents is None:
+            intents = intents_for_events(self.events) if self.events is not None else INTENTS
+            if entity_cache is not None:
+                intents |= Intents.GUILDS
+        elif entity_cache is not None and Intents.GUILDS not in intents:
+            logger.warning("Intents %r lack GUILDS, the entity cache will stay empty", intents)
+        elif self.events is not None and not self.events <= events_for_intents(intents):
+            logger.warning("Intents %r do not enable subscribed events %s", intents,
+                           sorted(self.events - events_for_intents(intents)))
+        self.intents = intents
+
+        self.identify_payload = copy.deepcopy(IDENTIFY_PAYLOAD)
+        self.identify_payload["intents"] = int(intents)
+        if shard is not None:
+            self.identify_payload["shard"] = list(shard)
+        if large_threshold is not None:
+            self.identify_payload["large_threshold"] = large_threshold
+        if presence is not None:
+            self.identify_payload["presence"] = presence
+        self.event_queue.configure(event_queue_size, overflow_policy, droppable_events, spill_dir)
+        self.message_queue.configure(message_queue_size)
+        self.invalidate_session()
+
+    def form_message(self, opcode: int, payload: Any):
+        """
+        Form a 'send event' message encoded with the connection's codec (see form_message)
+
+        :param opcode: opcode
+        :param payload: payload
+        :returns: encoded event message
+        """
+        return form_message(opcode, payload, self.codec)
+
+    async def next_event(self) -> dict:
+        """
+        Get next event to process.
+        Used as in XNextEvent from Xlib:
+        https://tronche.com/gui/x/xlib/event-handling/manipulating-event-queue/XNextEvent.html
+
+        :returns: raw dict processable with process_event_payload
+        """
+        return await self.event_queue.get()
+
+    async def next_events(self, max_items: int = 100, timeout: float | None = None) -> list[dict]:
+        """
+        Get a batch of events to process.
+        Waits for at least one event, then drains up to max_items queued events without suspending again.
+
+        :param max_items: maximum number of events to return
+        :param timeout: seconds to wait for the first event, None to wait forever
+        :returns: list of raw dicts processable with process_event_payloads (empty on timeout)
+        """
+        try:
+            first = await asyncio.wait_for(self.event_queue.get(), timeout) if timeout is not None else await self.event_queue.get()
+        except asyncio.TimeoutError:
+            return []
+
+        events = [first]
+        while len(events) < max_items and not self.event_queue.empty():
+            events.append(self.event_queue.get_nowait())
+        return events
+
+    async def send_event_message(self, payload: dict) -> asyncio.Future:
+        """
+        Send an event message to the Gateway API, within the gateway send rate limit.
+        e.g. await connection.send_event_message({"op": 3, "d": {...}}) # presence update
+        Bulk messages (presence, voice state and guild member requests) are sent after other messages
+        and coalesced with pending ones of the same kind (see write_handler).
+
+        :param payload: payload
+        :returns: receipt future resolving to the seconds the message was held back before being sent
+        """
+        receipt = asyncio.get_running_loop().create_future()
+        await self.message_queue.put((payload, receipt, time.perf_counter()))
+        return receipt
+
+    def queue_stats(self) -> dict[str, QueueStats]:
+        """
+        Get size and high-water-mark statistics of the event and message queues
+
+        :returns: {"events": ..., "messages": ...}
+        """
+        return {"events": self.event_queue.stats(), "messages": self.message_queue.stats()}
+
+    async def request_guild_members(self, guild_id: int, query: str = "", limit: int = 0,
+                                    user_ids: Iterable[int] | None = None, presences: bool = False,
+                                    lazy: bool = False, timeout: float = MEMBERS_CHUNK_TIMEOUT) -> AsyncIterator["GuildMember"]:
+        """
+        Request guild members (op 8) and yield them as their GUILD_MEMBERS_CHUNK events arrive.
+        Chunks are matched by nonce and routed here instead of next_event(). At most one chunk waits besides
+        the one being yielded: reading from the gateway pauses until the previous chunk is taken.
+        Requests may run concurrently, they are sent within the send rate limit like any bulk message.
+        https://discord.com/developers/docs/events/gateway-events#request-guild-members
+        e.g. async for member in connection.request_guild_members(guild_id): ...
+
+        :param guild_id: guild snowflake (the guild must be on this connection's shard)
+        :param query: username prefix, "" with limit 0 for all members (requires the GUILD_MEMBERS intent)
+        :param limit: maximum number of members, 0 for no limit
+        :param user_ids: snowflakes of the members to get instead of query
+        :param presences: also request presences (requires the GUILD_PRESENCES intent)
+        :param lazy: decode nested objects only on first attribute access (see Serializable.from_dict)
+        :param timeout: seconds to wait for each chunk before raising asyncio.TimeoutError
+        :returns: async iterator of members
+        """
+        # chunks are reassembled raw, the decode layer is only imported by gateway users requesting members
+        from tppatchcord.api_types import GuildMember
+
+        nonce = str(next(self._member_request_nonces))
+        request = {"guild_id": str(guild_id), "limit": limit, "presences": presences, "nonce": nonce}
+        if user_ids is not None:
+            request["user_ids"] = [str(user_id) for user_id in user_ids]
+        else:
+            request["query"] = query
+
+        chunks = asyncio.Queue(maxsize=1)
+        self.member_requests[nonce] = chunks
+        try:
+            await self.send_event_message({"op": REQUEST_GUILD_MEMBERS_OPCODE, "d": request})
+            while True:
+                chunk = await asyncio.wait_for(chunks.get(), timeout)
+                for member in chunk["members"]:
+                    yield GuildMember.from_dict(member, lazy)
+                if chunk["chunk_index"] >= chunk["chunk_count"] - 1: # chunks are sent in order
+                    return
+        finally:
+            self.member_requests.pop(nonce, None)
+            while not chunks.empty(): # unblocks the read path if iteration stopped early
+                chunks.get_nowait()
+
+    async def fetch_guild_members(self, guild_id: int, query: str = "", limit: int = 0,
+                                  user_ids: Iterable[int] | None = None, presences: bool = False,
+                                  lazy: bool = False, timeout: float = MEMBERS_CHUNK_TIMEOUT) -> list["GuildMember"]:
+        """
+        Request guild members and wait for all of their chunks (see request_guild_members)
+
+        :returns: list of members
+        """
+        return [member async for member in self.request_guild_members(guild_id, query, limit, user_ids, presences, lazy, timeout)]
+
+    async def receive_frame(self, websocket: ClientConnection) -> bytes:
+        """
+        Receive the next raw gateway frame.
+        With zlib-stream compression enabled, frames are accumulated until the Z_SYNC_FLUSH suffix
+        and inflated with the connection's long-lived decompressor.
+
+        :param websocket: Connected websocket
+        :returns: raw (decompressed) frame
+        """
+        # raw bytes are handed to the codec as is, skipping the UTF-8 decoding to str
+        data = await websocket.recv(decode=False)
+        if self.inflator is None:
+            return data
+
+        if not data.endswith(ZLIB_SUFFIX):
+            buffer = bytearray(data)
+            while not buffer.endswith(ZLIB_SUFFIX):
+                buffer.extend(await websocket.recv(decode=False))
+            data = buffer
+        return self.inflator.decompress(data)
+
+    async def receive_payload(self, websocket: ClientConnection) -> Any:
+        """
+        Receive and decode the next gateway payload
+
+        :param websocket: Connected websocket
+        :returns: decoded payload
+        """
+        return self.codec.loads(await self.receive_frame(websocket))
+
+    async def init_connection(self, websocket: ClientConnection) -> None:
+        """
+        Initializes websocket connection: gets the heartbeat interval from HELLO for later use, then resumes
+        the previous session if there is one or identifies the client otherwise
+
+        :param websocket: Connected websocket to send messages to
+        """
+        ret = await self.receive_payload(websocket)
+
+        if ret["op"] != HELLO_OPCODE: raise Exception("Unexpected reply")
+
+        self.heartbeat_interval = (ret["d"]["heartbeat_interval"] - HEARTBEAT_SKEW) / 1000
+
+        # control messages bypass the lanes of write_handler but still count against the send limit
+        if self.session_id is not None and self.sequence_number is not None:
+            await self.send_limiter.acquire()
+            await websocket.send(self.form_message(RESUME_OPCODE, {
+                "token": self.token,
+                "session_id": self.session_id,
+                "seq": self.sequence_number
+            }))
+        else:
+            if self.identify_limiter is not None:
+                await self.identify_limiter.wait(self.shard[0] if self.shard else 0)
+            self.identify_payload["token"] = self.token
+            await self.send_limiter.acquire()
+            await websocket.send(self.form_message(IDENTIFY_OPCODE, self.identify_payload))
+
+    def latency(self) -> float | None:
+        """
+        Get the gateway round-trip latency: mean of the last LATENCY_SAMPLES heartbeat/ACK round-trips
+
+        :returns: latency in seconds, None before the first ACK
+        """
+        return sum(self.latencies) / len(self.latencies) if self.latencies else None
+
+    async def send_heartbeat(self, websocket: ClientConnection) -> None:
+        """
+        Send a heartbeat (op 1) now and start waiting for its ACK
+
+        :param websocket: Connected websocket
+        """
+        await self.send_limiter.acquire()
+        self.heartbeat_acked = False
+        self.last_heartbeat_sent = time.perf_counter()
+        await websocket.send(self.form_message(HEARTBEAT_OPCODE, self.sequence_number))
+
+    async def heartbeat(self, websocket: ClientConnection) -> None:
+        """
+        Infinite heartbeat (op 1) loop to maintain websocket connection.
+        The first beat is jittered as required by the gateway. If the previous heartbeat was not ACKed (op 11)
+        when the next one is due, the connection is considered dead (zombie) and closed to be resumed.
+
+        :param websocket: Connected websocket
+        """
+        self.heartbeat_acked = True
+        await asyncio.sleep(self.heartbeat_interval * random.random())
+        while True:
+            if not self.heartbeat_acked:
+                logger.warning("Heartbeat ACK missed, reconnecting")
+                await websocket.close(code=RESUME_CLOSE_CODE)
+                return
+            await self.send_heartbeat(websocket)
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def invalidate_session(self) -> None:
+        """
+        Forget the current session, the next connection will identify instead of resuming
+        """
+        self.session_id = None
+        self.resume_gateway_url = None
+        self.sequence_number = None
+
+    def restore_session(self, session_id: str, resume_gateway_url: str, sequence_number: int) -> None:
+        """
+        Resume a session started elsewhere (e.g. by a crashed process) on the next connection
+
+        :param session_id: session_id from READY
+        :param resume_gateway_url: resume_gateway_url from READY
+        :param sequence_number: last sequence number received
+        """
+        self.session_id = session_id
+        self.resume_gateway_url = resume_gateway_url
+        self.sequence_number = sequence_number
+
+    async def handle_control_payload(self, websocket: ClientConnection, payload: dict) -> bool:
+        """
+        Track the session state from READY and handle the control opcodes
+        (HEARTBEAT requested by the gateway, HEARTBEAT_ACK, RECONNECT, INVALID_SESSION)
+
+        :param websocket: Connected websocket
+        :param payload: decoded payload
+        :returns: True if the connection was closed and has to be reestablished
+        """
+        opcode = payload["op"]
+        if opcode == HEARTBEAT_ACK_OPCODE:
+            self.heartbeat_acked = True
+            if self.last_heartbeat_sent is not None:
+                self.latencies.append(time.perf_counter() - self.last_heartbeat_sent)
+        elif opcode == HEARTBEAT_OPCODE:
+            await self.send_heartbeat(websocket)
+        elif opcode == DISPATCH_OPCODE and payload["t"] == "READY":
+            self.session_id = payload["d"]["session_id"]
+            self.resume_gateway_url = payload["d"]["resume_gateway_url"]
+        elif opcode == RECONNECT_OPCODE or opcode == INVALID_SESSION_OPCODE:
+            if opcode == INVALID_SESSION_OPCODE and not payload["d"]: # d tells whether the session is resumable
+                self.invalidate_session()
+            # any code but 1000/1001 keeps the session resumable
+            await websocket.close(code=RESUME_CLOSE_CODE)
+            return True
+        return False
+
+    async def read_handler(self, websocket: ClientConnection) -> None:
+        """
+        Handles incoming websocket messages for next_event() to process.
+        Dispatch events not in the subscription set are dropped, if possible before
+        the frame is fully decoded. Control opcodes (no event name) always pass through.
+        With a recorder, every raw frame is recorded before filtering. With an entity cache,
+        CACHE_EVENTS are decoded and applied to it before filtering.
+        Returns when the connection is closed.
+
+        :param websocket: Connected websocket
+        """
+        codec = self.codec
+        events = self.events
+        shard_id = self.shard[0] if self.shard else None
+        recorder = self.recorder
+        entity_cache = self.entity_cache
+        cache_events = entity_cache.events if entity_cache is not None else frozenset()
+        # events decoded even if not subscribed to
+        always_decoded = SESSION_EVENTS | cache_events
+        try:
+            while True:
+                frame = await self.receive_frame(websocket)
+                if recorder is not None:
+                    recorder.write(frame, shard_id)
+
+                if events is not None and codec.peek is not None:
+                    peeked = codec.peek(frame)
+                    if (peeked is not None and peeked[0] is not None and peeked[0] not in events and peeked[0] not in always_decoded
+                            and not (peeked[0] == MEMBERS_CHUNK_EVENT and self.member_requests)):
+                        if peeked[1] is not None:
+                            self.sequence_number = peeked[1]
+                        continue
+
+                payload = codec.loads(frame)
+                if payload.get("s") is not None:
+                    self.sequence_number = payload["s"]
+                if await self.handle_control_payload(websocket, payload):
+                    return
+                if shard_id is not None:
+                    payload["shard_id"] = shard_id
+                if payload.get("t") in cache_events:
+                    try:
+                        # decoded once, process_event_payload returns the event the cache was fed with
+                        payload = entity_cache.process_payload(payload)
+                    except Exception:
+                        logger.exception("Failed to decode %s event for the entity cache", payload["t"])
+                if payload.get("t") == MEMBERS_CHUNK_EVENT and payload["d"].get("nonce") in self.member_requests:
+                    await self._route_members_chunk(payload["d"])
+                    continue
+                if events is not None and payload.get("t") is not None and payload["t"] not in events:
+                    continue
+                await self.event_queue.put(payload)
+        except ConnectionClosed:
+            return
+
+    async def _route_members_chunk(self, chunk: dict) -> None:
+        # waits for the requester to take the previous chunk (backpressure), unless it stopped consuming
+        nonce = chunk["nonce"]
+        try:
+            await asyncio.wait_for(self.member_requests[nonce].put(chunk), MEMBERS_CHUNK_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Guild member request %s is not consumed, dropping its chunks", nonce)
+            self.member_requests.pop(nonce, None)
+
+    def _coalesce_key(self, payload: dict) -> Any:
+        if payload["op"] == PRESENCE_UPDATE_OPCODE: # only the latest presence matters
+            return PRESENCE_UPDATE_OPCODE
+        if payload["op"] == VOICE_STATE_UPDATE_OPCODE: # only the latest voice state of a guild matters
+            return VOICE_STATE_UPDATE_OPCODE, payload["d"].get("guild_id")
+        return payload["op"], self.codec.dumps(payload["d"]) # identical requests
+
+    def _enqueue_message(self, message: tuple[dict, asyncio.Future, float]) -> None:
+        payload, receipt, queued_at = message
+        if payload.get("op") not in BULK_OPCODES:
+            self.send_lane.append([payload, [receipt], queued_at])
+            return
+
+        key = self._coalesce_key(payload)
+        for pending in self.bulk_send_lane:
+            if self._coalesce_key(pending[0]) == key:
+                pending[0] = payload
+                pending[1].append(receipt)
+                self.coalesced_messages += 1
+                return
+        self.bulk_send_lane.append([payload, [receipt], queued_at])
+
+    async def write_handler(self, websocket: ClientConnection):
+        """
+        Handles messages from send_event_message() and sends them to the gateway within the send rate limit.
+        CONTROL_SEND_RESERVE sends per period are left for heartbeats/identify/resume. Bulk messages are
+        only sent while no other message is waiting and BULK_SEND_RESERVE more sends are left; while waiting
+        for budget they are coalesced with newer messages of the same kind.
+        Returns when the connection is closed, a message whose send failed is kept at the front of its lane
+        for the next connection. Receipts of messages the codec cannot encode fail with its exception.
+
+        :param websocket: Connected websocket
+        """
+        while True:
+            if not self.send_lane and not self.bulk_send_lane:
+                self._enqueue_message(await self.message_queue.get())
+            while not self.message_queue.empty():
+                self._enqueue_message(self.message_queue.get_nowait())
+
+            if self.send_lane:
+                lane, reserve = self.send_lane, CONTROL_SEND_RESERVE
+            else:
+                lane, reserve = self.bulk_send_lane, CONTROL_SEND_RESERVE + BULK_SEND_RESERVE
+
+            if not self.send_limiter.try_acquire(reserve):
+                # wait for budget, still accepting (and coalescing) new messages meanwhile
+                try:
+                    self._enqueue_message(await asyncio.wait_for(self.message_queue.get(), self.send_limiter.delay(reserve)))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            message = lane.popleft()
+            payload, receipts, queued_at = message
+            try:
+                frame = self.codec.dumps(payload)
+            except Exception as e: # not encodable, retrying would block the lane
+                for receipt in receipts:
+                    if not receipt.done():
+                        receipt.set_exception(e)
+                continue
+            try:
+                await websocket.send(frame)
+            except ConnectionClosed:
+                lane.appendleft(message) # not sent, the next connection sends it
+                return
+            held_back = time.perf_counter() - queued_at
+            for receipt in receipts:
+                if not receipt.done():
+                    receipt.set_result(held_back)
+
+    async def run_connection(self, url: str) -> int | None:
+        """
+        Open and initialize a single websocket connection, then run heartbeat, read_handler and write_handler
+        until it is closed
+
+        :param url: Gateway URL
+        :returns: close code of the connection
+        """
+        # one inflator per connection: zlib-stream keeps its compression context for the whole connection
+        self.inflator = zlib.decompressobj() if self.compress else None
+        # the send limit applies per connection
+        self.send_limiter = SlidingWindowLimiter(GATEWAY_SEND_LIMIT, GATEWAY_SEND_PERIOD + GATEWAY_SEND_MARGIN)
+        async with ws_connect(url, max_size=WS_MAX_SIZE, open_timeout=GATEWAY_OPEN_TIMEOUT) as websocket:
+            await self.init_connection(websocket)
+            tasks = [asyncio.create_task(self.heartbeat(websocket)), asyncio.create_task(self.write_handler(websocket))]
+            try:
+                await self.read_handler(websocket)
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return websocket.close_code
+
+    async def run(self) -> None:
+        """
+        Main loop which opens and initializes the websocket connection. Launches heartbeat, read_handler and write_handler.
+        Reconnects with exponential backoff when the connection drops or cannot be opened,
+        resuming the session (op 6) when possible. Closes the spill file of the event queue when it ends.
+        """
+        backoff = RECONNECT_BACKOFF_MIN
+        try:
+            while True:
+                base_url = self.resume_gateway_url.rstrip("/") + "/" if self.resume_gateway_url else self.gateway_base_url
+                try:
+                    close_code = await self.run_connection(gateway_url(self.codec, self.compress, base_url))
+                except (ConnectionClosed, InvalidHandshake, OSError, TimeoutError) as e:
+                    # dropped connections, and handshakes refused (e.g. 5xx), failed or timed out
+                    logger.warning("Gateway connection failed: %r", e)
+                    close_code = None
+                else:
+                    backoff = RECONNECT_BACKOFF_MIN
+
+                if close_code in FATAL_CLOSE_CODES:
+                    raise Exception(f"Gateway closed the connection with code {close_code}")
+                if close_code in INVALID_SESSION_CLOSE_CODES:
+                    self.invalidate_session()
+
+                logger.info("Reconnecting in %.1fs (close code %s)", backoff, close_code)
+                await asyncio.sleep(backoff * random.uniform(1, 1.5))
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+        except asyncio.CancelledError:
+            return
+        finally:
+            self.event_queue.close()
+
+
+_default_connection: GatewayConnection | None = None
+_shard_connections: dict[int, GatewayConnection] = {}
+
+def default_connection() -> GatewayConnection:
+    """
+    Get the connection used by main_loop(), next_event(), next_events(), send_event_message() and queue_stats().
+    It is created on first use, so its queues bind to the event loop using them
+
+    :returns: default connection
     """
-    return json.dumps({"op": opcode, "d": payload})
+    global _default_connection
+    if _default_connection is None:
+        _default_connection = GatewayConnection()
+    return _default_connection
 
 async def next_event() -> dict:
     """
-    Get next event to process.
-    Used as in XNextEvent from Xlib:
-    https://tronche.com/gui/x/xlib/event-handling/manipulating-event-queue/XNextEvent.html
+    Get next event to process from the default connection (see GatewayConnection.next_event)
 
     :returns: raw dict processable with process_event_payload
     """
-    return await _event_queue.get()
+    return await default_connection().next_event()
 
-async def send_event_message(payload: dict) -> None:
+async def next_events(max_items: int = 100, timeout: float | None = None) -> list[dict]:
     """
-    Send an event message to the Gateway API
-    e.g. await send_event_message({"op": 10, "d": None}) # heartbeat
+    Get a batch of events to process from the default connection (see GatewayConnection.next_events)
+
+    :param max_items: maximum number of events to return
+    :param timeout: seconds to wait for the first event, None to wait forever
+    :returns: list of raw dicts processable with process_event_payloads (empty on timeout)
+    """
+    return await default_connection().next_events(max_items, timeout)
+
+async def send_event_message(payload: dict) -> asyncio.Future:
+    """
+    Send an event message to the Gateway API through the default connection (see GatewayConnection.send_event_message)
+    e.g. await send_event_message({"op": 3, "d": {...}}) # presence update
 
     :param payload: payload
+    :returns: receipt future resolving to the seconds the message was held back before being sent
     """
-    await _message_queue.put(payload)
+    return await default_connection().send_event_message(payload)
 
-async def init_connection(websocket: ClientConnection, token: str) -> None:
+def latency() -> float | None:
     """
-    Initializes websocket connection, identifies the client and gets the heartbeat interval for later use
+    Get the gateway round-trip latency of the default connection (see GatewayConnection.latency)
 
-    :param websocket: Connected websocket to send messages to
-    :param token: User (bot) identification token
+    :returns: latency in seconds, None before the first ACK
+    """
+    return default_connection().latency()
+
+def queue_stats() -> dict[str, QueueStats]:
+    """
+    Get size and high-water-mark statistics of the default connection's event and message queues
+
+    :returns: {"events": ..., "messages": ...}
+    """
+    return default_connection().queue_stats()
+
+def guild_connection(guild_id: int) -> GatewayConnection:
     """
-    IDENTIFY_PAYLOAD["token"] = token
-    await websocket.send(form_message(IDENTIFY_OPCODE, IDENTIFY_PAYLOAD))
-    ret = json.loads(await websocket.recv())
+    Get the connection receiving the events of a guild: its shard connection started by main_loop,
+    the default connection if not sharded
 
-    if ret["op"] != HELLO_OPCODE: raise Exception("Unexpected reply")
+    :param guild_id: guild snowflake
+    :returns: connection
+    """
+    connection = default_connection()
+    if not _shard_connections:
+        return connection
+    return _shard_connections[shard_for_guild(guild_id, connection.shard[1])]
 
-    _global_context["heartbeat_interval"] = (ret["d"]["heartbeat_interval"] - HEARTBEAT_SKEW) / 1000
+def request_guild_members(guild_id: int, query: str = "", limit: int = 0, user_ids: Iterable[int] | None = None,
+                          presences: bool = False, lazy: bool = False,
+                          timeout: float = MEMBERS_CHUNK_TIMEOUT) -> AsyncIterator["GuildMember"]:
+    """
+    Request guild members through the guild's connection (see GatewayConnection.request_guild_members)
+    e.g. async for member in request_guild_members(guild_id): ...
 
+    :returns: async iterator of members
+    """
+    return guild_connection(guild_id).request_guild_members(guild_id, query, limit, user_ids, presences, lazy, timeout)
 
-async def heartbeat(websocket: ClientConnection) -> None:
+async def fetch_guild_members(guild_id: int, query: str = "", limit: int = 0, user_ids: Iterable[int] | None = None,
+                              presences: bool = False, lazy: bool = False,
+                              timeout: float = MEMBERS_CHUNK_TIMEOUT) -> list["GuildMember"]:
     """
-    Infinite heartbeat (op 10) loop to maintain websocket connection
+    Request guild members through the guild's connection and wait for all of their chunks
+    (see GatewayConnection.fetch_guild_members)
 
-    :param websocket: Connected websocket
+    :returns: list of members
     """
-    while True:
-        await websocket.send(json.dumps({"op": HEARTBEAT_OPCODE, "d": _global_context["sequence_number"]}))
-        await asyncio.sleep(_global_context["heartbeat_interval"])
+    return await guild_connection(guild_id).fetch_guild_members(guild_id, query, limit, user_ids, presences, lazy, timeout)
 
-async def read_handler(websocket: ClientConnection) -> None:
+def shard_connections() -> dict[int, GatewayConnection]:
     """
-    Handles incoming websocket messages for next_event() to process
+    Get the shard connections started by main_loop
 
-    :param websocket: Connected websocket
+    :returns: shard_id -> connection mapping
     """
-    async for message in websocket:
-        await _event_queue.put(json.loads(message))
+    return dict(_shard_connections)
 
-async def write_handler(websocket: ClientConnection):
+def shard_connection(shard_id: int) -> GatewayConnection:
     """
-    Handles messages from send_event_message() and sends them to the gateway
+    Get the connection of a shard started by main_loop, e.g. to send guild specific messages:
+    await shard_connection(shard_for_guild(guild_id, shard_count)).send_event_message(...)
 
-    :param websocket: Connected websocket
+    :param shard_id: shard ID
+    :returns: shard connection
     """
-    while True:
-        message = await _message_queue.get()
-        await websocket.send(json.dumps(message))
+    return _shard_connections[shard_id]
 
-async def main_loop(token: str) -> None:
+async def main_loop(token: str, shard_count: int | None = None, shard_ids: Iterable[int] | None = None,
+                    sessions: dict[int, tuple[str, str, int]] | None = None, identify_limiter: IdentifyLimiter | None = None,
+                    record_path: str | None = None, *, codec: Codec | None = None, compress: bool = False,
+                    events: Iterable[str] | None = None, event_queue_size: int = 0,
+                    overflow_policy: OverflowPolicy = OverflowPolicy.BLOCK, droppable_events: Iterable[str] = (),
+                    spill_dir: str | None = None, message_queue_size: int = 0, intents: Intents | None = None,
+                    large_threshold: int | None = None, presence: dict | None = None,
+                    gateway_base_url: str = GATEWAY_BASE_URL, recorder: FrameRecorder | None = None,
+                    entity_cache: "EntityCache | None" = None) -> None:
     """
-    Main loop which opens and initializes the websocket connection. Launches heartbeat, read_handler and write_handler
+    Configure and run the default connection (see GatewayConnection.configure and GatewayConnection.run).
+    With shard_count, runs one connection per shard in this event loop instead. Their events are merged into
+    the default connection's event queue (next_event() etc.) and tagged with "shard_id".
+    send_event_message() sends through the first shard, see shard_connection() for the others.
 
     :param token: User (bot) identification token
+    :param shard_count: Total number of shards, AUTO_SHARD_COUNT for the recommended one, None to not shard
+    :param shard_ids: IDs of the shards to run in this process, all of them by default
+    :param sessions: Sessions to resume, {shard_id: (session_id, resume_gateway_url, sequence_number)}
+    :param identify_limiter: Limiter shared with shards of other processes, a local one by default
+    :param record_path: Append the raw frames received by all shards to this recording file (see recording.replay)
+    :param codec: Gateway payload codec (codecs.ETF_CODEC selects encoding=etf, slower than json),
+                  defaults to the fastest available JSON one (see codecs.default_codec)
+    :param compress: Enable zlib-stream transport compression
+    :param events: Dispatch event names (e.g. "MESSAGE_CREATE") to pass to next_event(), None for all
+    :param event_queue_size: Maximum number of events waiting for next_event(), 0 for unbounded
+    :param overflow_policy: What read_handler does when the event queue is full (see queues.OverflowPolicy)
+    :param droppable_events: Event names which may be dropped with OverflowPolicy.DROP_BY_TYPE
+    :param spill_dir: Directory for the spill file of OverflowPolicy.SPILL
+    :param message_queue_size: Maximum number of messages waiting to be sent, send_event_message() blocks when full
+    :param intents: Gateway intents, by default the minimal ones for events (see intents.intents_for_events)
+    :param large_threshold: Member count (50-250) above which GUILD_CREATE omits offline members
+    :param presence: Initial presence, an op 3 payload
+    :param gateway_base_url: Gateway to connect to when there is no session to resume
+    :param recorder: Recorder of the raw frames received, instead of record_path
+    :param entity_cache: Cache fed with the CACHE_EVENTS received (see cache.EntityCache)
     """
+    if record_path is not None:
+        recorder = FrameRecorder(record_path, (codec or default_codec()).encoding)
+    # connection settings, see GatewayConnection.configure
+    settings = {
+        "codec": codec, "compress": compress, "events": events, "event_queue_size": event_queue_size,
+        "overflow_policy": overflow_policy, "droppable_events": droppable_events, "spill_dir": spill_dir,
+        "message_queue_size": message_queue_size, "intents": intents, "large_threshold": large_threshold,
+        "presence": presence, "gateway_base_url": gateway_base_url, "recorder": recorder, "entity_cache": entity_cache
+    }
+    try:
+        await _run_connections(token, shard_count, shard_ids, sessions, identify_limiter, settings)
+    finally:
+        if record_path is not None:
+            recorder.close()
+
+async def _run_connections(token: str, shard_count: int | None, shard_ids: Iterable[int] | None,
+                           sessions: dict[int, tuple[str, str, int]] | None, identify_limiter: IdentifyLimiter | None,
+                           settings: dict[str, Any]) -> None:
+    connection = default_connection()
+    if shard_count is None:
+        connection.configure(token, **settings)
+        await connection.run()
+        return
+
+    try:
+        max_concurrency = 1
+        if shard_count == AUTO_SHARD_COUNT:
+            gateway_bot = await fetch_gateway_bot(token)
+            shard_count = gateway_bot["shards"]
+            max_concurrency = gateway_bot["session_start_limit"]["max_concurrency"]
+        identify_limiter = identify_limiter or IdentifyLimiter(max_concurrency)
+        shard_ids = list(range(shard_count) if shard_ids is None else shard_ids)
+
+        _shard_connections.clear()
+        for shard_id in shard_ids:
+            if not _shard_connections:
+                sharded_connection = connection
+                sharded_connection.configure(token, shard=(shard_id, shard_count), identify_limiter=identify_limiter, **settings)
+            else:
+                sharded_connection = GatewayConnection(token, connection.event_queue, shard=(shard_id, shard_count),
+                                                       identify_limiter=identify_limiter, **settings)
+            if sessions and shard_id in sessions:
+                sharded_connection.restore_session(*sessions[shard_id])
+            _shard_connections[shard_id] = sharded_connection
+    except asyncio.CancelledError:
+        return
+
+    tasks = [asyncio.create_task(sharded_connection.run()) for sharded_connection in _shard_connections.values()]
     try:
-        async with ws_connect(GATEWAY_URL, max_size=WS_MAX_SIZE) as websocket:
-            await init_connection(websocket, token)
-            await asyncio.gather(heartbeat(websocket), read_handler(websocket), write_handler(websocket))
+        await asyncio.gather(*tasks)
     except asyncio.CancelledError:
         return
+    finally:
+        for task in tasks:
+            task.cancel()